@@ -0,0 +1,92 @@
+import hashlib
+import os
+import re
+import tempfile
+from pathlib import Path
+from typing import Iterator, Optional, Tuple
+
+CHUNK_SIZE = 64 * 1024
+HASH_PATTERN = re.compile(r"^[0-9a-f]{64}$")
+
+# Leading bytes of the image formats the storefront accepts
+IMAGE_SIGNATURES = [
+    (b"\xff\xd8\xff", "image/jpeg"),
+    (b"\x89PNG\r\n\x1a\n", "image/png"),
+    (b"GIF87a", "image/gif"),
+    (b"GIF89a", "image/gif"),
+]
+
+
+def sniff_content_type(head: bytes) -> str:
+    for signature, content_type in IMAGE_SIGNATURES:
+        if head.startswith(signature):
+            return content_type
+    if head[:4] == b"RIFF" and head[8:12] == b"WEBP":
+        return "image/webp"
+    return "application/octet-stream"
+
+
+class LocalBlobStore:
+    """Content-addressed blob store on the local filesystem.
+
+    Blobs are keyed by the SHA-256 of their bytes and laid out as
+    ``<root>/<aa>/<bb>/<hash>`` so that identical uploads are stored once.
+    The interface is kept small enough to swap in an S3 bucket later.
+    """
+
+    def __init__(self, root: Path):
+        self.root = Path(root)
+        self.root.mkdir(parents=True, exist_ok=True)
+
+    def path(self, digest: str) -> Path:
+        if not HASH_PATTERN.match(digest):
+            raise KeyError(digest)
+        return self.root / digest[:2] / digest[2:4] / digest
+
+    def exists(self, digest: str) -> bool:
+        try:
+            return self.path(digest).is_file()
+        except KeyError:
+            return False
+
+    def put(self, data: bytes) -> str:
+        digest = hashlib.sha256(data).hexdigest()
+        target = self.path(digest)
+        if target.is_file():
+            return digest
+        target.parent.mkdir(parents=True, exist_ok=True)
+        # Write to a temp file first so readers never see a partial blob
+        fd, tmp_name = tempfile.mkstemp(dir=target.parent)
+        try:
+            with os.fdopen(fd, "wb") as tmp:
+                tmp.write(data)
+            os.replace(tmp_name, target)
+        except BaseException:
+            if os.path.exists(tmp_name):
+                os.unlink(tmp_name)
+            raise
+        return digest
+
+    def stat(self, digest: str) -> Tuple[int, str]:
+        """Return (size, content_type) of a stored blob, raising KeyError if missing."""
+        path = self.path(digest)
+        if not path.is_file():
+            raise KeyError(digest)
+        with open(path, "rb") as f:
+            head = f.read(16)
+        return path.stat().st_size, sniff_content_type(head)
+
+    def iter_range(self, digest: str, start: int = 0, end: Optional[int] = None) -> Iterator[bytes]:
+        """Yield the bytes in [start, end] (inclusive) in CHUNK_SIZE pieces."""
+        path = self.path(digest)
+        with open(path, "rb") as f:
+            f.seek(start)
+            remaining = None if end is None else end - start + 1
+            while remaining is None or remaining > 0:
+                size = CHUNK_SIZE if remaining is None else min(CHUNK_SIZE, remaining)
+                chunk = f.read(size)
+                if not chunk:
+                    break
+                if remaining is not None:
+                    remaining -= len(chunk)
+                yield chunk
@@ -0,0 +1,74 @@
+"""Database diagnostics for the Automares backend.
+
+Usage (from the backend directory):
+
+    python diagnostics.py ensure-indexes
+    python diagnostics.py check-query-plans
+    python diagnostics.py profile-token /api/orders
+"""
+import asyncio
+import os
+import time
+from pathlib import Path
+
+import typer
+from dotenv import load_dotenv
+from motor.motor_asyncio import AsyncIOMotorClient
+from pymongo import MongoClient
+
+from indexes import INDEXES, QUERY_SHAPES, build_indexes, plan_stages, winning_plan
+from profiling import PROFILE_HEADER, sign_profile_request
+
+ROOT_DIR = Path(__file__).parent
+load_dotenv(ROOT_DIR / '.env')
+
+cli = typer.Typer(help=__doc__)
+
+
+def get_db():
+    return MongoClient(os.environ['MONGO_URL'])[os.environ['DB_NAME']]
+
+
+@cli.command()
+def ensure_indexes():
+    """Create every index the API relies on (safe to run repeatedly)."""
+    async def build_all():
+        # The same build the server runs at startup
+        db = AsyncIOMotorClient(os.environ['MONGO_URL'])[os.environ['DB_NAME']]
+        for collection, indexes in INDEXES.items():
+            names = await build_indexes(db, collection, indexes)
+            typer.echo(f"{collection}: {', '.join(names)}")
+
+    asyncio.run(build_all())
+
+
+@cli.command()
+def check_query_plans():
+    """Explain each handler query shape and fail if any would scan a whole collection."""
+    db = get_db()
+    failures = 0
+    for collection, query, sort in QUERY_SHAPES:
+        cursor = db[collection].find(query)
+        if sort:
+            cursor = cursor.sort(sort)
+        stages = list(plan_stages(winning_plan(cursor.explain())))
+        ok = "COLLSCAN" not in stages
+        failures += not ok
+        typer.echo(f"{'ok  ' if ok else 'FAIL'} {collection} {query} sort={sort}: {' <- '.join(stages)}")
+    if failures:
+        typer.echo(f"{failures} query shape(s) fall back to a collection scan", err=True)
+        raise typer.Exit(code=1)
+
+
+@cli.command()
+def profile_token(path: str, ttl: int = typer.Option(300, help="Seconds the token stays valid")):
+    """Print a signed header that makes the server profile requests to PATH."""
+    secret = os.environ.get("PROFILE_SECRET")
+    if not secret:
+        typer.echo("PROFILE_SECRET is not set", err=True)
+        raise typer.Exit(code=1)
+    typer.echo(f"{PROFILE_HEADER}: {sign_profile_request(secret, path, int(time.time()) + ttl)}")
+
+
+if __name__ == "__main__":
+    cli()
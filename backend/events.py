@@ -0,0 +1,57 @@
+import asyncio
+from collections import defaultdict
+from typing import Any, Dict, Hashable, Set
+
+
+class EventBroker:
+    """In-process fan-out of events to subscribers, keyed by topic.
+
+    Each subscriber gets its own bounded queue. A subscriber that falls behind
+    loses its oldest queued events rather than holding up the publisher, which
+    suits state updates where only the latest value matters. Events only reach
+    subscribers connected to the same process.
+    """
+
+    def __init__(self, max_queued: int = 100):
+        self.max_queued = max_queued
+        self.subscribers: Dict[Hashable, Set[asyncio.Queue]] = defaultdict(set)
+        self.published = 0
+        self.dropped = 0
+
+    def subscribe(self, topic: Hashable) -> asyncio.Queue:
+        queue = asyncio.Queue(maxsize=self.max_queued)
+        self.subscribers[topic].add(queue)
+        return queue
+
+    def unsubscribe(self, topic: Hashable, queue: asyncio.Queue) -> None:
+        queues = self.subscribers.get(topic)
+        if queues is None:
+            return
+        queues.discard(queue)
+        if not queues:
+            del self.subscribers[topic]
+
+    def has_subscribers(self, topic: Hashable) -> bool:
+        return topic in self.subscribers
+
+    def topics(self) -> Set[Hashable]:
+        return set(self.subscribers)
+
+    def publish(self, topic: Hashable, event: Any) -> int:
+        """Queue event for every subscriber of topic; returns how many received it."""
+        queues = self.subscribers.get(topic, ())
+        for queue in queues:
+            if queue.full():
+                queue.get_nowait()
+                self.dropped += 1
+            queue.put_nowait(event)
+        self.published += 1
+        return len(queues)
+
+    def stats(self) -> dict:
+        return {
+            "topics": len(self.subscribers),
+            "subscribers": sum(len(queues) for queues in self.subscribers.values()),
+            "published": self.published,
+            "dropped": self.dropped,
+        }
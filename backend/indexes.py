@@ -0,0 +1,136 @@
+import os
+from pathlib import Path
+
+from dotenv import load_dotenv
+from pymongo import ASCENDING, DESCENDING, TEXT, IndexModel
+from pymongo.errors import OperationFailure
+
+load_dotenv(Path(__file__).parent / '.env')
+
+# Abandoned carts are normally archived by the server's sweeper well before this
+CART_TTL_SECONDS = int(os.environ.get("CART_TTL_SECONDS", str(30 * 24 * 3600)))
+
+# Indexes backing every lookup the API handlers make, by collection
+INDEXES = {
+    "products": [
+        IndexModel([("id", ASCENDING)], unique=True),
+        IndexModel([("created_at", ASCENDING), ("id", ASCENDING)]),
+        IndexModel([("category", ASCENDING), ("created_at", ASCENDING), ("id", ASCENDING)]),
+        IndexModel([("reserved_by", ASCENDING)], sparse=True),
+        IndexModel([("stock_quantity", ASCENDING)]),
+        # Only products that have a SKU take part in uniqueness
+        IndexModel([("sku", ASCENDING)], unique=True, partialFilterExpression={"sku": {"$type": "string"}}),
+        IndexModel([("name", TEXT), ("description", TEXT)], weights={"name": 5, "description": 1}, name="products_text"),
+    ],
+    "carts": [
+        IndexModel([("session_id", ASCENDING)], unique=True),
+        IndexModel([("updated_at", ASCENDING)], expireAfterSeconds=CART_TTL_SECONDS, name="carts_ttl"),
+    ],
+    "abandoned_carts": [
+        IndexModel([("session_id", ASCENDING), ("last_active_at", ASCENDING)], unique=True),
+        IndexModel([("last_active_at", ASCENDING)]),
+    ],
+    "orders": [
+        IndexModel([("id", ASCENDING)], unique=True),
+        IndexModel([("user_id", ASCENDING), ("created_at", DESCENDING)]),
+        IndexModel([("created_at", ASCENDING), ("id", ASCENDING)]),
+        IndexModel([("mpesa_checkouts.token_hash", ASCENDING)], sparse=True),
+    ],
+    "sales_daily": [
+        IndexModel([("day", ASCENDING)], unique=True),
+    ],
+    "sales_by_category": [
+        IndexModel([("day", ASCENDING), ("category", ASCENDING)], unique=True),
+    ],
+    "product_sales": [
+        IndexModel([("product_id", ASCENDING)], unique=True),
+        IndexModel([("revenue", DESCENDING)]),
+    ],
+    "stock_ledger": [
+        IndexModel([("product_id", ASCENDING), ("created_at", ASCENDING)]),
+        IndexModel([("batch_id", ASCENDING)]),
+    ],
+    "users": [
+        IndexModel([("email", ASCENDING)], unique=True),
+        IndexModel([("id", ASCENDING)], unique=True),
+    ],
+    "mpesa_callbacks": [
+        IndexModel([("id", ASCENDING)], unique=True),
+        IndexModel([("processed", ASCENDING), ("received_at", ASCENDING)]),
+    ],
+    "jobs": [
+        IndexModel([("id", ASCENDING)], unique=True),
+        IndexModel([("status", ASCENDING), ("run_at", ASCENDING)]),
+    ],
+}
+
+# One representative (collection, filter, sort) per query shape the handlers use
+QUERY_SHAPES = [
+    ("products", {"id": "x"}, None),  # get_product, add_to_cart, update_product
+    ("products", {"id": {"$in": ["x", "y"]}}, None),  # reserve_stock, apply_cart_batch
+    ("products", {"sku": "x"}, None),  # bulk_import_products
+    ("products", {"reserved_by": "x"}, None),  # release_stock, commit_stock
+    ("products", {}, [("created_at", ASCENDING), ("id", ASCENDING)]),  # get_products
+    ("products", {"category": "x"}, [("created_at", ASCENDING), ("id", ASCENDING)]),  # get_products
+    ("products", {"$or": [
+        {"created_at": {"$gt": "x"}},
+        {"created_at": "x", "id": {"$gt": "y"}},
+    ]}, [("created_at", ASCENDING), ("id", ASCENDING)]),  # get_products after a cursor
+    ("products", {"$text": {"$search": "x"}}, None),  # search_products
+    ("products", {"stock_quantity": {"$lte": 5}}, [("stock_quantity", ASCENDING)]),  # low_stock_stats
+    ("carts", {"session_id": "x"}, None),  # cart endpoints, create_order
+    # archive_abandoned_carts; checked_out_order_id is filtered on the rows the updated_at range yields
+    ("carts", {"updated_at": {"$lt": "x"}}, [("updated_at", ASCENDING)]),
+    ("orders", {"id": "x"}, None),  # get_order, update_order_status, initiate_stk_push
+    ("orders", {"user_id": "x"}, None),  # get_my_orders
+    ("orders", {}, [("created_at", DESCENDING)]),  # get_orders
+    ("orders", {"mpesa_checkouts.token_hash": "x"}, None),  # initiate_stk_push, apply_mpesa_callbacks
+    ("orders", {"$or": [
+        {"created_at": {"$gt": "x"}},
+        {"created_at": "x", "id": {"$gt": "y"}},
+    ]}, [("created_at", ASCENDING), ("id", ASCENDING)]),  # export_orders after a cursor
+    ("sales_daily", {"day": {"$gte": "x"}}, [("day", ASCENDING)]),  # revenue_stats
+    ("sales_by_category", {"day": {"$gte": "x"}}, None),  # revenue_stats
+    ("product_sales", {}, [("revenue", DESCENDING)]),  # top_products_stats
+    ("users", {"email": "x"}, None),  # get_user, register
+    ("mpesa_callbacks", {"processed": False}, [("received_at", ASCENDING)]),  # apply_mpesa_callbacks
+    ("jobs", {"status": {"$in": ["pending", "running"]}, "run_at": {"$lte": "x"}}, [("run_at", ASCENDING)]),  # JobQueue.claim
+]
+
+
+def ttl_settings(indexes):
+    """(name, expireAfterSeconds) for each TTL index, so existing ones can be updated with collMod."""
+    return [
+        (model.document["name"], model.document["expireAfterSeconds"])
+        for model in indexes if "expireAfterSeconds" in model.document
+    ]
+
+
+async def build_indexes(db, collection: str, indexes) -> list:
+    """Create indexes on a collection of the Motor database db; returns their names.
+
+    TTL changes are applied to existing indexes in place with collMod first,
+    since create_indexes would reject them as a conflict.
+    """
+    for name, seconds in ttl_settings(indexes):
+        try:
+            await db.command("collMod", collection, index={"name": name, "expireAfterSeconds": seconds})
+        except OperationFailure:
+            pass  # Collection or index does not exist yet
+    return await db[collection].create_indexes(indexes)
+
+
+def plan_stages(plan: dict):
+    """Yield every stage name in an explain() query plan tree."""
+    if "stage" in plan:
+        yield plan["stage"]
+    for key in ("inputStage", "queryPlan"):
+        if key in plan:
+            yield from plan_stages(plan[key])
+    for child in plan.get("inputStages", []):
+        yield from plan_stages(child)
+
+
+def winning_plan(explain: dict) -> dict:
+    planner = explain.get("queryPlanner", {})
+    return planner.get("winningPlan", {})
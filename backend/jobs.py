@@ -0,0 +1,207 @@
+import asyncio
+import logging
+import uuid
+from datetime import datetime, timedelta
+from typing import Awaitable, Callable, Dict, List, Optional, Tuple
+
+from pymongo import ReturnDocument
+
+logger = logging.getLogger(__name__)
+
+Handler = Callable[[dict], Awaitable[None]]
+
+
+class JobQueue:
+    """Durable background job queue stored in a MongoDB collection.
+
+    Jobs are claimed one at a time with find_one_and_update. A claimed job
+    has its run_at pushed out by the lease, so a job whose worker died is
+    picked up again once the lease lapses. Failures are retried with
+    exponential backoff up to the handler's attempt limit, after which the
+    job is kept with status "failed" for inspection; so is a job whose lease
+    lapses on its last attempt, without running it again. Finished jobs are
+    deleted. Handlers must therefore be safe to run more than once unless
+    registered with max_attempts=1.
+    """
+
+    def __init__(
+        self,
+        collection: Callable,
+        workers: int = 2,
+        poll_seconds: float = 5.0,
+        lease_seconds: float = 60.0,
+        max_attempts: int = 5,
+        backoff_seconds: float = 2.0,
+    ):
+        # Resolved on every use so the queue follows the app's current database
+        self._collection = collection
+        self.workers = workers
+        self.poll_seconds = poll_seconds
+        self.lease_seconds = lease_seconds
+        self.max_attempts = max_attempts
+        self.backoff_seconds = backoff_seconds
+        self.handlers: Dict[str, Tuple[Handler, int]] = {}
+        self.tasks: List[asyncio.Task] = []
+        self._wakeup = asyncio.Event()
+
+    @property
+    def collection(self):
+        return self._collection()
+
+    def register(self, job_type: str, handler: Handler, max_attempts: Optional[int] = None) -> None:
+        self.handlers[job_type] = (handler, max_attempts or self.max_attempts)
+
+    def job(self, job_type: str, payload: dict) -> dict:
+        if job_type not in self.handlers:
+            raise KeyError(f"No handler registered for job type {job_type!r}")
+        now = datetime.utcnow()
+        return {
+            "id": str(uuid.uuid4()),
+            "type": job_type,
+            "payload": payload,
+            "status": "pending",
+            "attempts": 0,
+            "run_at": now,
+            "created_at": now,
+        }
+
+    async def enqueue(self, *jobs: Tuple[str, dict]) -> None:
+        """Store (job_type, payload) pairs with a single insert and wake the workers."""
+        await self.collection.insert_many([self.job(job_type, payload) for job_type, payload in jobs])
+        self.wake()
+
+    async def claim(self) -> Optional[dict]:
+        now = datetime.utcnow()
+        return await self.collection.find_one_and_update(
+            {"status": {"$in": ["pending", "running"]}, "run_at": {"$lte": now}},
+            {
+                "$set": {"status": "running", "run_at": now + timedelta(seconds=self.lease_seconds)},
+                "$inc": {"attempts": 1},
+            },
+            sort=[("run_at", 1)],
+            return_document=ReturnDocument.AFTER,
+        )
+
+    async def run_one(self) -> bool:
+        """Claim and run a single due job; returns False when none was due."""
+        job = await self.claim()
+        if job is None:
+            return False
+        # Only the worker holding the latest claim may settle the job
+        owner = {"id": job["id"], "attempts": job["attempts"]}
+        handler, max_attempts = self.handlers.get(job["type"], (None, 1))
+        if job["attempts"] > max_attempts:
+            # A worker died or overran its lease on the final attempt, which may
+            # have taken effect, so the job is not run again
+            logger.error("Job %s (%s) lease expired on its last attempt", job["id"], job["type"])
+            update = {"status": "failed", "last_error": "Lease expired on the last attempt",
+                      "failed_at": datetime.utcnow()}
+            await self.collection.update_one(owner, {"$set": update})
+            return True
+        try:
+            if handler is None:
+                raise KeyError(f"No handler registered for job type {job['type']!r}")
+            await handler(job["payload"])
+        except asyncio.CancelledError:
+            raise
+        except Exception as exc:
+            error = f"{type(exc).__name__}: {exc}"
+            if job["attempts"] >= max_attempts:
+                logger.exception("Job %s (%s) failed permanently", job["id"], job["type"])
+                update = {"status": "failed", "last_error": error, "failed_at": datetime.utcnow()}
+            else:
+                logger.warning("Job %s (%s) failed, retrying: %s", job["id"], job["type"], error)
+                delay = self.backoff_seconds * 2 ** (job["attempts"] - 1)
+                update = {"status": "pending", "last_error": error,
+                          "run_at": datetime.utcnow() + timedelta(seconds=delay)}
+            await self.collection.update_one(owner, {"$set": update})
+        else:
+            await self.collection.delete_one(owner)
+        return True
+
+    def wake(self) -> None:
+        self._wakeup.set()
+
+    def start(self) -> None:
+        self.tasks = [asyncio.create_task(self._run()) for _ in range(self.workers)]
+
+    async def stop(self) -> None:
+        for task in self.tasks:
+            task.cancel()
+        for task in self.tasks:
+            try:
+                await task
+            except asyncio.CancelledError:
+                pass
+        self.tasks = []
+
+    async def _run(self) -> None:
+        while True:
+            self._wakeup.clear()
+            try:
+                while await self.run_one():
+                    pass
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                logger.exception("Job queue worker failed")
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=self.poll_seconds)
+            except asyncio.TimeoutError:
+                pass
+
+    async def stats(self) -> dict:
+        counts = await self.collection.aggregate([
+            {"$group": {"_id": "$status", "count": {"$sum": 1}}}
+        ]).to_list(None)
+        return {
+            "workers": len(self.tasks),
+            "handlers": sorted(self.handlers),
+            "jobs": {entry["_id"]: entry["count"] for entry in counts},
+        }
+
+
+class BatchWorker:
+    """Background task that repeatedly runs a batch function.
+
+    process_batch returns how many items it handled; the worker keeps calling
+    it while full batches come back, then sleeps until woken or until the
+    next poll, so work left behind by a restart is still picked up.
+    """
+
+    def __init__(self, name: str, process_batch: Callable[[], Awaitable[int]], batch_size: int, poll_seconds: float):
+        self.name = name
+        self.process_batch = process_batch
+        self.batch_size = batch_size
+        self.poll_seconds = poll_seconds
+        self.task: Optional[asyncio.Task] = None
+        self._wakeup = asyncio.Event()
+
+    def wake(self) -> None:
+        self._wakeup.set()
+
+    def start(self) -> None:
+        self.task = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        if self.task:
+            self.task.cancel()
+            try:
+                await self.task
+            except asyncio.CancelledError:
+                pass
+
+    async def _run(self) -> None:
+        while True:
+            self._wakeup.clear()
+            try:
+                while await self.process_batch() >= self.batch_size:
+                    pass
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                logger.exception("%s failed", self.name)
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=self.poll_seconds)
+            except asyncio.TimeoutError:
+                pass
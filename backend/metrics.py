@@ -0,0 +1,190 @@
+import bisect
+import contextvars
+import threading
+import time
+from collections import defaultdict
+from typing import Dict, Optional, Sequence, Tuple
+
+from pymongo import monitoring
+
+# Seconds; roughly the Prometheus client defaults
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+BACKGROUND_ROUTE = "background"
+UNMATCHED_ROUTE = "unmatched"
+
+# The ASGI scope of the request being served; Motor copies the context into its
+# executor threads, so command events can see which request issued them
+current_scope: contextvars.ContextVar[Optional[dict]] = contextvars.ContextVar("current_scope", default=None)
+
+
+def route_label(scope: Optional[dict]) -> str:
+    """Route template (not the raw path) of a request, to keep label cardinality bounded."""
+    if scope is None:
+        return BACKGROUND_ROUTE
+    route = scope.get("route")
+    return getattr(route, "path", UNMATCHED_ROUTE)
+
+
+class Histogram:
+    def __init__(self, buckets: Sequence[float]):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float) -> None:
+        index = bisect.bisect_left(self.buckets, value)
+        if index < len(self.counts):
+            self.counts[index] += 1
+        self.sum += value
+        self.count += 1
+
+    def cumulative(self):
+        total = 0
+        for bound, count in zip(self.buckets, self.counts):
+            total += count
+            yield bound, total
+
+
+def escape_label_value(value) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def format_labels(labels: Dict[str, str]) -> str:
+    return "{" + ",".join(f'{name}="{escape_label_value(value)}"' for name, value in labels.items()) + "}"
+
+
+class Metrics:
+    """Request and MongoDB command metrics rendered in the Prometheus text format.
+
+    Updated from the event loop and from Motor's executor threads, so every
+    write takes a lock.
+    """
+
+    def __init__(self, buckets: Sequence[float] = DEFAULT_BUCKETS):
+        self.buckets = tuple(buckets)
+        self._lock = threading.Lock()
+        self.request_durations: Dict[Tuple[str, str], Histogram] = {}
+        self.responses: Dict[Tuple[str, str, str], int] = defaultdict(int)
+        self.in_flight = 0
+        self.command_durations: Dict[Tuple[str, str], Histogram] = {}
+        self.command_failures: Dict[Tuple[str, str], int] = defaultdict(int)
+
+    def _histogram(self, table: dict, key: tuple) -> Histogram:
+        histogram = table.get(key)
+        if histogram is None:
+            histogram = table[key] = Histogram(self.buckets)
+        return histogram
+
+    def request_started(self) -> None:
+        with self._lock:
+            self.in_flight += 1
+
+    def request_finished(self, method: str, route: str, status: int, seconds: Optional[float]) -> None:
+        with self._lock:
+            self.in_flight -= 1
+            self.responses[(method, route, str(status))] += 1
+            if seconds is not None:
+                self._histogram(self.request_durations, (method, route)).observe(seconds)
+
+    def command_finished(self, route: str, command: str, seconds: float, failed: bool = False) -> None:
+        with self._lock:
+            self._histogram(self.command_durations, (route, command)).observe(seconds)
+            if failed:
+                self.command_failures[(route, command)] += 1
+
+    def command_listener(self) -> "CommandMetricsListener":
+        return CommandMetricsListener(self)
+
+    def render(self) -> str:
+        with self._lock:
+            lines = []
+            self._render_histograms(
+                lines, "http_request_duration_seconds", "Time to serve a request, by route template.",
+                ("method", "route"), self.request_durations,
+            )
+            lines += [
+                "# HELP http_requests_total Responses sent, by route template and status code.",
+                "# TYPE http_requests_total counter",
+            ]
+            for (method, route, status), count in sorted(self.responses.items()):
+                lines.append(f"http_requests_total{format_labels({'method': method, 'route': route, 'status': status})} {count}")
+            lines += [
+                "# HELP http_requests_in_flight Requests currently being served.",
+                "# TYPE http_requests_in_flight gauge",
+                f"http_requests_in_flight {self.in_flight}",
+            ]
+            self._render_histograms(
+                lines, "mongodb_command_duration_seconds", "MongoDB command round trips, by the route that issued them.",
+                ("route", "command"), self.command_durations,
+            )
+            lines += [
+                "# HELP mongodb_command_failures_total MongoDB commands that returned an error.",
+                "# TYPE mongodb_command_failures_total counter",
+            ]
+            for (route, command), count in sorted(self.command_failures.items()):
+                lines.append(f"mongodb_command_failures_total{format_labels({'route': route, 'command': command})} {count}")
+            return "\n".join(lines) + "\n"
+
+    def _render_histograms(self, lines, name, help_text, label_names, table) -> None:
+        lines += [f"# HELP {name} {help_text}", f"# TYPE {name} histogram"]
+        for key, histogram in sorted(table.items()):
+            labels = dict(zip(label_names, key))
+            for bound, count in histogram.cumulative():
+                lines.append(f"{name}_bucket{format_labels({**labels, 'le': repr(bound)})} {count}")
+            lines.append(f"{name}_bucket{format_labels({**labels, 'le': '+Inf'})} {histogram.count}")
+            lines.append(f"{name}_sum{format_labels(labels)} {histogram.sum}")
+            lines.append(f"{name}_count{format_labels(labels)} {histogram.count}")
+
+
+class CommandMetricsListener(monitoring.CommandListener):
+    def __init__(self, metrics: Metrics):
+        self.metrics = metrics
+
+    def started(self, event):
+        pass
+
+    def succeeded(self, event):
+        self.metrics.command_finished(route_label(current_scope.get()), event.command_name, event.duration_micros / 1e6)
+
+    def failed(self, event):
+        self.metrics.command_finished(
+            route_label(current_scope.get()), event.command_name, event.duration_micros / 1e6, failed=True
+        )
+
+
+class MetricsMiddleware:
+    """ASGI middleware timing every HTTP request and counting its response status.
+
+    Event streams are counted but not timed, since their duration is the
+    length of the client's session rather than the cost of serving it.
+    """
+
+    def __init__(self, app, metrics: Metrics):
+        self.app = app
+        self.metrics = metrics
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        response = {"status": 500, "stream": False}
+
+        async def send_wrapper(message):
+            if message["type"] == "http.response.start":
+                response["status"] = message["status"]
+                headers = dict(message.get("headers", []))
+                response["stream"] = headers.get(b"content-type", b"").startswith(b"text/event-stream")
+            await send(message)
+
+        token = current_scope.set(scope)
+        self.metrics.request_started()
+        started = time.perf_counter()
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            elapsed = None if response["stream"] else time.perf_counter() - started
+            self.metrics.request_finished(scope["method"], route_label(scope), response["status"], elapsed)
+            current_scope.reset(token)
@@ -0,0 +1,154 @@
+import asyncio
+import base64
+import logging
+import time
+from datetime import datetime
+from typing import Optional
+
+import httpx
+
+logger = logging.getLogger(__name__)
+
+SANDBOX_URL = "https://sandbox.safaricom.co.ke"
+PRODUCTION_URL = "https://api.safaricom.co.ke"
+
+# Retry on throttling and upstream failures; anything else is the caller's fault
+RETRYABLE_STATUSES = {429, 500, 502, 503, 504}
+# A push that reached Safaricom may already have prompted the customer, so
+# non-idempotent requests are only retried when they cannot have been processed
+UNSENT_ERRORS = (httpx.ConnectError, httpx.ConnectTimeout)
+UNPROCESSED_STATUSES = {429}
+
+
+class MpesaError(Exception):
+    pass
+
+
+class DarajaClient:
+    """Async client for the Safaricom Daraja API.
+
+    Keeps one pooled HTTP connection set for the life of the process and
+    caches the OAuth token until shortly before it expires, so an STK push
+    costs a single round trip in the common case.
+    """
+
+    def __init__(
+        self,
+        base_url: str,
+        consumer_key: Optional[str],
+        consumer_secret: Optional[str],
+        shortcode: Optional[str],
+        passkey: Optional[str],
+        timeout: float = 10.0,
+        max_retries: int = 2,
+        backoff: float = 0.5,
+        token_refresh_margin: float = 60.0,
+        max_connections: int = 20,
+    ):
+        self.base_url = base_url.rstrip("/")
+        self.consumer_key = consumer_key
+        self.consumer_secret = consumer_secret
+        self.shortcode = shortcode
+        self.passkey = passkey
+        self.timeout = timeout
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.token_refresh_margin = token_refresh_margin
+        self.max_connections = max_connections
+        self._http: Optional[httpx.AsyncClient] = None
+        self._token: Optional[str] = None
+        self._token_expires_at = 0.0
+        self._token_lock = asyncio.Lock()
+
+    @property
+    def http(self) -> httpx.AsyncClient:
+        if self._http is None:
+            self._http = httpx.AsyncClient(
+                base_url=self.base_url,
+                timeout=self.timeout,
+                limits=httpx.Limits(max_connections=self.max_connections, max_keepalive_connections=self.max_connections),
+            )
+        return self._http
+
+    async def aclose(self) -> None:
+        if self._http is not None:
+            await self._http.aclose()
+            self._http = None
+
+    async def _request(self, method: str, url: str, idempotent: bool = True, **kwargs) -> httpx.Response:
+        retryable_errors = httpx.TransportError if idempotent else UNSENT_ERRORS
+        retryable_statuses = RETRYABLE_STATUSES if idempotent else UNPROCESSED_STATUSES
+        for attempt in range(self.max_retries + 1):
+            try:
+                response = await self.http.request(method, url, **kwargs)
+            except httpx.TransportError as exc:
+                if not isinstance(exc, retryable_errors) or attempt == self.max_retries:
+                    raise MpesaError(f"M-Pesa request failed: {exc}") from exc
+                logger.warning("M-Pesa %s %s failed (%s), retrying", method, url, exc)
+            else:
+                if response.status_code not in retryable_statuses or attempt == self.max_retries:
+                    return response
+                logger.warning("M-Pesa %s %s returned %s, retrying", method, url, response.status_code)
+            await asyncio.sleep(self.backoff * 2 ** attempt)
+
+    async def access_token(self) -> str:
+        if self._token and time.monotonic() < self._token_expires_at:
+            return self._token
+        async with self._token_lock:
+            # Another request may have refreshed the token while we waited
+            if self._token and time.monotonic() < self._token_expires_at:
+                return self._token
+            response = await self._request(
+                "GET",
+                "/oauth/v1/generate",
+                params={"grant_type": "client_credentials"},
+                auth=(self.consumer_key or "", self.consumer_secret or ""),
+            )
+            if response.status_code != 200:
+                raise MpesaError("Could not get M-Pesa access token")
+            data = response.json()
+            expires_in = float(data.get("expires_in", 3599))
+            self._token = data["access_token"]
+            self._token_expires_at = time.monotonic() + max(expires_in - self.token_refresh_margin, 0)
+            return self._token
+
+    def invalidate_token(self) -> None:
+        self._token = None
+        self._token_expires_at = 0.0
+
+    async def stk_push(self, amount: int, phone_number: str, account_reference: str,
+                       callback_url: str, description: str = "Payment for order") -> dict:
+        timestamp = datetime.now().strftime("%Y%m%d%H%M%S")
+        password_str = f"{self.shortcode}{self.passkey}{timestamp}"
+        payload = {
+            "BusinessShortCode": self.shortcode,
+            "Password": base64.b64encode(password_str.encode()).decode(),
+            "Timestamp": timestamp,
+            "TransactionType": "CustomerPayBillOnline",
+            "Amount": amount,
+            "PartyA": phone_number,
+            "PartyB": self.shortcode,
+            "PhoneNumber": phone_number,
+            "CallBackURL": callback_url,
+            "AccountReference": account_reference,
+            "TransactionDesc": description,
+        }
+
+        response = await self._post_authorized("/mpesa/stkpush/v1/processrequest", payload)
+        if response.status_code != 200:
+            raise MpesaError("M-Pesa STK push failed")
+        return response.json()
+
+    async def _post_authorized(self, url: str, payload: dict) -> httpx.Response:
+        token = await self.access_token()
+        response = await self._request(
+            "POST", url, idempotent=False, json=payload, headers={"Authorization": f"Bearer {token}"}
+        )
+        if response.status_code == 401:
+            # Token revoked or expired early on Safaricom's side; fetch a fresh one once
+            self.invalidate_token()
+            token = await self.access_token()
+            response = await self._request(
+                "POST", url, idempotent=False, json=payload, headers={"Authorization": f"Bearer {token}"}
+            )
+        return response
@@ -0,0 +1,107 @@
+import threading
+import time
+from collections import defaultdict
+
+from pymongo import monitoring
+
+
+class PoolStats:
+    def __init__(self):
+        self.open = 0
+        self.checked_out = 0
+        self.waiting = 0
+        self.checkouts = 0
+        self.checkout_failures = 0
+        self.wait_seconds_total = 0.0
+        self.wait_seconds_max = 0.0
+        self.cleared = 0
+
+    def as_dict(self) -> dict:
+        return {
+            "open": self.open,
+            "checked_out": self.checked_out,
+            "wait_queue": self.waiting,
+            "checkouts": self.checkouts,
+            "checkout_failures": self.checkout_failures,
+            "wait_ms_avg": round(1000 * self.wait_seconds_total / self.checkouts, 3) if self.checkouts else 0.0,
+            "wait_ms_max": round(1000 * self.wait_seconds_max, 3),
+            "cleared": self.cleared,
+        }
+
+
+class PoolStatsListener(monitoring.ConnectionPoolListener):
+    """Tracks connection pool usage per server from pymongo's CMAP events.
+
+    Events fire on the threads Motor runs pymongo on, and a checkout starts
+    and finishes on the same thread, so the wait is timed with a thread-local.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._pools = defaultdict(PoolStats)
+
+    def _address(self, event) -> str:
+        host, port = event.address
+        return f"{host}:{port}"
+
+    def _finish_wait(self, pool: PoolStats) -> float:
+        started = getattr(self._local, "check_out_started", None)
+        self._local.check_out_started = None
+        pool.waiting = max(pool.waiting - 1, 0)
+        return time.perf_counter() - started if started is not None else 0.0
+
+    def pool_created(self, event):
+        pass
+
+    def pool_ready(self, event):
+        pass
+
+    def pool_cleared(self, event):
+        with self._lock:
+            self._pools[self._address(event)].cleared += 1
+
+    def pool_closed(self, event):
+        with self._lock:
+            self._pools.pop(self._address(event), None)
+
+    def connection_created(self, event):
+        with self._lock:
+            self._pools[self._address(event)].open += 1
+
+    def connection_ready(self, event):
+        pass
+
+    def connection_closed(self, event):
+        with self._lock:
+            pool = self._pools[self._address(event)]
+            pool.open = max(pool.open - 1, 0)
+
+    def connection_check_out_started(self, event):
+        self._local.check_out_started = time.perf_counter()
+        with self._lock:
+            self._pools[self._address(event)].waiting += 1
+
+    def connection_check_out_failed(self, event):
+        with self._lock:
+            pool = self._pools[self._address(event)]
+            self._finish_wait(pool)
+            pool.checkout_failures += 1
+
+    def connection_checked_out(self, event):
+        with self._lock:
+            pool = self._pools[self._address(event)]
+            waited = self._finish_wait(pool)
+            pool.checked_out += 1
+            pool.checkouts += 1
+            pool.wait_seconds_total += waited
+            pool.wait_seconds_max = max(pool.wait_seconds_max, waited)
+
+    def connection_checked_in(self, event):
+        with self._lock:
+            pool = self._pools[self._address(event)]
+            pool.checked_out = max(pool.checked_out - 1, 0)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {address: pool.as_dict() for address, pool in self._pools.items()}
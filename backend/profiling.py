@@ -0,0 +1,185 @@
+import asyncio
+import hashlib
+import hmac
+import json
+import os
+import random
+import sys
+import threading
+import time
+import uuid
+from collections import Counter
+from datetime import datetime
+from pathlib import Path
+from typing import List, Optional
+
+from metrics import route_label
+
+PROFILE_HEADER = "x-profile-token"
+PROFILE_ID_HEADER = "X-Profile-Id"
+
+
+def sign_profile_request(secret: str, path: str, expires: int) -> str:
+    """Header value that asks for one profile of path until the unix time expires."""
+    signature = hmac.new(secret.encode(), f"{expires}:{path}".encode(), hashlib.sha256).hexdigest()
+    return f"{expires}.{signature}"
+
+
+def verify_profile_token(secret: str, path: str, token: str) -> bool:
+    expires = token.partition(".")[0]
+    if not expires.isdigit() or int(expires) < time.time():
+        return False
+    return hmac.compare_digest(sign_profile_request(secret, path, int(expires)), token)
+
+
+def collapse_stack(frame) -> str:
+    """One stack in the collapsed format flamegraph tools read: root;...;leaf."""
+    names = []
+    while frame is not None:
+        code = frame.f_code
+        names.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+        frame = frame.f_back
+    return ";".join(reversed(names))
+
+
+class StackSampler(threading.Thread):
+    """Samples the stack of one thread at a fixed interval until stopped.
+
+    Pointed at the event loop thread this sees every coroutine the loop runs
+    while the request is in flight, not only the profiled handler, and time
+    the loop spends waiting shows up under the selector.
+    """
+
+    def __init__(self, thread_id: int, interval: float):
+        super().__init__(daemon=True)
+        self.thread_id = thread_id
+        self.interval = interval
+        self.stacks: Counter = Counter()
+        self._stopped = threading.Event()
+
+    def run(self) -> None:
+        while not self._stopped.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            if frame is not None:
+                self.stacks[collapse_stack(frame)] += 1
+
+    def stop(self) -> Counter:
+        self._stopped.set()
+        self.join()
+        return self.stacks
+
+
+class ProfileStore:
+    """Keeps the newest max_profiles profiles as files under root.
+
+    Each profile is a <id>.collapsed stack file plus a <id>.json summary.
+    """
+
+    def __init__(self, root: Path, max_profiles: int = 200):
+        self.root = Path(root)
+        self.max_profiles = max_profiles
+
+    def _summaries(self) -> List[Path]:
+        if not self.root.is_dir():
+            return []
+        return sorted(self.root.glob("*.json"), key=lambda path: path.stat().st_mtime, reverse=True)
+
+    def save(self, summary: dict, stacks: Counter) -> None:
+        self.root.mkdir(parents=True, exist_ok=True)
+        lines = [f"{stack} {count}" for stack, count in stacks.most_common()]
+        (self.root / f"{summary['id']}.collapsed").write_text("\n".join(lines) + "\n")
+        (self.root / f"{summary['id']}.json").write_text(json.dumps(summary))
+        for stale in self._summaries()[self.max_profiles:]:
+            stale.with_suffix(".collapsed").unlink(missing_ok=True)
+            stale.unlink(missing_ok=True)
+
+    def index(self, limit: int = 50) -> List[dict]:
+        return [json.loads(path.read_text()) for path in self._summaries()[:limit]]
+
+    def read(self, profile_id: str) -> Optional[str]:
+        try:
+            uuid.UUID(profile_id)
+        except ValueError:
+            return None
+        path = self.root / f"{profile_id}.collapsed"
+        return path.read_text() if path.is_file() else None
+
+
+class ProfilingMiddleware:
+    """ASGI middleware that profiles a sample of requests.
+
+    A request is profiled when it carries a valid signed x-profile-token
+    header, or at random with probability sample_rate. At most max_concurrent
+    requests are profiled at once. Other requests pay for one random() call
+    and a header lookup; the app should not install the middleware at all
+    when profiling is disabled. Event streams are not profiled: sampling
+    stops when their response starts, since they would otherwise hold a
+    slot for as long as the client stays connected.
+    """
+
+    def __init__(self, app, store: ProfileStore, sample_rate: float = 0.0, secret: Optional[str] = None,
+                 interval: float = 0.005, max_concurrent: int = 2):
+        self.app = app
+        self.store = store
+        self.sample_rate = sample_rate
+        self.secret = secret
+        self.interval = interval
+        self.max_concurrent = max_concurrent
+        self.active = 0
+
+    def requested(self, scope) -> bool:
+        if not self.secret:
+            return False
+        for name, value in scope["headers"]:
+            if name == PROFILE_HEADER.encode():
+                return verify_profile_token(self.secret, scope["path"], value.decode("latin-1"))
+        return False
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or self.active >= self.max_concurrent:
+            await self.app(scope, receive, send)
+            return
+        sampled = self.sample_rate > 0 and random.random() < self.sample_rate
+        if not (sampled or self.requested(scope)):
+            await self.app(scope, receive, send)
+            return
+
+        profile_id = str(uuid.uuid4())
+        response = {"status": 500, "stream": False}
+
+        async def send_wrapper(message):
+            if message["type"] == "http.response.start":
+                response["status"] = message["status"]
+                headers = dict(message.get("headers", []))
+                if headers.get(b"content-type", b"").startswith(b"text/event-stream"):
+                    response["stream"] = True
+                    self.active -= 1
+                    await asyncio.to_thread(sampler.stop)
+                else:
+                    message["headers"] = [*message.get("headers", []), (PROFILE_ID_HEADER.encode(), profile_id.encode())]
+            await send(message)
+
+        self.active += 1
+        sampler = StackSampler(threading.get_ident(), self.interval)
+        sampler.start()
+        started = time.perf_counter()
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            if not response["stream"]:
+                elapsed = time.perf_counter() - started
+                self.active -= 1
+                stacks = await asyncio.to_thread(sampler.stop)
+                summary = {
+                    "id": profile_id,
+                    "method": scope["method"],
+                    "path": scope["path"],
+                    "route": route_label(scope),
+                    "status": response["status"],
+                    "duration_ms": round(elapsed * 1000, 3),
+                    "samples": sum(stacks.values()),
+                    "interval_ms": self.interval * 1000,
+                    "trigger": "sampled" if sampled else "header",
+                    "created_at": datetime.utcnow().isoformat(),
+                }
+                await asyncio.to_thread(self.store.save, summary, stacks)
@@ -1,19 +1,50 @@
-from fastapi import FastAPI, APIRouter, HTTPException, File, UploadFile, Form, Depends
+from fastapi import FastAPI, APIRouter, HTTPException, File, UploadFile, Form, Depends, Request, Response
+from fastapi.encoders import jsonable_encoder
+from fastapi.responses import ORJSONResponse, StreamingResponse
 from fastapi.security import OAuth2PasswordBearer, OAuth2PasswordRequestForm
 from dotenv import load_dotenv
 from starlette.middleware.cors import CORSMiddleware
 from motor.motor_asyncio import AsyncIOMotorClient
+from pymongo import DeleteOne, ReadPreference, ReturnDocument, UpdateOne
+from pymongo.errors import BulkWriteError, DuplicateKeyError, OperationFailure
+from pydantic import ValidationError
 import os
 import logging
 from pathlib import Path
 from pydantic import BaseModel, Field
-from typing import List, Optional
+from typing import List, Literal, Optional
 import uuid
+import asyncio
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager
 from datetime import datetime, timedelta
 import base64
 import json
 from passlib.context import CryptContext
 from jose import JWTError, jwt
+import binascii
+import hashlib
+import secrets
+import orjson
+import csv
+import io
+from functools import lru_cache
+from blob_store import LocalBlobStore
+from cache import TTLCache
+from events import EventBroker
+from indexes import INDEXES, build_indexes
+from jobs import BatchWorker, JobQueue
+from metrics import Metrics, MetricsMiddleware
+from profiling import PROFILE_ID_HEADER, ProfileStore, ProfilingMiddleware
+from pool_stats import PoolStatsListener
+
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:  # Parquet export is optional
+    pyarrow = None
+from mpesa import DarajaClient, MpesaError, PRODUCTION_URL, SANDBOX_URL
 
 ROOT_DIR = Path(__file__).parent
 load_dotenv(ROOT_DIR / '.env')
@@ -23,20 +54,126 @@ SECRET_KEY = os.environ.get("SECRET_KEY", "a_secret_key")
 ALGORITHM = "HS256"
 ACCESS_TOKEN_EXPIRE_MINUTES = 30
 
-pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
+BCRYPT_ROUNDS = int(os.environ.get("BCRYPT_ROUNDS", "12"))
+PASSWORD_HASH_WORKERS = int(os.environ.get("PASSWORD_HASH_WORKERS", "4"))
+PASSWORD_HASH_MAX_PENDING = int(os.environ.get("PASSWORD_HASH_MAX_PENDING", "64"))
+
+# Pinning min and max to the configured cost flags any other cost for rehash on login
+pwd_context = CryptContext(
+    schemes=["bcrypt"],
+    deprecated="auto",
+    bcrypt__default_rounds=BCRYPT_ROUNDS,
+    bcrypt__min_rounds=BCRYPT_ROUNDS,
+    bcrypt__max_rounds=BCRYPT_ROUNDS,
+)
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="api/token")
 
+# Authenticated user cache
+AUTH_CACHE_SIZE = int(os.environ.get("AUTH_CACHE_SIZE", "10000"))
+AUTH_CACHE_TTL_SECONDS = float(os.environ.get("AUTH_CACHE_TTL_SECONDS", "60"))
+
+# Responses built from DB documents skip model validation unless this is set (e.g. in tests)
+STRICT_RESPONSE_VALIDATION = os.environ.get("STRICT_RESPONSE_VALIDATION", "false").lower() == "true"
+
+# Catalog cache
+CATALOG_CACHE_SIZE = int(os.environ.get("CATALOG_CACHE_SIZE", "5000"))
+CATALOG_CACHE_TTL_SECONDS = float(os.environ.get("CATALOG_CACHE_TTL_SECONDS", "60"))
+
+# Request profiling (off unless a sample rate or a signing secret is set)
+PROFILE_SAMPLE_RATE = float(os.environ.get("PROFILE_SAMPLE_RATE", "0"))
+PROFILE_SECRET = os.environ.get("PROFILE_SECRET")
+PROFILE_INTERVAL_MS = float(os.environ.get("PROFILE_INTERVAL_MS", "5"))
+PROFILE_MAX_CONCURRENT = int(os.environ.get("PROFILE_MAX_CONCURRENT", "2"))
+profile_store = ProfileStore(
+    Path(os.environ.get("PROFILE_DIR", ROOT_DIR / "profiles")),
+    max_profiles=int(os.environ.get("PROFILE_MAX_FILES", "200")),
+)
+
 # MongoDB connection
 mongo_url = os.environ['MONGO_URL']
-client = AsyncIOMotorClient(mongo_url)
-db = client[os.environ['DB_NAME']]
+db_name = os.environ['DB_NAME']
+MONGO_CLIENT_OPTIONS = {
+    "maxPoolSize": int(os.environ.get("MONGO_MAX_POOL_SIZE", "50")),
+    "minPoolSize": int(os.environ.get("MONGO_MIN_POOL_SIZE", "5")),
+    "maxIdleTimeMS": int(os.environ.get("MONGO_MAX_IDLE_TIME_MS", "60000")),
+    "waitQueueTimeoutMS": int(os.environ.get("MONGO_WAIT_QUEUE_TIMEOUT_MS", "5000")),
+    "serverSelectionTimeoutMS": int(os.environ.get("MONGO_SERVER_SELECTION_TIMEOUT_MS", "5000")),
+    "connectTimeoutMS": int(os.environ.get("MONGO_CONNECT_TIMEOUT_MS", "5000")),
+    "socketTimeoutMS": int(os.environ.get("MONGO_SOCKET_TIMEOUT_MS", "60000")),
+}
+# Catalog reads go to the primary unless MONGO_CATALOG_READ_PREFERENCE opts in
+# to secondaries, which spreads the load but can serve data that lags writes
+READ_PREFERENCES = {
+    "primary": ReadPreference.PRIMARY,
+    "primaryPreferred": ReadPreference.PRIMARY_PREFERRED,
+    "secondary": ReadPreference.SECONDARY,
+    "secondaryPreferred": ReadPreference.SECONDARY_PREFERRED,
+    "nearest": ReadPreference.NEAREST,
+}
+CATALOG_READ_PREFERENCE = os.environ.get("MONGO_CATALOG_READ_PREFERENCE", "primary")
 
-# Create the main app without a prefix
-app = FastAPI()
+pool_stats = PoolStatsListener()
+# Request and Mongo command metrics, served on /metrics
+metrics = Metrics()
+
+# Set by connect_mongo when the app starts
+client: Optional[AsyncIOMotorClient] = None
+db = None
+catalog_db = None
+
+def connect_mongo() -> None:
+    global client, db, catalog_db
+    client = AsyncIOMotorClient(
+        mongo_url, event_listeners=[pool_stats, metrics.command_listener()], **MONGO_CLIENT_OPTIONS
+    )
+    db = client[db_name]
+    catalog_db = client.get_database(db_name, read_preference=READ_PREFERENCES[CATALOG_READ_PREFERENCE])
+
+# Image blob storage
+blob_store = LocalBlobStore(Path(os.environ.get("BLOB_STORE_DIR", ROOT_DIR / "blobs")))
+IMAGE_CACHE_CONTROL = "public, max-age=31536000, immutable"
 
 # Create a router with the /api prefix
 api_router = APIRouter(prefix="/api")
 
+# Pagination
+MAX_PAGE_SIZE = 200
+
+# Search
+MAX_SEARCH_OFFSET = 1000
+
+# Bulk product import
+IMPORT_CHUNK_SIZE = 1000
+MAX_IMPORT_ERRORS = 1000
+
+# Stock adjustments
+MAX_STOCK_ADJUSTMENTS = 10000
+
+# Cart
+MAX_CART_BATCH_SIZE = 500
+# Carts idle this long are archived and deleted by the sweeper; the TTL index
+# on carts.updated_at (CART_TTL_SECONDS, see indexes.py) is the backstop
+CART_ABANDON_SECONDS = int(os.environ.get("CART_ABANDON_SECONDS", str(7 * 24 * 3600)))
+CART_SWEEP_BATCH_SIZE = int(os.environ.get("CART_SWEEP_BATCH_SIZE", "500"))
+CART_SWEEP_INTERVAL_SECONDS = float(os.environ.get("CART_SWEEP_INTERVAL_SECONDS", "3600"))
+
+# Order export
+EXPORT_BATCH_SIZE = 1000
+EXPORT_CSV_COLUMNS = [
+    "id", "created_at", "updated_at", "status", "payment_status", "user_id",
+    "customer_name", "customer_email", "customer_phone", "customer_address",
+    "total_amount", "item_count", "items", "mpesa_receipt_number", "cursor",
+]
+NEXT_CURSOR_HEADER = "X-Next-Cursor"
+
+# Order status push
+ORDER_EVENTS_QUEUE_SIZE = int(os.environ.get("ORDER_EVENTS_QUEUE_SIZE", "100"))
+SSE_KEEPALIVE_SECONDS = float(os.environ.get("SSE_KEEPALIVE_SECONDS", "15"))
+# EventSource puts its credentials in the URL, so it gets a ticket that can
+# only open the stream and expires soon after, never the session token
+STREAM_TICKET_PURPOSE = "order-events"
+STREAM_TICKET_SECONDS = int(os.environ.get("STREAM_TICKET_SECONDS", "60"))
+
 # Models
 class Product(BaseModel):
     id: str = Field(default_factory=lambda: str(uuid.uuid4()))
@@ -45,7 +182,9 @@ class Product(BaseModel):
     price: float
     category: str
     stock_quantity: int
-    image_base64: Optional[str] = None
+    sku: Optional[str] = None
+    image_hash: Optional[str] = None  # SHA-256 key in the blob store
+    image_url: Optional[str] = None  # external image, when not stored locally
     created_at: datetime = Field(default_factory=datetime.utcnow)
     updated_at: datetime = Field(default_factory=datetime.utcnow)
 
@@ -55,6 +194,7 @@ class ProductCreate(BaseModel):
     price: float
     category: str
     stock_quantity: int
+    sku: Optional[str] = None
     image_base64: Optional[str] = None
 
 class ProductUpdate(BaseModel):
@@ -63,6 +203,7 @@ class ProductUpdate(BaseModel):
     price: Optional[float] = None
     category: Optional[str] = None
     stock_quantity: Optional[int] = None
+    sku: Optional[str] = None
     image_base64: Optional[str] = None
 
 class CartItem(BaseModel):
@@ -70,7 +211,8 @@ class CartItem(BaseModel):
     quantity: int
     product_name: str
     product_price: float
-    product_image: Optional[str] = None
+    product_image_hash: Optional[str] = None
+    product_image: Optional[str] = None  # external image URL
 
 class Cart(BaseModel):
     id: str = Field(default_factory=lambda: str(uuid.uuid4()))
@@ -80,12 +222,31 @@ class Cart(BaseModel):
     created_at: datetime = Field(default_factory=datetime.utcnow)
     updated_at: datetime = Field(default_factory=datetime.utcnow)
 
+class CartOperation(BaseModel):
+    op: Literal["add", "set", "remove"]
+    product_id: str
+    quantity: int = 1
+
+class CartBatch(BaseModel):
+    operations: List[CartOperation]
+
+class StockAdjustment(BaseModel):
+    product_id: str
+    delta: Optional[int] = None  # relative change
+    quantity: Optional[int] = None  # absolute stock level
+
+class StockAdjustmentBatch(BaseModel):
+    adjustments: List[StockAdjustment]
+    source: str = "warehouse"
+    reference: Optional[str] = None
+
 class OrderItem(BaseModel):
     product_id: str
     product_name: str
     quantity: int
     price: float
     subtotal: float
+    category: Optional[str] = None
 
 class Order(BaseModel):
     id: str = Field(default_factory=lambda: str(uuid.uuid4()))
@@ -98,6 +259,8 @@ class Order(BaseModel):
     total_amount: float
     status: str = "pending"  # pending, confirmed, processing, shipped, delivered, cancelled
     payment_status: str = "pending"  # pending, paid, failed
+    mpesa_checkout_request_id: Optional[str] = None  # of the latest push
+    mpesa_receipt_number: Optional[str] = None
     created_at: datetime = Field(default_factory=datetime.utcnow)
     updated_at: datetime = Field(default_factory=datetime.utcnow)
 
@@ -118,64 +281,908 @@ class OrderCreate(BaseModel):
     customer_address: str
     cart_session_id: str
 
+# Password hashing
+class PasswordHasher:
+    """Runs bcrypt on a bounded thread pool so hashing never blocks the event loop.
+
+    At most ``max_pending`` operations may be queued or running; beyond that new
+    requests are rejected with 503 instead of piling up behind a login storm.
+    """
+
+    def __init__(self, context: CryptContext, workers: int, max_pending: int):
+        self.context = context
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="bcrypt")
+        self.workers = workers
+        self.max_pending = max_pending
+        self.pending = 0
+        self.stats = {"completed": 0, "rejected": 0, "rehashed": 0, "total_seconds": 0.0, "max_seconds": 0.0}
+
+    async def _run(self, fn, *args):
+        if self.pending >= self.max_pending:
+            self.stats["rejected"] += 1
+            raise HTTPException(
+                status_code=503,
+                detail="Authentication service busy, please retry",
+                headers={"Retry-After": "1"},
+            )
+        self.pending += 1
+        started = time.perf_counter()
+        try:
+            return await asyncio.get_running_loop().run_in_executor(self.executor, fn, *args)
+        finally:
+            self.pending -= 1
+            elapsed = time.perf_counter() - started
+            self.stats["completed"] += 1
+            self.stats["total_seconds"] += elapsed
+            self.stats["max_seconds"] = max(self.stats["max_seconds"], elapsed)
+
+    async def hash(self, password: str) -> str:
+        return await self._run(self.context.hash, password)
+
+    async def verify_and_update(self, password: str, hashed_password: str):
+        """Return (valid, new_hash); new_hash is set when the stored hash uses outdated settings."""
+        valid, new_hash = await self._run(self.context.verify_and_update, password, hashed_password)
+        if new_hash:
+            self.stats["rehashed"] += 1
+        return valid, new_hash
+
+    def metrics(self) -> dict:
+        completed = self.stats["completed"]
+        return {
+            "workers": self.workers,
+            "max_pending": self.max_pending,
+            "pending": self.pending,
+            **self.stats,
+            "avg_seconds": self.stats["total_seconds"] / completed if completed else 0.0,
+        }
+
+password_hasher = PasswordHasher(pwd_context, PASSWORD_HASH_WORKERS, PASSWORD_HASH_MAX_PENDING)
+
+# token -> subject email, so repeat requests skip JWT verification
+token_claims_cache = TTLCache(AUTH_CACHE_SIZE, AUTH_CACHE_TTL_SECONDS)
+# subject email -> User, so repeat requests skip the users lookup
+user_cache = TTLCache(AUTH_CACHE_SIZE, AUTH_CACHE_TTL_SECONDS)
+
+def invalidate_user(email: str) -> None:
+    """Drop the cached User for email; call after any write to that user's record."""
+    user_cache.pop(email)
+
+# Auth functions
+async def get_password_hash(password):
+    return await password_hasher.hash(password)
+
+async def get_user(email: str):
+    user = await db.users.find_one({"email": email})
+    if user:
+        return User(**user)
+
+def create_access_token(data: dict, expires_delta: Optional[timedelta] = None):
+    to_encode = data.copy()
+    if expires_delta:
+        expire = datetime.utcnow() + expires_delta
+    else:
+        expire = datetime.utcnow() + timedelta(minutes=15)
+    to_encode.update({"exp": expire})
+    encoded_jwt = jwt.encode(to_encode, SECRET_KEY, algorithm=ALGORITHM)
+    return encoded_jwt
+
+async def get_current_user(token: str = Depends(oauth2_scheme)):
+    credentials_exception = HTTPException(
+        status_code=401,
+        detail="Could not validate credentials",
+        headers={"WWW-Authenticate": "Bearer"},
+    )
+    email = token_claims_cache.get(token)
+    if email is None:
+        try:
+            payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
+            email: str = payload.get("sub")
+            # Single-purpose tokens such as stream tickets are not sessions
+            if email is None or "purpose" in payload:
+                raise credentials_exception
+        except JWTError:
+            raise credentials_exception
+        # Never serve a cached token past its own expiry
+        remaining = payload["exp"] - time.time() if "exp" in payload else None
+        token_claims_cache.set(token, email, ttl=remaining)
+    user = await get_cached_user(email)
+    if user is None:
+        raise credentials_exception
+    return user
+
+async def get_cached_user(email: str) -> Optional[User]:
+    user = user_cache.get(email)
+    if user is None:
+        user = await get_user(email=email)
+        if user is not None:
+            user_cache.set(email, user)
+    return user
+
+# Image helpers
+def image_fields(image: str) -> dict:
+    """Turn an uploaded image value into the image fields kept on documents.
+
+    URLs are kept as references; base64 payloads (optionally as data URIs)
+    are decoded into the blob store and only their hash is kept. Raises
+    ValueError for a payload that is not valid base64.
+    """
+    if image.startswith(("http://", "https://")):
+        return {"image_hash": None, "image_url": image}
+    if image.startswith("data:"):
+        image = image.split(",", 1)[-1]
+    try:
+        data = base64.b64decode(image, validate=True)
+    except (binascii.Error, ValueError):
+        raise ValueError("Invalid base64 image")
+    return {"image_hash": blob_store.put(data), "image_url": None}
+
+def store_image(image: str) -> dict:
+    """image_fields for request handlers, reporting a bad payload as a 400."""
+    try:
+        return image_fields(image)
+    except ValueError as exc:
+        raise HTTPException(status_code=400, detail=str(exc))
+
+def parse_range(range_header: str, size: int):
+    """Parse a single "bytes=start-end" range into inclusive offsets."""
+    unit, _, spec = range_header.partition("=")
+    if unit.strip() != "bytes" or "," in spec:
+        return None
+    start_str, _, end_str = spec.strip().partition("-")
+    try:
+        if start_str:
+            start = int(start_str)
+            end = int(end_str) if end_str else size - 1
+        else:
+            # Suffix range: the last N bytes
+            start = max(size - int(end_str), 0)
+            end = size - 1
+    except ValueError:
+        return None
+    end = min(end, size - 1)
+    if start > end:
+        raise HTTPException(
+            status_code=416,
+            detail="Requested range not satisfiable",
+            headers={"Content-Range": f"bytes */{size}"},
+        )
+    return start, end
+
+# Catalog cache
+# Values are rendered (body, etag) pairs so hits skip serialization entirely.
+# Entries are dropped precisely on writes made by this process; the TTL bounds
+# how stale another worker process's copy can get. Every invalidation bumps
+# catalog_generation, and a fill whose read was in flight across one is not
+# stored, since it may hold the data from before the write.
+product_cache = TTLCache(CATALOG_CACHE_SIZE, CATALOG_CACHE_TTL_SECONDS)  # product id -> (body, etag)
+listing_cache = TTLCache(CATALOG_CACHE_SIZE, CATALOG_CACHE_TTL_SECONDS)  # (category, limit, cursor, fields) -> (body, etag, next cursor, product ids)
+categories_cache = TTLCache(1, CATALOG_CACHE_TTL_SECONDS)
+catalog_generation = 0
+
+def fill_catalog_cache(cache: TTLCache, key, value, generation: int) -> None:
+    """Cache a value read while catalog_generation was generation, unless invalidated since."""
+    if generation == catalog_generation:
+        cache.set(key, value)
+
+def invalidate_catalog(product_ids=(), categories=()) -> None:
+    """Drop cached catalog data for changed products.
+
+    Pass the categories a product was added to or removed from; listings of
+    those categories (and unfiltered listings) may gain or lose entries.
+    Pages that contain any of the changed products are dropped as well.
+    """
+    global catalog_generation
+    catalog_generation += 1
+    product_ids, categories = set(product_ids), set(categories)
+    for product_id in product_ids:
+        product_cache.pop(product_id)
+    
+    def stale(key, page):
+        category = key[0]
+        if categories and (category is None or category in categories):
+            return True
+        _, _, _, page_ids = page
+        return not page_ids.isdisjoint(product_ids)
+    
+    listing_cache.pop_where(stale)
+    if categories:
+        categories_cache.clear()
+
+def clear_catalog_cache() -> None:
+    global catalog_generation
+    catalog_generation += 1
+    product_cache.clear()
+    listing_cache.clear()
+    categories_cache.clear()
+
+# Stock adjustments
+def stock_adjustment_update(adjustment: StockAdjustment, batch_id: str, now: datetime) -> UpdateOne:
+    """Apply one adjustment; deltas never take stock below zero.
+
+    The level before the batch and after each of its adjustments is kept on
+    the product as last_stock_adjustment, so the ledger records what was
+    actually applied, clamping included.
+    """
+    if adjustment.quantity is not None:
+        stock = {"$literal": adjustment.quantity}
+    else:
+        stock = {"$max": [0, {"$add": ["$stock_quantity", adjustment.delta]}]}
+    batch = {"$literal": batch_id}
+    return UpdateOne({"id": adjustment.product_id}, [
+        {"$set": {"last_stock_adjustment": {"$cond": [
+            {"$eq": ["$last_stock_adjustment.batch_id", batch]},
+            "$last_stock_adjustment",
+            {"batch_id": batch, "levels": ["$stock_quantity"]},
+        ]}}},
+        {"$set": {"stock_quantity": stock, "updated_at": now}},
+        {"$set": {"last_stock_adjustment": {
+            "batch_id": batch,
+            "levels": {"$concatArrays": ["$last_stock_adjustment.levels", ["$stock_quantity"]]},
+        }}},
+    ])
+
+async def record_stock_adjustments(by_product: dict, batch: StockAdjustmentBatch, batch_id: str,
+                                   now: datetime) -> int:
+    """Write a ledger row for each adjustment of this batch that was applied; returns how many."""
+    products = await db.products.find(
+        {"id": {"$in": list(by_product)}, "last_stock_adjustment.batch_id": batch_id},
+        {"_id": 0, "id": 1, "last_stock_adjustment.levels": 1}
+    ).to_list(None)
+    rows = []
+    for product in products:
+        levels = product["last_stock_adjustment"]["levels"]
+        for n, adjustment in enumerate(by_product[product["id"]][:len(levels) - 1]):
+            rows.append({
+                "id": str(uuid.uuid4()),
+                "batch_id": batch_id,
+                "product_id": adjustment.product_id,
+                "delta": adjustment.delta,
+                "quantity": adjustment.quantity,
+                "stock_before": levels[n],
+                "stock_after": levels[n + 1],
+                "source": batch.source,
+                "reference": batch.reference,
+                "created_at": now,
+            })
+    if rows:
+        await db.stock_ledger.insert_many(rows, ordered=True)
+    return len(rows)
+
+@api_router.post("/stock/adjustments")
+async def adjust_stock(batch: StockAdjustmentBatch):
+    """Apply many absolute or relative stock changes in one bulk write.
+
+    Every applied adjustment is then appended to the stock_ledger collection
+    under a shared batch id, with the stock level before and after it, so the
+    history can be audited or replayed. The ledger is written after the bulk
+    write so it never records a change that did not happen.
+    """
+    if not batch.adjustments:
+        raise HTTPException(status_code=400, detail="No stock adjustments given")
+    if len(batch.adjustments) > MAX_STOCK_ADJUSTMENTS:
+        raise HTTPException(status_code=400, detail=f"At most {MAX_STOCK_ADJUSTMENTS} adjustments per batch")
+    invalid = [a.product_id for a in batch.adjustments if (a.delta is None) == (a.quantity is None)]
+    if invalid:
+        raise HTTPException(status_code=400, detail=f"Give exactly one of delta or quantity for: {', '.join(invalid)}")
+    negative = [a.product_id for a in batch.adjustments if a.quantity is not None and a.quantity < 0]
+    if negative:
+        raise HTTPException(status_code=400, detail=f"Stock quantity cannot be negative for: {', '.join(negative)}")
+    
+    product_ids = {adjustment.product_id for adjustment in batch.adjustments}
+    known = await db.products.distinct("id", {"id": {"$in": list(product_ids)}})
+    missing = product_ids - set(known)
+    adjustments = [a for a in batch.adjustments if a.product_id not in missing]
+    # Each product's adjustments keep the order they were given in
+    by_product = {}
+    for adjustment in adjustments:
+        by_product.setdefault(adjustment.product_id, []).append(adjustment)
+    
+    batch_id = str(uuid.uuid4())
+    now = datetime.utcnow()
+    applied = 0
+    if adjustments:
+        # Ordered so each product's changes apply in sequence; the levels each
+        # product carries show how far a failed batch got
+        try:
+            await db.products.bulk_write(
+                [stock_adjustment_update(a, batch_id, now) for a in adjustments], ordered=True
+            )
+        finally:
+            invalidate_catalog(by_product)
+            applied = await record_stock_adjustments(by_product, batch, batch_id, now)
+    
+    return {
+        "batch_id": batch_id,
+        "applied": applied,
+        "missing_products": sorted(missing),
+    }
+
 # Product endpoints
 @api_router.post("/products", response_model=Product)
 async def create_product(product: ProductCreate):
     product_dict = product.dict()
+    image = product_dict.pop("image_base64")
+    if image:
+        product_dict.update(store_image(image))
     product_obj = Product(**product_dict)
     await db.products.insert_one(product_obj.dict())
+    invalidate_catalog(categories=[product_obj.category])
     return product_obj
 
+# Bulk product import
+def iter_import_rows(upload: UploadFile, format: str):
+    """Yield (row_number, raw_row) pairs from an uploaded NDJSON or CSV file, one line at a time."""
+    text = io.TextIOWrapper(upload.file, encoding="utf-8-sig", newline="")
+    if format == "csv":
+        # Row 1 is the header
+        for row_number, row in enumerate(csv.DictReader(text), start=2):
+            yield row_number, row
+        return
+    for row_number, line in enumerate(text, start=1):
+        if not line.strip():
+            continue
+        try:
+            yield row_number, json.loads(line)
+        except ValueError as exc:
+            yield row_number, exc
+
+def import_operation(row) -> tuple:
+    """Validate one import row into (sku, upsert); raises ValueError or ValidationError."""
+    if isinstance(row, Exception):
+        raise ValueError(f"Invalid JSON: {row}")
+    if not isinstance(row, dict):
+        raise ValueError("Row must be an object")
+    # Blank CSV cells mean "not given"
+    product = ProductCreate(**{k: v for k, v in row.items() if k and v not in ("", None)})
+    if not product.sku:
+        raise ValueError("sku is required")
+    fields = product.dict(exclude={"image_base64"})
+    if product.image_base64:
+        fields.update(image_fields(product.image_base64))
+    now = datetime.utcnow()
+    fields["updated_at"] = now
+    return product.sku, UpdateOne(
+        {"sku": product.sku},
+        {"$set": fields, "$setOnInsert": {"id": str(uuid.uuid4()), "created_at": now}},
+        upsert=True
+    )
+
+def read_import_chunk(rows, errors: list) -> dict:
+    """Validate rows until IMPORT_CHUNK_SIZE SKUs are ready; empty once rows run out.
+
+    Blocking: it reads the upload and decodes and stores images, so the
+    handler runs it in a worker thread. Invalid rows are appended to errors.
+    """
+    chunk = {}
+    for row_number, row in rows:
+        try:
+            sku, operation = import_operation(row)
+        except ValidationError as exc:
+            error = "; ".join(f"{'.'.join(map(str, e['loc']))}: {e['msg']}" for e in exc.errors())
+            errors.append({"row": row_number, "error": error})
+            continue
+        except ValueError as exc:
+            errors.append({"row": row_number, "error": str(exc)})
+            continue
+        # A SKU repeated within a chunk keeps its last row
+        chunk[sku] = (row_number, operation)
+        if len(chunk) >= IMPORT_CHUNK_SIZE:
+            break
+    return chunk
+
+async def write_import_chunk(chunk: dict, summary: dict) -> None:
+    """Upsert one chunk of {sku: (row_number, operation)} and fold the outcome into summary."""
+    row_numbers = [row_number for row_number, _ in chunk.values()]
+    try:
+        result = await db.products.bulk_write([operation for _, operation in chunk.values()], ordered=False)
+        details = result.bulk_api_result
+    except BulkWriteError as exc:
+        details = exc.details
+        for error in details["writeErrors"]:
+            summary["errors"].append({"row": row_numbers[error["index"]], "error": error["errmsg"]})
+    summary["inserted"] += details["nUpserted"]
+    summary["updated"] += details["nMatched"]
+
+@api_router.post("/products/bulk")
+async def bulk_import_products(file: UploadFile = File(...), format: Optional[str] = Form(None)):
+    """Upsert products keyed by SKU from an NDJSON or CSV upload.
+
+    Rows are validated off the event loop and written in chunks of
+    IMPORT_CHUNK_SIZE; invalid rows are reported individually and do not stop
+    the import.
+    """
+    format = format or Path(file.filename or "").suffix.lstrip(".").lower() or "ndjson"
+    if format in ("jsonl", "json"):
+        format = "ndjson"
+    if format not in ("ndjson", "csv"):
+        raise HTTPException(status_code=400, detail="Unsupported format, use ndjson or csv")
+    
+    summary = {"inserted": 0, "updated": 0, "errors": []}
+    rows = iter_import_rows(file, format)
+    try:
+        while True:
+            # Chunks are read one at a time, so only one thread touches the upload
+            chunk = await asyncio.to_thread(read_import_chunk, rows, summary["errors"])
+            if not chunk:
+                break
+            await write_import_chunk(chunk, summary)
+    finally:
+        # Earlier chunks are written even if a later one fails
+        clear_catalog_cache()
+    error_count = len(summary["errors"])
+    summary["errors"] = summary["errors"][:MAX_IMPORT_ERRORS]
+    summary["error_count"] = error_count
+    return summary
+
+# Response serialization
+def response_projection(model) -> dict:
+    """Mongo projection fetching exactly the fields of a response model."""
+    projection = {field: 1 for field in model.model_fields}
+    projection["_id"] = 0
+    return projection
+
+@lru_cache(maxsize=None)
+def field_defaults(model) -> dict:
+    return {
+        name: field.default
+        for name, field in model.model_fields.items()
+        if not field.is_required() and field.default_factory is None
+    }
+
+def trusted_docs(docs: List[dict], model) -> List[dict]:
+    """Shape documents this app wrote through model like dumped instances.
+
+    Documents are only topped up with field defaults, not validated; with
+    STRICT_RESPONSE_VALIDATION set each one goes through the model instead.
+    """
+    if STRICT_RESPONSE_VALIDATION:
+        return [{**doc, **model(**doc).model_dump()} for doc in docs]
+    defaults = field_defaults(model)
+    return [{**defaults, **doc} for doc in docs]
+
+def list_response(docs: List[dict], model):
+    items = trusted_docs(docs, model)
+    if STRICT_RESPONSE_VALIDATION:
+        # Let FastAPI validate against the route's response_model as well
+        return items
+    return ORJSONResponse(items)
+
+# Conditional GET helpers
+def render_json(content) -> tuple:
+    """Serialize content once; returns (body, strong ETag derived from the body)."""
+    body = orjson.dumps(content, default=jsonable_encoder)
+    return body, f'"{hashlib.sha256(body).hexdigest()[:32]}"'
+
+def etag_matches(request: Request, etag: str) -> bool:
+    if_none_match = request.headers.get("if-none-match")
+    if not if_none_match:
+        return False
+    # If-None-Match uses weak comparison, so a W/ prefix is ignored
+    candidates = {tag.strip().removeprefix("W/") for tag in if_none_match.split(",")}
+    return "*" in candidates or etag in candidates
+
+def conditional_response(request: Request, etag: str, render, headers: Optional[dict] = None) -> Response:
+    """Answer 304 when the client already has etag, otherwise the body from render().
+
+    render is only called on a miss, so a 304 costs no serialization.
+    """
+    headers = {"ETag": etag, "Cache-Control": "no-cache", **(headers or {})}
+    if etag_matches(request, etag):
+        return Response(status_code=304, headers=headers)
+    return Response(content=render(), media_type="application/json", headers=headers)
+
+# Pagination helpers
+def encode_cursor(doc: dict) -> str:
+    raw = json.dumps({"created_at": doc["created_at"].isoformat(), "id": doc["id"]})
+    return base64.urlsafe_b64encode(raw.encode()).decode()
+
+def decode_cursor(cursor: str) -> dict:
+    try:
+        raw = json.loads(base64.urlsafe_b64decode(cursor.encode()).decode())
+        return {"created_at": datetime.fromisoformat(raw["created_at"]), "id": str(raw["id"])}
+    except (ValueError, KeyError, TypeError):
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+
+def keyset_filter(filter_dict: dict, cursor: Optional[str]) -> dict:
+    """Restrict filter_dict to documents sorted after the (created_at, id) cursor."""
+    if not cursor:
+        return filter_dict
+    position = decode_cursor(cursor)
+    after = {"$or": [
+        {"created_at": {"$gt": position["created_at"]}},
+        {"created_at": position["created_at"], "id": {"$gt": position["id"]}},
+    ]}
+    return {"$and": [filter_dict, after]} if filter_dict else after
+
+def parse_projection(fields: Optional[str], model) -> Optional[dict]:
+    if not fields:
+        return None
+    requested = {f.strip() for f in fields.split(",") if f.strip()}
+    unknown = requested - set(model.model_fields)
+    if unknown:
+        raise HTTPException(status_code=400, detail=f"Unknown fields: {', '.join(sorted(unknown))}")
+    # The cursor is built from the sort key, so it is always fetched
+    projection = {f: 1 for f in requested | {"id", "created_at"}}
+    projection["_id"] = 0
+    return projection
+
 @api_router.get("/products", response_model=List[Product])
-async def get_products(category: Optional[str] = None, limit: int = 50):
+async def get_products(
+    request: Request,
+    category: Optional[str] = None,
+    limit: int = 50,
+    cursor: Optional[str] = None,
+    fields: Optional[str] = None,
+):
+    limit = max(1, min(limit, MAX_PAGE_SIZE))
+    cache_key = (category or None, limit, cursor, fields)
+    page = listing_cache.get(cache_key)
+    if page is None:
+        generation = catalog_generation
+        page = await fetch_product_page(category, limit, cursor, fields)
+        fill_catalog_cache(listing_cache, cache_key, page, generation)
+    
+    body, etag, next_cursor, _ = page
+    headers = {NEXT_CURSOR_HEADER: next_cursor} if next_cursor else None
+    return conditional_response(request, etag, lambda: body, headers)
+
+async def fetch_product_page(category: Optional[str], limit: int, cursor: Optional[str], fields: Optional[str]):
+    """Load and render one listing page; returns (body, etag, next_cursor, product_ids)."""
     filter_dict = {}
     if category:
         filter_dict["category"] = category
+    projection = parse_projection(fields, Product)
+    
+    # Fetch one extra document to know whether another page exists
+    products = await catalog_db.products.find(keyset_filter(filter_dict, cursor), projection or response_projection(Product)) \
+        .sort([("created_at", 1), ("id", 1)]).limit(limit + 1).to_list(limit + 1)
+    next_cursor = None
+    if len(products) > limit:
+        products = products[:limit]
+        next_cursor = encode_cursor(products[-1])
+    
+    product_ids = frozenset(product["id"] for product in products)
+    if not projection:
+        products = trusted_docs(products, Product)
+    return (*render_json(products), next_cursor, product_ids)
+
+@api_router.get("/products/search")
+async def search_products(
+    q: str,
+    category: Optional[str] = None,
+    min_price: Optional[float] = None,
+    max_price: Optional[float] = None,
+    in_stock: bool = False,
+    limit: int = 20,
+    offset: int = 0,
+):
+    if not q.strip():
+        raise HTTPException(status_code=400, detail="Search query is required")
+    if not 0 <= offset <= MAX_SEARCH_OFFSET:
+        raise HTTPException(status_code=400, detail=f"offset must be between 0 and {MAX_SEARCH_OFFSET}")
+    limit = max(1, min(limit, MAX_PAGE_SIZE))
+    
+    match = {"$text": {"$search": q}}
+    price = {}
+    if min_price is not None:
+        price["$gte"] = min_price
+    if max_price is not None:
+        price["$lte"] = max_price
+    if price:
+        match["price"] = price
+    if in_stock:
+        match["stock_quantity"] = {"$gt": 0}
+    category_match = {"category": category} if category else {}
     
-    products = await db.products.find(filter_dict).limit(limit).to_list(limit)
-    return [Product(**product) for product in products]
+    # Category facets ignore the category filter so shoppers can switch between them
+    pipeline = [
+        {"$match": match},
+        {"$addFields": {"score": {"$meta": "textScore"}}},
+        {"$facet": {
+            "products": [
+                {"$match": category_match},
+                {"$sort": {"score": -1, "id": 1}},
+                {"$skip": offset},
+                {"$limit": limit},
+                {"$project": {**response_projection(Product), "score": 1}},
+            ],
+            "total": [{"$match": category_match}, {"$count": "count"}],
+            "categories": [
+                {"$group": {"_id": "$category", "count": {"$sum": 1}}},
+                {"$sort": {"count": -1, "_id": 1}},
+            ],
+        }},
+    ]
+    result = (await catalog_db.products.aggregate(pipeline).to_list(1))[0]
+    total = result["total"][0]["count"] if result["total"] else 0
+    next_offset = offset + limit
+    return {
+        "products": trusted_docs(result["products"], Product),
+        "total": total,
+        "facets": {"categories": [{"category": f["_id"], "count": f["count"]} for f in result["categories"]]},
+        "next_offset": next_offset if next_offset < total and next_offset <= MAX_SEARCH_OFFSET else None,
+    }
 
 @api_router.get("/products/{product_id}", response_model=Product)
-async def get_product(product_id: str):
-    product = await db.products.find_one({"id": product_id})
-    if not product:
-        raise HTTPException(status_code=404, detail="Product not found")
-    return Product(**product)
+async def get_product(product_id: str, request: Request):
+    rendered = product_cache.get(product_id)
+    if rendered is None:
+        generation = catalog_generation
+        product = await catalog_db.products.find_one({"id": product_id}, response_projection(Product))
+        if not product:
+            raise HTTPException(status_code=404, detail="Product not found")
+        rendered = render_json(trusted_docs([product], Product)[0])
+        fill_catalog_cache(product_cache, product_id, rendered, generation)
+    body, etag = rendered
+    return conditional_response(request, etag, lambda: body)
 
 @api_router.put("/products/{product_id}", response_model=Product)
 async def update_product(product_id: str, product_update: ProductUpdate):
-    # Check if product exists
-    existing_product = await db.products.find_one({"id": product_id})
-    if not existing_product:
-        raise HTTPException(status_code=404, detail="Product not found")
-    
     # Update fields
     update_dict = {k: v for k, v in product_update.dict().items() if v is not None}
+    image = update_dict.pop("image_base64", None)
+    if image:
+        update_dict.update(store_image(image))
     update_dict["updated_at"] = datetime.utcnow()
     
-    await db.products.update_one({"id": product_id}, {"$set": update_dict})
+    # The previous version tells us which category listings to invalidate
+    existing_product = await db.products.find_one_and_update(
+        {"id": product_id},
+        {"$set": update_dict},
+        projection=response_projection(Product),
+        return_document=ReturnDocument.BEFORE
+    )
+    if not existing_product:
+        raise HTTPException(status_code=404, detail="Product not found")
+    invalidate_catalog([product_id], {existing_product["category"], update_dict.get("category")} - {None})
     
-    # Return updated product
-    updated_product = await db.products.find_one({"id": product_id})
-    return Product(**updated_product)
+    return Product(**{**existing_product, **update_dict})
 
 @api_router.delete("/products/{product_id}")
 async def delete_product(product_id: str):
-    result = await db.products.delete_one({"id": product_id})
-    if result.deleted_count == 0:
+    deleted = await db.products.find_one_and_delete({"id": product_id}, {"_id": 0, "category": 1})
+    if not deleted:
         raise HTTPException(status_code=404, detail="Product not found")
+    invalidate_catalog([product_id], [deleted["category"]])
     return {"message": "Product deleted successfully"}
 
+@api_router.get("/images/{image_hash}")
+async def get_image(image_hash: str, request: Request):
+    try:
+        size, content_type = blob_store.stat(image_hash)
+    except KeyError:
+        raise HTTPException(status_code=404, detail="Image not found")
+    
+    # Blobs are content-addressed, so the hash is a strong validator forever
+    etag = f'"{image_hash}"'
+    headers = {"ETag": etag, "Cache-Control": IMAGE_CACHE_CONTROL, "Accept-Ranges": "bytes"}
+    if etag_matches(request, etag):
+        return Response(status_code=304, headers=headers)
+    
+    byte_range = None
+    range_header = request.headers.get("range")
+    if range_header and request.headers.get("if-range", etag) == etag:
+        byte_range = parse_range(range_header, size)
+    if byte_range is None:
+        headers["Content-Length"] = str(size)
+        return StreamingResponse(blob_store.iter_range(image_hash), media_type=content_type, headers=headers)
+    
+    start, end = byte_range
+    headers["Content-Range"] = f"bytes {start}-{end}/{size}"
+    headers["Content-Length"] = str(end - start + 1)
+    return StreamingResponse(
+        blob_store.iter_range(image_hash, start, end),
+        status_code=206,
+        media_type=content_type,
+        headers=headers,
+    )
+
+def chunks(items: list, size: int):
+    for start in range(0, len(items), size):
+        yield items[start:start + size]
+
+@api_router.post("/images/migrate")
+async def migrate_inline_images():
+    """Move images still stored inline on product and cart documents into the blob store.
+
+    A product whose inline image cannot be decoded is reported and left as it
+    is, so one bad value does not block the rest. Carts are rewritten in a
+    single pass before the products, so a migration cut short is redone in
+    full by the next call.
+    """
+    fields_by_product, errors = {}, []
+    async for product in db.products.find(
+        {"image_base64": {"$ne": None, "$exists": True}},
+        {"_id": 0, "id": 1, "image_base64": 1}
+    ):
+        try:
+            # Decoding and the blob write are blocking work, kept off the event loop
+            fields_by_product[product["id"]] = await asyncio.to_thread(image_fields, product["image_base64"])
+        except ValueError as exc:
+            errors.append({"product_id": product["id"], "error": str(exc)})
+    
+    cart_updates = []
+    async for cart in db.carts.find({}, {"_id": 0, "session_id": 1, "items.product_id": 1}):
+        product_ids = {item["product_id"] for item in cart.get("items", [])} & fields_by_product.keys()
+        if not product_ids:
+            continue
+        fields, array_filters = {}, []
+        for n, product_id in enumerate(sorted(product_ids)):
+            fields[f"items.$[p{n}].product_image_hash"] = fields_by_product[product_id]["image_hash"]
+            fields[f"items.$[p{n}].product_image"] = fields_by_product[product_id]["image_url"]
+            array_filters.append({f"p{n}.product_id": product_id})
+        cart_updates.append(UpdateOne({"session_id": cart["session_id"]}, {"$set": fields}, array_filters=array_filters))
+    for chunk in chunks(cart_updates, IMPORT_CHUNK_SIZE):
+        await db.carts.bulk_write(chunk, ordered=False)
+    
+    product_updates = [
+        UpdateOne({"id": product_id}, {"$set": fields, "$unset": {"image_base64": ""}})
+        for product_id, fields in fields_by_product.items()
+    ]
+    try:
+        for chunk in chunks(product_updates, IMPORT_CHUNK_SIZE):
+            await db.products.bulk_write(chunk, ordered=False)
+    finally:
+        clear_catalog_cache()
+    for error in errors:
+        logger.warning("Could not migrate the image of product %s: %s", error["product_id"], error["error"])
+    return {
+        "message": f"Migrated {len(fields_by_product)} product images",
+        "errors": errors[:MAX_IMPORT_ERRORS],
+        "error_count": len(errors),
+    }
+
 @api_router.get("/categories")
-async def get_categories():
-    categories = await db.products.distinct("category")
-    return {"categories": categories}
+async def get_categories(request: Request):
+    rendered = categories_cache.get("categories")
+    if rendered is None:
+        generation = catalog_generation
+        categories = await catalog_db.products.distinct("category")
+        rendered = render_json({"categories": categories})
+        fill_catalog_cache(categories_cache, "categories", rendered, generation)
+    body, etag = rendered
+    return conditional_response(request, etag, lambda: body)
+
+# Cart update pipelines
+# Each cart mutation is a single aggregation-pipeline update, so it applies
+# atomically on the server and is computed against the stored document rather
+# than a copy read earlier. Expressions in one $set stage all see the document
+# as it was before the update, which lets the total be adjusted by the delta of
+# just the touched line. Client-supplied values are wrapped in $literal so a
+# product id such as "$items" is compared as a string, not read as a field path.
+def cart_line(product_id: str, field: str) -> dict:
+    """Expression for ``field`` of the cart line holding product_id (null if absent)."""
+    return {"$arrayElemAt": [
+        {"$map": {
+            "input": {"$filter": {
+                "input": {"$ifNull": ["$items", []]},
+                "cond": {"$eq": ["$$this.product_id", {"$literal": product_id}]},
+            }},
+            "in": f"$$this.{field}",
+        }},
+        0,
+    ]}
+
+def cart_total(delta) -> dict:
+    return {"$round": [{"$add": [{"$ifNull": ["$total_amount", 0]}, {"$ifNull": [delta, 0]}]}, 2]}
+
+def reopen_cart_pipeline() -> list:
+    """Start a checked-out cart over, so later changes are not cleared with the order."""
+    checked_out = {"$ifNull": ["$checked_out_order_id", False]}
+    return [{"$set": {
+        "items": {"$cond": [checked_out, [], "$items"]},
+        "total_amount": {"$cond": [checked_out, 0, "$total_amount"]},
+        "checked_out_order_id": "$$REMOVE",
+    }}]
+
+def add_to_cart_pipeline(item: dict, now: datetime) -> list:
+    product_id = item["product_id"]
+    quantity = {"$literal": item["quantity"]}
+    in_cart = {"$in": [{"$literal": product_id}, {"$ifNull": ["$items.product_id", []]}]}
+    # An existing line keeps the price it was added at
+    line_price = {"$ifNull": [cart_line(product_id, "product_price"), {"$literal": item["product_price"]}]}
+    return reopen_cart_pipeline() + [{"$set": {
+        "id": {"$ifNull": ["$id", str(uuid.uuid4())]},
+        "created_at": {"$ifNull": ["$created_at", now]},
+        "items": {"$cond": [
+            in_cart,
+            {"$map": {"input": "$items", "in": {"$cond": [
+                {"$eq": ["$$this.product_id", {"$literal": product_id}]},
+                {"$mergeObjects": ["$$this", {"quantity": {"$add": ["$$this.quantity", quantity]}}]},
+                "$$this",
+            ]}}},
+            {"$concatArrays": [{"$ifNull": ["$items", []]}, [{"$literal": item}]]},
+        ]},
+        "total_amount": cart_total({"$multiply": [quantity, line_price]}),
+        "updated_at": now,
+    }}]
+
+def set_cart_quantity_pipeline(product_id: str, quantity: int, now: datetime) -> list:
+    old_quantity = cart_line(product_id, "quantity")
+    quantity = {"$literal": quantity}
+    return reopen_cart_pipeline() + [{"$set": {
+        "items": {"$map": {"input": "$items", "in": {"$cond": [
+            {"$eq": ["$$this.product_id", {"$literal": product_id}]},
+            {"$mergeObjects": ["$$this", {"quantity": quantity}]},
+            "$$this",
+        ]}}},
+        "total_amount": cart_total(
+            {"$multiply": [{"$subtract": [quantity, old_quantity]}, cart_line(product_id, "product_price")]}
+        ),
+        "updated_at": now,
+    }}]
+
+def remove_from_cart_pipeline(product_id: str, now: datetime) -> list:
+    return reopen_cart_pipeline() + [{"$set": {
+        "items": {"$filter": {"input": "$items", "cond": {"$ne": ["$$this.product_id", {"$literal": product_id}]}}},
+        "total_amount": cart_total(
+            {"$multiply": [-1, cart_line(product_id, "quantity"), cart_line(product_id, "product_price")]}
+        ),
+        "updated_at": now,
+    }}]
+
+def new_cart_pipeline(now: datetime) -> list:
+    """Fill in the fields of a cart being created by an upsert; a no-op otherwise."""
+    return reopen_cart_pipeline() + [{"$set": {
+        "id": {"$ifNull": ["$id", str(uuid.uuid4())]},
+        "items": {"$ifNull": ["$items", []]},
+        "total_amount": {"$ifNull": ["$total_amount", 0]},
+        "created_at": {"$ifNull": ["$created_at", now]},
+        "updated_at": now,
+    }}]
+
+def cart_batch_pipeline(lines: list, now: datetime) -> list:
+    """Apply the net per-product changes of a batch in a fixed number of stages.
+
+    Each line carries the product_id, whether its quantity is absolute or is
+    added to the current line, and the CartItem to append when the cart has no
+    line for the product yet. Lines whose quantity ends at zero are dropped and
+    the total is recomputed from the resulting items.
+    """
+    changes = {"$literal": lines}
+    change = {"$arrayElemAt": [
+        {"$filter": {"input": changes, "as": "change", "cond": {"$eq": ["$$change.product_id", "$$line.product_id"]}}},
+        0,
+    ]}
+    updated_lines = {"$map": {"input": "$items", "as": "line", "in": {"$let": {
+        "vars": {"change": {"$ifNull": [change, None]}},
+        "in": {"$cond": [
+            {"$eq": ["$$change", None]},
+            "$$line",
+            {"$mergeObjects": ["$$line", {"quantity": {"$cond": [
+                "$$change.absolute",
+                "$$change.quantity",
+                {"$add": ["$$line.quantity", "$$change.quantity"]},
+            ]}}]},
+        ]},
+    }}}}
+    new_lines = {"$map": {
+        "input": {"$filter": {"input": changes, "as": "change", "cond": {"$and": [
+            {"$gt": ["$$change.quantity", 0]},
+            {"$not": [{"$in": ["$$change.product_id", "$items.product_id"]}]},
+        ]}}},
+        "as": "change",
+        "in": "$$change.item",
+    }}
+    return new_cart_pipeline(now) + [
+        {"$set": {"items": {"$concatArrays": [
+            {"$filter": {"input": updated_lines, "as": "line", "cond": {"$gt": ["$$line.quantity", 0]}}},
+            new_lines,
+        ]}}},
+        {"$set": {"total_amount": {"$round": [
+            {"$sum": {"$map": {"input": "$items", "in": {"$multiply": ["$$this.quantity", "$$this.product_price"]}}}},
+            2,
+        ]}}},
+    ]
 
 # Cart endpoints
 @api_router.post("/cart/add")
 async def add_to_cart(session_id: str, product_id: str, quantity: int = 1):
     # Get product details
-    product = await db.products.find_one({"id": product_id})
+    product = await db.products.find_one(
+        {"id": product_id},
+        {"_id": 0, "name": 1, "price": 1, "stock_quantity": 1, "image_hash": 1, "image_url": 1}
+    )
     if not product:
         raise HTTPException(status_code=404, detail="Product not found")
     
@@ -183,65 +1190,109 @@ async def add_to_cart(session_id: str, product_id: str, quantity: int = 1):
     if product["stock_quantity"] < quantity:
         raise HTTPException(status_code=400, detail="Insufficient stock")
     
-    # Find or create cart
-    cart = await db.carts.find_one({"session_id": session_id}, {"_id": 0})
-    if not cart:
-        cart = Cart(session_id=session_id, items=[])
-        cart = cart.dict()
-    
-    # Check if product already in cart
-    existing_item_index = None
-    for i, item in enumerate(cart["items"]):
-        if item["product_id"] == product_id:
-            existing_item_index = i
-            break
+    cart_item = CartItem(
+        product_id=product_id,
+        quantity=quantity,
+        product_name=product["name"],
+        product_price=product["price"],
+        product_image_hash=product.get("image_hash"),
+        product_image=product.get("image_url")
+    )
     
-    if existing_item_index is not None:
-        # Update quantity
-        cart["items"][existing_item_index]["quantity"] += quantity
-    else:
-        # Add new item
+    # Creates the cart, bumps an existing line or appends a new one in one update
+    cart = await db.carts.find_one_and_update(
+        {"session_id": session_id},
+        add_to_cart_pipeline(cart_item.dict(), datetime.utcnow()),
+        projection={"_id": 0},
+        upsert=True,
+        return_document=ReturnDocument.AFTER
+    )
+    
+    return {"message": "Item added to cart", "cart": cart}
+
+@api_router.post("/cart/{session_id}/batch")
+async def apply_cart_batch(session_id: str, batch: CartBatch):
+    if not batch.operations:
+        raise HTTPException(status_code=400, detail="No cart operations given")
+    invalid = [
+        operation.product_id for operation in batch.operations
+        if (operation.op == "add" and operation.quantity <= 0) or (operation.op == "set" and operation.quantity < 0)
+    ]
+    if invalid:
+        raise HTTPException(
+            status_code=400,
+            detail=f"Adds need a positive quantity and sets a non-negative one for: {', '.join(invalid)}"
+        )
+    
+    # Net effect of the batch on each product: an absolute quantity once the
+    # product is set or removed, otherwise an amount added to the current line
+    changes = {}
+    for operation in batch.operations:
+        if operation.op == "remove":
+            changes[operation.product_id] = (True, 0)
+        elif operation.op == "set":
+            changes[operation.product_id] = (True, operation.quantity)
+        else:
+            absolute, quantity = changes.get(operation.product_id, (False, 0))
+            changes[operation.product_id] = (absolute, quantity + operation.quantity)
+    if len(changes) > MAX_CART_BATCH_SIZE:
+        raise HTTPException(status_code=400, detail=f"At most {MAX_CART_BATCH_SIZE} products per batch")
+    
+    # Stock is checked against the quantity each product needs, the same way single adds are
+    products = await db.products.find(
+        {"id": {"$in": list(changes)}},
+        {"_id": 0, "id": 1, "name": 1, "price": 1, "stock_quantity": 1, "image_hash": 1, "image_url": 1}
+    ).to_list(len(changes))
+    products = {product["id"]: product for product in products}
+    missing = [product_id for product_id in changes if product_id not in products]
+    if missing:
+        raise HTTPException(status_code=404, detail=f"Products not found: {', '.join(missing)}")
+    short = [
+        products[product_id]["name"] for product_id, (_, quantity) in changes.items()
+        if products[product_id]["stock_quantity"] < quantity
+    ]
+    if short:
+        raise HTTPException(status_code=400, detail=f"Insufficient stock for {', '.join(short)}")
+    
+    lines = []
+    for product_id, (absolute, quantity) in changes.items():
+        product = products[product_id]
         cart_item = CartItem(
             product_id=product_id,
             quantity=quantity,
             product_name=product["name"],
             product_price=product["price"],
-            product_image=product.get("image_base64")
+            product_image_hash=product.get("image_hash"),
+            product_image=product.get("image_url")
         )
-        cart["items"].append(cart_item.dict())
-    
-    # Calculate total
-    total = sum(item["quantity"] * item["product_price"] for item in cart["items"])
-    cart["total_amount"] = total
-    cart["updated_at"] = datetime.utcnow()
-    
-    # Save cart
-    await db.carts.replace_one({"session_id": session_id}, cart, upsert=True)
+        lines.append({"product_id": product_id, "absolute": absolute, "quantity": quantity, "item": cart_item.dict()})
     
-    return {"message": "Item added to cart", "cart": cart}
+    cart = await db.carts.find_one_and_update(
+        {"session_id": session_id},
+        cart_batch_pipeline(lines, datetime.utcnow()),
+        projection={"_id": 0},
+        upsert=True,
+        return_document=ReturnDocument.AFTER
+    )
+    return {"message": "Cart updated", "cart": cart}
 
 @api_router.get("/cart/{session_id}")
 async def get_cart(session_id: str):
     cart = await db.carts.find_one({"session_id": session_id}, {"_id": 0})
-    if not cart:
+    if not cart or cart.get("checked_out_order_id"):
         return {"items": [], "total_amount": 0}
     return cart
 
 @api_router.post("/cart/remove")
 async def remove_from_cart(session_id: str, product_id: str):
-    cart = await db.carts.find_one({"session_id": session_id}, {"_id": 0})
+    cart = await db.carts.find_one_and_update(
+        {"session_id": session_id},
+        remove_from_cart_pipeline(product_id, datetime.utcnow()),
+        projection={"_id": 0},
+        return_document=ReturnDocument.AFTER
+    )
     if not cart:
         raise HTTPException(status_code=404, detail="Cart not found")
-    
-    # Remove item
-    cart["items"] = [item for item in cart["items"] if item["product_id"] != product_id]
-    
-    # Recalculate total
-    total = sum(item["quantity"] * item["product_price"] for item in cart["items"])
-    cart["total_amount"] = total
-    cart["updated_at"] = datetime.utcnow()
-    
-    await db.carts.replace_one({"session_id": session_id}, cart)
     return {"message": "Item removed from cart", "cart": cart}
 
 @api_router.post("/cart/update")
@@ -249,47 +1300,137 @@ async def update_cart_item(session_id: str, product_id: str, quantity: int):
     if quantity <= 0:
         return await remove_from_cart(session_id, product_id)
     
-    cart = await db.carts.find_one({"session_id": session_id}, {"_id": 0})
-    if not cart:
-        raise HTTPException(status_code=404, detail="Cart not found")
-    
     # Check stock
-    product = await db.products.find_one({"id": product_id})
+    product = await db.products.find_one({"id": product_id}, {"_id": 0, "stock_quantity": 1})
     if product and product["stock_quantity"] < quantity:
         raise HTTPException(status_code=400, detail="Insufficient stock")
     
-    # Update quantity
-    for item in cart["items"]:
-        if item["product_id"] == product_id:
-            item["quantity"] = quantity
-            break
-    
-    # Recalculate total
-    total = sum(item["quantity"] * item["product_price"] for item in cart["items"])
-    cart["total_amount"] = total
-    cart["updated_at"] = datetime.utcnow()
-    
-    await db.carts.replace_one({"session_id": session_id}, cart)
+    cart = await db.carts.find_one_and_update(
+        {"session_id": session_id},
+        set_cart_quantity_pipeline(product_id, quantity, datetime.utcnow()),
+        projection={"_id": 0},
+        return_document=ReturnDocument.AFTER
+    )
+    if not cart:
+        raise HTTPException(status_code=404, detail="Cart not found")
     return {"message": "Cart updated", "cart": cart}
 
-# Order endpoints
-@api_router.post("/orders", response_model=Order)
-async def create_order(order_data: OrderCreate, current_user: User = Depends(get_current_user)):
-    # Get cart
-    cart = await db.carts.find_one({"session_id": order_data.cart_session_id}, {"_id": 0})
-    if not cart or not cart["items"]:
-        raise HTTPException(status_code=400, detail="Cart is empty")
+# Abandoned carts
+def abandoned_cart_summary(cart: dict, now: datetime) -> dict:
+    """Compact analytics record of an abandoned cart, without names or images."""
+    return {
+        "session_id": cart["session_id"],
+        "items": [
+            {"product_id": item["product_id"], "quantity": item["quantity"], "price": item["product_price"]}
+            for item in cart["items"]
+        ],
+        "item_count": sum(item["quantity"] for item in cart["items"]),
+        "total_amount": cart.get("total_amount", 0),
+        "created_at": cart.get("created_at"),
+        "last_active_at": cart["updated_at"],
+        "archived_at": now,
+    }
+
+async def archive_abandoned_carts() -> int:
+    """Archive and delete one batch of idle carts; returns how many were swept."""
+    now = datetime.utcnow()
+    cutoff = now - timedelta(seconds=CART_ABANDON_SECONDS)
+    # A checked-out cart belongs to its order until clear_cart_job removes it
+    idle = {"updated_at": {"$lt": cutoff}, "checked_out_order_id": {"$exists": False}}
+    carts = await db.carts.find(idle, {"_id": 0}) \
+        .sort("updated_at", 1).limit(CART_SWEEP_BATCH_SIZE).to_list(CART_SWEEP_BATCH_SIZE)
+    if not carts:
+        return 0
     
+    # Upserts keyed by cart version make a replayed batch harmless; empty carts are just dropped
+    archived = [
+        UpdateOne(
+            {"session_id": cart["session_id"], "last_active_at": cart["updated_at"]},
+            {"$setOnInsert": abandoned_cart_summary(cart, now)},
+            upsert=True
+        )
+        for cart in carts if cart.get("items")
+    ]
+    if archived:
+        await db.abandoned_carts.bulk_write(archived, ordered=False)
+    # A cart touched or checked out since it was read no longer matches and is kept
+    await db.carts.bulk_write([
+        DeleteOne({"session_id": cart["session_id"], "updated_at": cart["updated_at"],
+                   "checked_out_order_id": {"$exists": False}})
+        for cart in carts
+    ], ordered=False)
+    return len(carts)
+
+cart_sweeper = BatchWorker("Cart sweep", archive_abandoned_carts, CART_SWEEP_BATCH_SIZE, CART_SWEEP_INTERVAL_SECONDS)
+
+# Stock reservation
+def line_quantities(items: List[dict]) -> dict:
+    quantities = {}
+    for item in items:
+        quantities[item["product_id"]] = quantities.get(item["product_id"], 0) + item["quantity"]
+    return quantities
+
+async def reserve_stock(reservation_id: str, items: List[dict]) -> dict:
+    """Atomically take stock for every cart line or for none of them.
+
+    Each product is decremented by a conditional update that only matches while
+    enough stock remains, and is tagged with the reservation id so that a
+    partially applied reservation can be rolled back exactly. Returns the
+    category of each reserved product.
+    """
+    quantities = line_quantities(items)
+    names = {item["product_id"]: item["product_name"] for item in items}
+    
+    # Fail fast on a single read before touching any stock
+    products = await db.products.find(
+        {"id": {"$in": list(quantities)}},
+        {"_id": 0, "id": 1, "stock_quantity": 1, "category": 1}
+    ).to_list(len(quantities))
+    stock = {product["id"]: product["stock_quantity"] for product in products}
+    for product_id, quantity in quantities.items():
+        if stock.get(product_id, 0) < quantity:
+            raise HTTPException(status_code=400, detail=f"Insufficient stock for {names[product_id]}")
+    
+    result = await db.products.bulk_write([
+        UpdateOne(
+            {"id": product_id, "stock_quantity": {"$gte": quantity}},
+            {"$inc": {"stock_quantity": -quantity}, "$push": {"reserved_by": reservation_id}}
+        )
+        for product_id, quantity in quantities.items()
+    ], ordered=False)
+    invalidate_catalog(quantities)
+    
+    if result.modified_count < len(quantities):
+        # Another checkout won the race for at least one line
+        await release_stock(reservation_id, items)
+        raise HTTPException(status_code=409, detail="Stock changed during checkout, please retry")
+    return {product["id"]: product.get("category") for product in products}
+
+async def release_stock(reservation_id: str, items: List[dict]) -> None:
+    """Return stock taken by reserve_stock; lines it never reserved are untouched."""
+    quantities = line_quantities(items)
+    await db.products.bulk_write([
+        UpdateOne(
+            {"id": product_id, "reserved_by": reservation_id},
+            {"$inc": {"stock_quantity": quantity}, "$pull": {"reserved_by": reservation_id}}
+        )
+        for product_id, quantity in quantities.items()
+    ], ordered=False)
+    invalidate_catalog(quantities)
+
+async def commit_stock(reservation_id: str) -> None:
+    await db.products.update_many(
+        {"reserved_by": reservation_id},
+        {"$pull": {"reserved_by": reservation_id}}
+    )
+
+async def place_order(order_id: str, order_data: OrderCreate, cart: dict, current_user: User) -> Order:
+    """Reserve stock for a claimed cart and store its order; undone if it raises."""
     # Create order items
     order_items = []
     total_amount = 0
     
     for cart_item in cart["items"]:
-        # Check stock again
-        product = await db.products.find_one({"id": cart_item["product_id"]})
-        if not product or product["stock_quantity"] < cart_item["quantity"]:
-            raise HTTPException(status_code=400, detail=f"Insufficient stock for {cart_item['product_name']}")
-        
         subtotal = cart_item["quantity"] * cart_item["product_price"]
         order_item = OrderItem(
             product_id=cart_item["product_id"],
@@ -300,15 +1441,10 @@ async def create_order(order_data: OrderCreate, current_user: User = Depends(get
         )
         order_items.append(order_item)
         total_amount += subtotal
-        
-        # Update stock
-        await db.products.update_one(
-            {"id": cart_item["product_id"]}, 
-            {"$inc": {"stock_quantity": -cart_item["quantity"]}}
-        )
     
     # Create order
     order = Order(
+        id=order_id,
         user_id=current_user.id if current_user else None,
         customer_name=order_data.customer_name,
         customer_email=order_data.customer_email,
@@ -318,29 +1454,259 @@ async def create_order(order_data: OrderCreate, current_user: User = Depends(get
         total_amount=total_amount
     )
     
-    await db.orders.insert_one(order.dict())
+    categories = await reserve_stock(order.id, cart["items"])
+    for item in order.items:
+        item.category = categories.get(item.product_id)
+    try:
+        await db.orders.insert_one(order.dict())
+    except Exception:
+        await release_stock(order.id, cart["items"])
+        raise
+    return order
+
+# Order endpoints
+@api_router.post("/orders", response_model=Order)
+async def create_order(order_data: OrderCreate, current_user: User = Depends(get_current_user)):
+    # Claim the cart for this order, so a repeated submit cannot order it twice
+    order_id = str(uuid.uuid4())
+    cart = await db.carts.find_one_and_update(
+        {"session_id": order_data.cart_session_id, "items.0": {"$exists": True},
+         "checked_out_order_id": {"$exists": False}},
+        {"$set": {"checked_out_order_id": order_id}},
+        projection={"_id": 0}
+    )
+    if not cart:
+        raise HTTPException(status_code=400, detail="Cart is empty or already checked out")
+    
+    try:
+        order = await place_order(order_id, order_data, cart, current_user)
+    except Exception:
+        await db.carts.update_one(
+            {"session_id": order_data.cart_session_id, "checked_out_order_id": order_id},
+            {"$unset": {"checked_out_order_id": ""}}
+        )
+        raise
     
-    # Clear cart
-    await db.carts.delete_one({"session_id": order_data.cart_session_id})
+    # Once the order is stored the cart stays claimed, whatever fails next. The
+    # reservation commit, analytics and cart cleanup run on the job queue.
+    await order_jobs.enqueue(
+        ("commit_stock", {"order_id": order.id}),
+        ("record_sales", {"order": order.dict(), "sign": 1}),
+        ("clear_cart", {"session_id": order_data.cart_session_id, "order_id": order.id}),
+    )
     
     return order
 
 @api_router.get("/orders/me", response_model=List[Order])
 async def get_my_orders(current_user: User = Depends(get_current_user)):
-    orders = await db.orders.find({"user_id": current_user.id}).to_list(100)
-    return [Order(**order) for order in orders]
+    orders = await db.orders.find({"user_id": current_user.id}, response_projection(Order)).to_list(100)
+    return list_response(orders, Order)
+
+# Order status push
+# Status and payment changes are fanned out per user to open Server-Sent Events
+# streams, so order pages hold one connection instead of polling.
+order_events = EventBroker(max_queued=ORDER_EVENTS_QUEUE_SIZE)
+
+def publish_order_event(order: dict) -> None:
+    if order.get("user_id") and order_events.has_subscribers(order["user_id"]):
+        order_events.publish(order["user_id"], {
+            "order_id": order["id"],
+            "status": order.get("status"),
+            "payment_status": order.get("payment_status"),
+            "updated_at": order.get("updated_at"),
+        })
+
+async def get_stream_user(ticket: str):
+    """The user a ?ticket= from create_stream_ticket was issued to.
+
+    EventSource cannot set headers, so the credential travels in the URL, and
+    with it into access logs; a ticket only opens this stream and expires
+    within STREAM_TICKET_SECONDS.
+    """
+    credentials_exception = HTTPException(status_code=401, detail="Invalid or expired stream ticket")
+    try:
+        payload = jwt.decode(ticket, SECRET_KEY, algorithms=[ALGORITHM])
+    except JWTError:
+        raise credentials_exception
+    if payload.get("purpose") != STREAM_TICKET_PURPOSE or payload.get("sub") is None:
+        raise credentials_exception
+    user = await get_cached_user(payload["sub"])
+    if user is None:
+        raise credentials_exception
+    return user
+
+async def order_event_stream(user_id: str, queue: asyncio.Queue):
+    try:
+        yield b"retry: 5000\n\n"
+        while True:
+            try:
+                event = await asyncio.wait_for(queue.get(), timeout=SSE_KEEPALIVE_SECONDS)
+            except asyncio.TimeoutError:
+                # Comment lines keep proxies from closing an idle stream
+                yield b": keepalive\n\n"
+                continue
+            yield b"event: order\ndata: " + orjson.dumps(event) + b"\n\n"
+    finally:
+        order_events.unsubscribe(user_id, queue)
+
+@api_router.post("/orders/events/ticket")
+async def create_stream_ticket(current_user: User = Depends(get_current_user)):
+    ticket = create_access_token(
+        data={"sub": current_user.email, "purpose": STREAM_TICKET_PURPOSE},
+        expires_delta=timedelta(seconds=STREAM_TICKET_SECONDS)
+    )
+    return {"ticket": ticket, "expires_in": STREAM_TICKET_SECONDS}
+
+@api_router.get("/orders/events")
+async def stream_order_events(current_user: User = Depends(get_stream_user)):
+    queue = order_events.subscribe(current_user.id)
+    return StreamingResponse(
+        order_event_stream(current_user.id, queue),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
 
 @api_router.get("/orders", response_model=List[Order])
 async def get_orders(limit: int = 100):
-    orders = await db.orders.find().sort("created_at", -1).limit(limit).to_list(limit)
-    return [Order(**order) for order in orders]
+    orders = await db.orders.find({}, response_projection(Order)) \
+        .sort("created_at", -1).limit(limit).to_list(limit)
+    return list_response(orders, Order)
+
+# Order export
+class ParquetSink(io.RawIOBase):
+    """Write-only stream that hands out what pyarrow wrote since the last drain."""
+
+    def __init__(self):
+        self.chunks = []
+        self.position = 0
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self.chunks.append(bytes(data))
+        self.position += len(data)
+        return len(data)
+
+    def tell(self):
+        return self.position
+
+    def drain(self) -> bytes:
+        data, self.chunks = b"".join(self.chunks), []
+        return data
+
+def export_row(order: dict) -> dict:
+    """Flatten an order for tabular formats."""
+    row = {column: order.get(column) for column in EXPORT_CSV_COLUMNS}
+    row["item_count"] = len(order["items"])
+    row["items"] = orjson.dumps(order["items"]).decode()
+    row["cursor"] = order["cursor"]
+    return row
+
+async def iter_export_batches(filter_dict: dict, cursor: Optional[str]):
+    """Yield lists of orders in (created_at, id) order, each tagged with its resume cursor."""
+    orders = db.orders.find(keyset_filter(filter_dict, cursor), response_projection(Order)) \
+        .sort([("created_at", 1), ("id", 1)]).batch_size(EXPORT_BATCH_SIZE)
+    batch = []
+    async for order in orders:
+        order["cursor"] = encode_cursor(order)
+        batch.append(order)
+        if len(batch) >= EXPORT_BATCH_SIZE:
+            yield trusted_docs(batch, Order)
+            batch = []
+    if batch:
+        yield trusted_docs(batch, Order)
+
+async def export_ndjson(batches):
+    async for batch in batches:
+        yield b"".join(orjson.dumps(order) + b"\n" for order in batch)
+
+async def export_csv(batches):
+    buffer = io.StringIO()
+    writer = csv.DictWriter(buffer, fieldnames=EXPORT_CSV_COLUMNS)
+    writer.writeheader()
+    async for batch in batches:
+        writer.writerows(export_row(order) for order in batch)
+        yield buffer.getvalue().encode()
+        buffer.seek(0)
+        buffer.truncate()
+    yield buffer.getvalue().encode()
+
+def parquet_schema():
+    # Explicit types, since a batch where a column is all null would infer the wrong one
+    types = {
+        "created_at": pyarrow.timestamp("ms"),
+        "updated_at": pyarrow.timestamp("ms"),
+        "total_amount": pyarrow.float64(),
+        "item_count": pyarrow.int64(),
+    }
+    return pyarrow.schema([(column, types.get(column, pyarrow.string())) for column in EXPORT_CSV_COLUMNS])
+
+async def export_parquet(batches):
+    # One row group per batch keeps memory bounded by EXPORT_BATCH_SIZE
+    sink = ParquetSink()
+    schema = parquet_schema()
+    writer = pyarrow.parquet.ParquetWriter(sink, schema)
+    async for batch in batches:
+        writer.write_table(pyarrow.Table.from_pylist([export_row(order) for order in batch], schema=schema))
+        yield sink.drain()
+    writer.close()
+    yield sink.drain()
+
+EXPORT_FORMATS = {
+    "ndjson": (export_ndjson, "application/x-ndjson"),
+    "csv": (export_csv, "text/csv"),
+    "parquet": (export_parquet, "application/vnd.apache.parquet"),
+}
+
+@api_router.get("/orders/export")
+async def export_orders(
+    format: str = "ndjson",
+    start: Optional[datetime] = None,
+    end: Optional[datetime] = None,
+    status: Optional[str] = None,
+    cursor: Optional[str] = None,
+):
+    """Stream matching orders oldest first.
+
+    Every row carries a ``cursor``; pass the last one received to resume an
+    interrupted export.
+    """
+    if format not in EXPORT_FORMATS:
+        raise HTTPException(status_code=400, detail=f"Unsupported format, use one of: {', '.join(EXPORT_FORMATS)}")
+    if format == "parquet" and pyarrow is None:
+        raise HTTPException(status_code=400, detail="Parquet export requires pyarrow to be installed")
+    
+    filter_dict = {}
+    created_at = {}
+    if start:
+        created_at["$gte"] = start
+    if end:
+        created_at["$lt"] = end
+    if created_at:
+        filter_dict["created_at"] = created_at
+    if status:
+        filter_dict["status"] = status
+    if cursor:
+        decode_cursor(cursor)  # reject a bad token before the response starts
+    
+    encoder, media_type = EXPORT_FORMATS[format]
+    filename = f"orders-{datetime.utcnow():%Y%m%d%H%M%S}.{format}"
+    return StreamingResponse(
+        encoder(iter_export_batches(filter_dict, cursor)),
+        media_type=media_type,
+        headers={"Content-Disposition": f'attachment; filename="{filename}"'},
+    )
 
 @api_router.get("/orders/{order_id}", response_model=Order)
-async def get_order(order_id: str):
-    order = await db.orders.find_one({"id": order_id})
+async def get_order(order_id: str, request: Request):
+    order = await db.orders.find_one({"id": order_id}, response_projection(Order))
     if not order:
         raise HTTPException(status_code=404, detail="Order not found")
-    return Order(**order)
+    # Every order write bumps updated_at, so it versions the whole document
+    version = f"{order['id']}:{order['updated_at'].isoformat()}"
+    etag = f'"{hashlib.sha256(version.encode()).hexdigest()[:32]}"'
+    return conditional_response(request, etag, lambda: render_json(trusted_docs([order], Order)[0])[0])
 
 @api_router.put("/orders/{order_id}/status")
 async def update_order_status(order_id: str, status: str):
@@ -348,16 +1714,187 @@ async def update_order_status(order_id: str, status: str):
     if status not in valid_statuses:
         raise HTTPException(status_code=400, detail="Invalid status")
     
-    result = await db.orders.update_one(
+    now = datetime.utcnow()
+    previous = await db.orders.find_one_and_update(
         {"id": order_id}, 
-        {"$set": {"status": status, "updated_at": datetime.utcnow()}}
+        {"$set": {"status": status, "updated_at": now}},
+        projection={
+            "_id": 0, "id": 1, "user_id": 1, "status": 1, "payment_status": 1,
+            "items": 1, "total_amount": 1, "created_at": 1,
+        }
     )
     
-    if result.matched_count == 0:
+    if previous is None:
         raise HTTPException(status_code=404, detail="Order not found")
+    publish_order_event({**previous, "status": status, "updated_at": now})
+    
+    # Cancelled orders do not count as sales; reinstating one counts it again
+    if previous["status"] != "cancelled" and status == "cancelled":
+        await order_jobs.enqueue(("record_sales", {"order": previous, "sign": -1}))
+    elif previous["status"] == "cancelled" and status != "cancelled":
+        await order_jobs.enqueue(("record_sales", {"order": previous, "sign": 1}))
     
     return {"message": "Order status updated"}
 
+# Sales analytics
+# Rollups are maintained by record_sales as orders are placed and cancelled, so
+# the stats endpoints read a handful of small documents however many orders exist.
+LOW_STOCK_THRESHOLD = int(os.environ.get("LOW_STOCK_THRESHOLD", "5"))
+
+def sales_rollup_updates(order: dict, sign: int) -> dict:
+    """Per-collection $inc upserts that add (sign=1) or remove (sign=-1) an order's sales."""
+    day = order["created_at"].strftime("%Y-%m-%d")
+    updates = {
+        "sales_daily": [UpdateOne(
+            {"day": day},
+            {"$inc": {
+                "revenue": sign * order["total_amount"],
+                "orders": sign,
+                "units": sign * sum(item["quantity"] for item in order["items"]),
+            }},
+            upsert=True
+        )],
+        "sales_by_category": [],
+        "product_sales": [],
+    }
+    for item in order["items"]:
+        updates["sales_by_category"].append(UpdateOne(
+            {"day": day, "category": item.get("category") or "Uncategorized"},
+            {"$inc": {"revenue": sign * item["subtotal"], "units": sign * item["quantity"]}},
+            upsert=True
+        ))
+        updates["product_sales"].append(UpdateOne(
+            {"product_id": item["product_id"]},
+            {"$inc": {"revenue": sign * item["subtotal"], "units": sign * item["quantity"]},
+             "$set": {"product_name": item["product_name"]}},
+            upsert=True
+        ))
+    return updates
+
+async def record_sales(order: dict, sign: int) -> None:
+    await asyncio.gather(*(
+        db[collection].bulk_write(operations, ordered=False)
+        for collection, operations in sales_rollup_updates(order, sign).items()
+        if operations
+    ))
+
+@api_router.get("/admin/stats/revenue")
+async def revenue_stats(days: int = 30):
+    days = max(1, min(days, 366))
+    since = (datetime.utcnow() - timedelta(days=days - 1)).strftime("%Y-%m-%d")
+    daily = await db.sales_daily.find({"day": {"$gte": since}}, {"_id": 0}).sort("day", 1).to_list(days)
+    by_category = await db.sales_by_category.aggregate([
+        {"$match": {"day": {"$gte": since}}},
+        {"$group": {"_id": "$category", "revenue": {"$sum": "$revenue"}, "units": {"$sum": "$units"}}},
+        {"$sort": {"revenue": -1}},
+    ]).to_list(None)
+    return {
+        "since": since,
+        "daily": daily,
+        "by_category": [
+            {"category": row["_id"], "revenue": round(row["revenue"], 2), "units": row["units"]}
+            for row in by_category
+        ],
+    }
+
+@api_router.get("/admin/stats/top-products")
+async def top_products_stats(limit: int = 10):
+    limit = max(1, min(limit, 100))
+    products = await db.product_sales.find({}, {"_id": 0}).sort("revenue", -1).limit(limit).to_list(limit)
+    return {"products": products}
+
+@api_router.get("/admin/stats/low-stock")
+async def low_stock_stats(threshold: int = LOW_STOCK_THRESHOLD, limit: int = 50):
+    limit = max(1, min(limit, MAX_PAGE_SIZE))
+    products = await db.products.find(
+        {"stock_quantity": {"$lte": threshold}},
+        {"_id": 0, "id": 1, "name": 1, "category": 1, "stock_quantity": 1}
+    ).sort("stock_quantity", 1).limit(limit).to_list(limit)
+    return {"threshold": threshold, "products": products}
+
+@api_router.post("/admin/stats/rebuild")
+async def rebuild_sales_stats():
+    """Recompute every rollup from the orders collection (for backfills and repairs).
+
+    Each rollup is rebuilt by one server-side aggregation whose $out swaps the
+    result in atomically, keeping the collection's indexes, so dashboards never
+    read an empty or partial rollup. Sales recorded while a rebuild runs can
+    still be counted twice or lost, so run it again if orders were placed.
+    """
+    sales = {"$match": {"status": {"$ne": "cancelled"}}}
+    day = {"$dateToString": {"format": "%Y-%m-%d", "date": "$created_at"}}
+    await db.orders.aggregate([
+        sales,
+        {"$group": {
+            "_id": day,
+            "revenue": {"$sum": "$total_amount"},
+            "orders": {"$sum": 1},
+            "units": {"$sum": {"$sum": "$items.quantity"}},
+        }},
+        {"$project": {"_id": 0, "day": "$_id", "revenue": 1, "orders": 1, "units": 1}},
+        {"$out": "sales_daily"},
+    ]).to_list(None)
+    await db.orders.aggregate([
+        sales,
+        {"$unwind": "$items"},
+        {"$group": {
+            "_id": {"day": day, "category": {"$ifNull": ["$items.category", "Uncategorized"]}},
+            "revenue": {"$sum": "$items.subtotal"},
+            "units": {"$sum": "$items.quantity"},
+        }},
+        {"$project": {"_id": 0, "day": "$_id.day", "category": "$_id.category", "revenue": 1, "units": 1}},
+        {"$out": "sales_by_category"},
+    ]).to_list(None)
+    await db.orders.aggregate([
+        sales,
+        {"$unwind": "$items"},
+        {"$group": {
+            "_id": "$items.product_id",
+            "product_name": {"$last": "$items.product_name"},
+            "revenue": {"$sum": "$items.subtotal"},
+            "units": {"$sum": "$items.quantity"},
+        }},
+        {"$project": {"_id": 0, "product_id": "$_id", "product_name": 1, "revenue": 1, "units": 1}},
+        {"$out": "product_sales"},
+    ]).to_list(None)
+    
+    rebuilt = await db.orders.count_documents({"status": {"$ne": "cancelled"}})
+    return {"message": f"Rebuilt sales stats from {rebuilt} orders"}
+
+# Order side effects
+# Work that does not decide whether an order is placed runs on a durable job
+# queue in the jobs collection, so checkout latency stays flat as integrations
+# are added. New side effects register a handler here and are enqueued by the
+# endpoint alongside the existing ones.
+JOB_WORKERS = int(os.environ.get("JOB_WORKERS", "2"))
+JOB_POLL_SECONDS = float(os.environ.get("JOB_POLL_SECONDS", "5"))
+JOB_LEASE_SECONDS = float(os.environ.get("JOB_LEASE_SECONDS", "60"))
+JOB_MAX_ATTEMPTS = int(os.environ.get("JOB_MAX_ATTEMPTS", "5"))
+
+order_jobs = JobQueue(
+    lambda: db.jobs,
+    workers=JOB_WORKERS,
+    poll_seconds=JOB_POLL_SECONDS,
+    lease_seconds=JOB_LEASE_SECONDS,
+    max_attempts=JOB_MAX_ATTEMPTS,
+)
+
+async def record_sales_job(payload: dict) -> None:
+    await record_sales(payload["order"], payload["sign"])
+
+async def commit_stock_job(payload: dict) -> None:
+    await commit_stock(payload["order_id"])
+
+async def clear_cart_job(payload: dict) -> None:
+    # A cart changed since checkout was reopened by the change and is kept
+    await db.carts.delete_one({"session_id": payload["session_id"], "checked_out_order_id": payload["order_id"]})
+
+# Rollup $incs are not idempotent, so a failed write is left for
+# /admin/stats/rebuild rather than retried into a double count
+order_jobs.register("record_sales", record_sales_job, max_attempts=1)
+order_jobs.register("commit_stock", commit_stock_job)
+order_jobs.register("clear_cart", clear_cart_job)
+
 # Initialize with sample products
 @api_router.post("/init-sample-data")
 async def init_sample_data():
@@ -417,72 +1954,44 @@ async def init_sample_data():
         }
     ]
     
+    products = []
     for product_data in sample_products:
-        product = Product(**product_data)
-        await db.products.insert_one(product.dict())
+        product_data.update(store_image(product_data.pop("image_base64")))
+        products.append(Product(**product_data).dict())
+    await db.products.insert_many(products)
+    clear_catalog_cache()
     
     return {"message": "Sample data initialized successfully"}
 
-# Auth functions
-def verify_password(plain_password, hashed_password):
-    return pwd_context.verify(plain_password, hashed_password)
-
-def get_password_hash(password):
-    return pwd_context.hash(password)
-
-async def get_user(email: str):
-    user = await db.users.find_one({"email": email})
-    if user:
-        return User(**user)
-
-def create_access_token(data: dict, expires_delta: Optional[timedelta] = None):
-    to_encode = data.copy()
-    if expires_delta:
-        expire = datetime.utcnow() + expires_delta
-    else:
-        expire = datetime.utcnow() + timedelta(minutes=15)
-    to_encode.update({"exp": expire})
-    encoded_jwt = jwt.encode(to_encode, SECRET_KEY, algorithm=ALGORITHM)
-    return encoded_jwt
-
-async def get_current_user(token: str = Depends(oauth2_scheme)):
-    credentials_exception = HTTPException(
-        status_code=401,
-        detail="Could not validate credentials",
-        headers={"WWW-Authenticate": "Bearer"},
-    )
-    try:
-        payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
-        email: str = payload.get("sub")
-        if email is None:
-            raise credentials_exception
-    except JWTError:
-        raise credentials_exception
-    user = await get_user(email=email)
-    if user is None:
-        raise credentials_exception
-    return user
-
 # Auth endpoints
 @api_router.post("/register", response_model=User)
 async def register(user: UserCreate):
-    db_user = await db.users.find_one({"email": user.email})
-    if db_user:
-        raise HTTPException(status_code=400, detail="Email already registered")
-    hashed_password = get_password_hash(user.password)
+    hashed_password = await get_password_hash(user.password)
     user_obj = User(email=user.email, hashed_password=hashed_password)
-    await db.users.insert_one(user_obj.dict())
+    # The unique index on users.email rejects duplicates without a lookup first
+    try:
+        await db.users.insert_one(user_obj.dict())
+    except DuplicateKeyError:
+        raise HTTPException(status_code=400, detail="Email already registered")
+    invalidate_user(user_obj.email)
     return user_obj
 
 @api_router.post("/token")
 async def login(form_data: OAuth2PasswordRequestForm = Depends()):
     user = await get_user(email=form_data.username)
-    if not user or not verify_password(form_data.password, user.hashed_password):
+    valid, new_hash = (False, None)
+    if user:
+        valid, new_hash = await password_hasher.verify_and_update(form_data.password, user.hashed_password)
+    if not valid:
         raise HTTPException(
             status_code=401,
             detail="Incorrect username or password",
             headers={"WWW-Authenticate": "Bearer"},
         )
+    if new_hash:
+        # The configured bcrypt cost changed since this hash was made
+        await db.users.update_one({"id": user.id}, {"$set": {"hashed_password": new_hash}})
+        invalidate_user(user.email)
     access_token_expires = timedelta(minutes=ACCESS_TOKEN_EXPIRE_MINUTES)
     access_token = create_access_token(
         data={"sub": user.email}, expires_delta=access_token_expires
@@ -493,83 +2002,246 @@ async def login(form_data: OAuth2PasswordRequestForm = Depends()):
 async def read_users_me(current_user: User = Depends(get_current_user)):
     return current_user
 
-# Include the router in the main app
-app.include_router(api_router)
+# Diagnostics endpoints
+@api_router.get("/diagnostics/password-hashing")
+async def password_hashing_diagnostics():
+    return password_hasher.metrics()
 
-app.add_middleware(
-    CORSMiddleware,
-    allow_credentials=True,
-    allow_origins=["*"],
-    allow_methods=["*"],
-    allow_headers=["*"],
-)
+@api_router.get("/diagnostics/auth-cache")
+async def auth_cache_diagnostics():
+    return {"tokens": token_claims_cache.stats(), "users": user_cache.stats()}
+
+@api_router.get("/diagnostics/catalog-cache")
+async def catalog_cache_diagnostics():
+    return {
+        "products": product_cache.stats(),
+        "listings": listing_cache.stats(),
+        "categories": categories_cache.stats(),
+    }
+
+@api_router.get("/diagnostics/db-pool")
+async def db_pool_diagnostics():
+    return {
+        "options": MONGO_CLIENT_OPTIONS,
+        "catalog_read_preference": CATALOG_READ_PREFERENCE,
+        "servers": pool_stats.stats(),
+    }
+
+@api_router.get("/diagnostics/profiles")
+async def list_profiles(limit: int = 50):
+    return await asyncio.to_thread(profile_store.index, min(limit, MAX_PAGE_SIZE))
+
+@api_router.get("/diagnostics/profiles/{profile_id}")
+async def get_profile(profile_id: str):
+    stacks = await asyncio.to_thread(profile_store.read, profile_id)
+    if stacks is None:
+        raise HTTPException(status_code=404, detail="Profile not found")
+    return Response(stacks, media_type="text/plain; charset=utf-8")
+
+@api_router.get("/diagnostics/order-events")
+async def order_events_diagnostics():
+    return order_events.stats()
+
+@api_router.get("/diagnostics/jobs")
+async def job_queue_diagnostics():
+    return await order_jobs.stats()
 
 # M-Pesa Integration
-mpesa_consumer_key = os.environ.get("MPESA_CONSUMER_KEY")
-mpesa_consumer_secret = os.environ.get("MPESA_CONSUMER_SECRET")
-mpesa_shortcode = os.environ.get("MPESA_SHORTCODE")
-mpesa_passkey = os.environ.get("MPESA_PASSKEY")
-mpesa_env = "sandbox"  # or "production"
-
-if mpesa_env == "production":
-    mpesa_api_url = "https://api.safaricom.co.ke"
-else:
-    mpesa_api_url = "https://sandbox.safaricom.co.ke"
-
-def get_mpesa_access_token():
-    url = f"{mpesa_api_url}/oauth/v1/generate?grant_type=client_credentials"
-    response = requests.get(url, auth=(mpesa_consumer_key, mpesa_consumer_secret))
-    if response.status_code == 200:
-        return response.json()["access_token"]
-    else:
-        raise HTTPException(status_code=500, detail="Could not get M-Pesa access token")
+mpesa_env = os.environ.get("MPESA_ENV", "sandbox")  # or "production"
+mpesa_api_url = os.environ.get("MPESA_API_URL", PRODUCTION_URL if mpesa_env == "production" else SANDBOX_URL)
+
+mpesa_client = DarajaClient(
+    base_url=mpesa_api_url,
+    consumer_key=os.environ.get("MPESA_CONSUMER_KEY"),
+    consumer_secret=os.environ.get("MPESA_CONSUMER_SECRET"),
+    shortcode=os.environ.get("MPESA_SHORTCODE"),
+    passkey=os.environ.get("MPESA_PASSKEY"),
+    timeout=float(os.environ.get("MPESA_TIMEOUT_SECONDS", "10")),
+    max_retries=int(os.environ.get("MPESA_MAX_RETRIES", "2")),
+)
+
+def callback_token_hash(token: str) -> str:
+    return hashlib.sha256(token.encode()).hexdigest()
 
 @api_router.post("/mpesa/stk-push")
 async def initiate_stk_push(order_id: str, phone_number: str):
-    order = await db.orders.find_one({"id": order_id})
+    # Only Safaricom sees the callback URL, so its token proves a callback is genuine.
+    # Every push keeps its own token, so a customer who retries the push can still
+    # pay an earlier prompt. The checkout is stored before the push so its callback
+    # can never arrive first.
+    callback_token = secrets.token_urlsafe(32)
+    token_hash = callback_token_hash(callback_token)
+    order = await db.orders.find_one({"id": order_id}, {"_id": 0, "total_amount": 1, "payment_status": 1})
     if not order:
         raise HTTPException(status_code=404, detail="Order not found")
+    if order.get("payment_status") == "paid":
+        raise HTTPException(status_code=400, detail="Order is already paid")
+    amount = int(order["total_amount"])
+    await db.orders.update_one(
+        {"id": order_id},
+        {"$push": {"mpesa_checkouts": {"token_hash": token_hash, "amount": amount, "requested_at": datetime.utcnow()}}}
+    )
+
+    try:
+        result = await mpesa_client.stk_push(
+            amount=amount,
+            phone_number=phone_number,
+            account_reference=order_id,
+            callback_url=f"{os.environ.get('BASE_URL')}/api/mpesa/callback/{callback_token}",
+        )
+    except MpesaError as exc:
+        await db.orders.update_one({"id": order_id}, {"$pull": {"mpesa_checkouts": {"token_hash": token_hash}}})
+        raise HTTPException(status_code=500, detail=str(exc))
+
+    if result.get("CheckoutRequestID"):
+        await db.orders.update_one(
+            {"id": order_id, "mpesa_checkouts.token_hash": token_hash},
+            {"$set": {
+                "mpesa_checkouts.$.checkout_request_id": result["CheckoutRequestID"],
+                "mpesa_checkout_request_id": result["CheckoutRequestID"],
+                "updated_at": datetime.utcnow(),
+            }}
+        )
+    return result
+
+@api_router.post("/mpesa/callback/{callback_token}")
+async def mpesa_callback(callback_token: str, request: Request):
+    # Persist the raw body and acknowledge; orders are updated by the callback worker
+    body = await request.body()
+    await db.mpesa_callbacks.insert_one({
+        "id": str(uuid.uuid4()),
+        "body": body.decode("utf-8", errors="replace"),
+        "token_hash": callback_token_hash(callback_token),
+        "processed": False,
+        "received_at": datetime.utcnow(),
+    })
+    mpesa_callback_worker.wake()
+    return {"ResultCode": 0, "ResultDesc": "Accepted"}
+
+# M-Pesa callback processing
+MPESA_CALLBACK_BATCH_SIZE = int(os.environ.get("MPESA_CALLBACK_BATCH_SIZE", "100"))
+MPESA_CALLBACK_POLL_SECONDS = float(os.environ.get("MPESA_CALLBACK_POLL_SECONDS", "5"))
 
-    access_token = get_mpesa_access_token()
-
-    timestamp = datetime.now().strftime("%Y%m%d%H%M%S")
-    password_str = f"{mpesa_shortcode}{mpesa_passkey}{timestamp}"
-    password = base64.b64encode(password_str.encode()).decode()
-
-    payload = {
-        "BusinessShortCode": mpesa_shortcode,
-        "Password": password,
-        "Timestamp": timestamp,
-        "TransactionType": "CustomerPayBillOnline",
-        "Amount": int(order["total_amount"]),
-        "PartyA": phone_number,
-        "PartyB": mpesa_shortcode,
-        "PhoneNumber": phone_number,
-        "CallBackURL": f"{os.environ.get('BASE_URL')}/api/mpesa/callback",
-        "AccountReference": order_id,
-        "TransactionDesc": "Payment for order"
+def parse_stk_callback(body: str, token_hash: Optional[str]) -> dict:
+    """Extract the payment outcome from a Daraja STK callback body."""
+    callback = json.loads(body)["Body"]["stkCallback"]
+    metadata = {
+        item["Name"]: item.get("Value")
+        for item in callback.get("CallbackMetadata", {}).get("Item", [])
+    }
+    if not token_hash:
+        raise ValueError("Callback did not arrive on a tokenized callback URL")
+    paid = callback["ResultCode"] == 0
+    if paid and not isinstance(metadata.get("Amount"), (int, float)):
+        raise ValueError("Successful callback without an Amount")
+    return {
+        "checkout_request_id": callback["CheckoutRequestID"],
+        "token_hash": token_hash,
+        "paid": paid,
+        "amount": metadata.get("Amount"),
+        "receipt_number": metadata.get("MpesaReceiptNumber"),
     }
 
-    headers = {
-        "Authorization": f"Bearer {access_token}",
-        "Content-Type": "application/json"
+def payment_order_filter(result: dict) -> dict:
+    # An order only accepts callbacks delivered to the callback URL of one of its
+    # own pushes, for that push's CheckoutRequestID once it is known
+    checkout = {
+        "token_hash": result["token_hash"],
+        "checkout_request_id": {"$in": [result["checkout_request_id"], None]},
     }
+    if result["paid"]:
+        checkout["amount"] = result["amount"]
+    return {"mpesa_checkouts": {"$elemMatch": checkout}}
 
-    url = f"{mpesa_api_url}/mpesa/stkpush/v1/processrequest"
-    response = requests.post(url, json=payload, headers=headers)
+def callback_mismatch(result: dict, orders: List[dict]) -> Optional[str]:
+    """Why a parsed callback matches no checkout of the given orders, or None."""
+    checkouts = [
+        checkout for order in orders for checkout in order.get("mpesa_checkouts", [])
+        if checkout["token_hash"] == result["token_hash"]
+    ]
+    if not checkouts:
+        return "No order has a checkout for this callback URL"
+    checkout = checkouts[0]
+    if checkout.get("checkout_request_id") not in (None, result["checkout_request_id"]):
+        return f"CheckoutRequestID {result['checkout_request_id']} does not match {checkout['checkout_request_id']}"
+    if result["paid"] and result["amount"] != checkout["amount"]:
+        return f"Paid amount {result['amount']} does not match the requested {checkout['amount']}"
+    return None
 
-    if response.status_code == 200:
-        return response.json()
-    else:
-        raise HTTPException(status_code=500, detail="M-Pesa STK push failed")
-
-@api_router.post("/mpesa/callback")
-async def mpesa_callback(request: Request):
-    data = await request.json()
-    # Process the callback data here
-    # For example, update the order payment status
-    # ...
-    return {"ResultCode": 0, "ResultDesc": "Accepted"}
+def payment_update(result: dict) -> UpdateOne:
+    """Build an idempotent order update for one callback result.
+
+    Re-applying the same callback is a no-op, and a late failure for a
+    CheckoutRequestID can never overwrite a payment already marked paid.
+    A payment is only accepted for exactly the amount that was requested.
+    """
+    order_filter = {**payment_order_filter(result), "payment_status": {"$ne": "paid"}}
+    fields = {"payment_status": "paid" if result["paid"] else "failed", "updated_at": datetime.utcnow()}
+    if result["receipt_number"]:
+        fields["mpesa_receipt_number"] = result["receipt_number"]
+    return UpdateOne(order_filter, {"$set": fields})
+
+async def apply_mpesa_callbacks() -> int:
+    """Apply one batch of queued callbacks to orders; returns the number consumed."""
+    callbacks = await db.mpesa_callbacks.find({"processed": False}, {"_id": 0}) \
+        .sort("received_at", 1).limit(MPESA_CALLBACK_BATCH_SIZE).to_list(MPESA_CALLBACK_BATCH_SIZE)
+    if not callbacks:
+        return 0
+    
+    parsed, errors = {}, {}
+    for callback in callbacks:
+        try:
+            parsed[callback["id"]] = parse_stk_callback(callback["body"], callback.get("token_hash"))
+        except (ValueError, KeyError, TypeError) as exc:
+            errors[callback["id"]] = f"Unparseable callback: {exc!r}"
+    
+    # A callback that no checkout accepts, such as a payment of the wrong amount,
+    # is recorded as an error rather than dropped by an update matching nothing
+    if parsed:
+        orders = await db.orders.find(
+            {"mpesa_checkouts.token_hash": {"$in": [result["token_hash"] for result in parsed.values()]}},
+            {"_id": 0, "mpesa_checkouts": 1}
+        ).to_list(None)
+        for callback_id, result in list(parsed.items()):
+            mismatch = callback_mismatch(result, orders)
+            if mismatch:
+                errors[callback_id] = f"Unmatched {'payment' if result['paid'] else 'callback'}: {mismatch}"
+                del parsed[callback_id]
+    results = list(parsed.values())
+    if results:
+        await db.orders.bulk_write([payment_update(result) for result in results], ordered=False)
+        await publish_payment_events(results)
+    
+    # Marking after applying means a crash replays the batch, which is safe
+    now = datetime.utcnow()
+    await db.mpesa_callbacks.update_many(
+        {"id": {"$in": [c["id"] for c in callbacks if c["id"] not in errors]}},
+        {"$set": {"processed": True, "processed_at": now}}
+    )
+    for callback_id, error in errors.items():
+        logger.warning("Skipping M-Pesa callback %s: %s", callback_id, error)
+        await db.mpesa_callbacks.update_one(
+            {"id": callback_id},
+            {"$set": {"processed": True, "processed_at": now, "error": error}}
+        )
+    return len(callbacks)
+
+async def publish_payment_events(results: List[dict]) -> None:
+    # Only read the orders back when someone is listening for their owners
+    listeners = order_events.topics()
+    if not listeners:
+        return
+    orders = await db.orders.find(
+        {"$or": [payment_order_filter(result) for result in results], "user_id": {"$in": list(listeners)}},
+        {"_id": 0, "id": 1, "user_id": 1, "status": 1, "payment_status": 1, "updated_at": 1}
+    ).to_list(None)
+    for order in orders:
+        publish_order_event(order)
+
+# Drained as soon as a callback is stored, and polled for any left behind by a restart
+mpesa_callback_worker = BatchWorker(
+    "M-Pesa callback processing", apply_mpesa_callbacks, MPESA_CALLBACK_BATCH_SIZE, MPESA_CALLBACK_POLL_SECONDS
+)
 
 
 # Configure logging
@@ -579,6 +2251,79 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
-@app.on_event("shutdown")
-async def shutdown_db_client():
-    client.close()
\ No newline at end of file
+# App lifecycle
+async def ensure_indexes():
+    """Create the indexes in INDEXES; create_indexes is a no-op for existing ones.
+
+    Handlers rely on the unique indexes for correctness (register has no
+    duplicate check of its own), so a collection whose unique index the
+    server refuses, for example over existing duplicates, stops startup.
+    Other failures, such as an unreachable server, are logged.
+    """
+    refused = []
+    for collection, indexes in INDEXES.items():
+        try:
+            await build_indexes(db, collection, indexes)
+        except OperationFailure:
+            logger.exception("Could not create indexes on %s", collection)
+            if any(index.document.get("unique") for index in indexes):
+                refused.append(collection)
+        except Exception:
+            logger.exception("Could not create indexes on %s", collection)
+    if refused:
+        raise RuntimeError(f"Unique indexes could not be built on: {', '.join(refused)}")
+
+async def start_background_workers():
+    mpesa_callback_worker.start()
+    order_jobs.start()
+    cart_sweeper.start()
+
+async def stop_background_workers():
+    await mpesa_callback_worker.stop()
+    await order_jobs.stop()
+    await cart_sweeper.stop()
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    connect_mongo()
+    await ensure_indexes()
+    await start_background_workers()
+    try:
+        yield
+    finally:
+        await stop_background_workers()
+        client.close()
+        password_hasher.executor.shutdown(wait=False)
+        await mpesa_client.aclose()
+
+# Create the main app without a prefix
+app = FastAPI(lifespan=lifespan)
+
+# Include the router in the main app
+app.include_router(api_router)
+
+app.add_middleware(
+    CORSMiddleware,
+    allow_credentials=True,
+    allow_origins=["*"],
+    allow_methods=["*"],
+    allow_headers=["*"],
+    expose_headers=[NEXT_CURSOR_HEADER, "ETag", PROFILE_ID_HEADER],
+)
+
+if PROFILE_SAMPLE_RATE > 0 or PROFILE_SECRET:
+    app.add_middleware(
+        ProfilingMiddleware,
+        store=profile_store,
+        sample_rate=PROFILE_SAMPLE_RATE,
+        secret=PROFILE_SECRET,
+        interval=PROFILE_INTERVAL_MS / 1000,
+        max_concurrent=PROFILE_MAX_CONCURRENT,
+    )
+
+# Outermost, so time spent in the other middleware is included
+app.add_middleware(MetricsMiddleware, metrics=metrics)
+
+@app.get("/metrics", include_in_schema=False)
+async def prometheus_metrics():
+    return Response(metrics.render(), media_type="text/plain; version=0.0.4; charset=utf-8")
@@ -92,6 +92,55 @@ class AutomaresAPITester:
         except Exception as e:
             self.log_test("Get Products by Category", False, f"Exception: {str(e)}")
     
+    def test_get_products_paginated(self):
+        """Test GET /api/products?limit=2 with cursor and field projection"""
+        print("\n=== Testing Paginated Products ===")
+        
+        try:
+            response = requests.get(f"{self.base_url}/products", params={"limit": 2, "fields": "name,price"})
+            
+            if response.status_code == 200:
+                first_page = response.json()
+                next_cursor = response.headers.get("X-Next-Cursor")
+                if any("description" in p or "image_base64" in p for p in first_page):
+                    self.log_test("Paginated Products", False, "Projection returned unrequested fields")
+                elif not next_cursor:
+                    self.log_test("Paginated Products", True, f"Single page of {len(first_page)} products")
+                else:
+                    second = requests.get(f"{self.base_url}/products", params={"limit": 2, "cursor": next_cursor})
+                    first_ids = {p['id'] for p in first_page}
+                    overlap = [p for p in second.json() if p['id'] in first_ids]
+                    if second.status_code == 200 and not overlap:
+                        self.log_test("Paginated Products", True, f"Second page has {len(second.json())} new products")
+                    else:
+                        self.log_test("Paginated Products", False, f"Status: {second.status_code}, overlap: {len(overlap)}")
+            else:
+                self.log_test("Paginated Products", False, f"Status: {response.status_code}")
+                
+        except Exception as e:
+            self.log_test("Paginated Products", False, f"Exception: {str(e)}")
+    
+    def test_search_products(self):
+        """Test GET /api/products/search?q=brake"""
+        print("\n=== Testing Product Search ===")
+        
+        try:
+            response = requests.get(f"{self.base_url}/products/search", params={"q": "brake", "in_stock": "true"})
+            
+            if response.status_code == 200:
+                data = response.json()
+                products = data.get('products', [])
+                facets = data.get('facets', {}).get('categories', [])
+                if all(p.get('stock_quantity', 0) > 0 for p in products) and data.get('total', 0) >= len(products):
+                    self.log_test("Search Products", True, f"Found {data.get('total')} products across {len(facets)} categories")
+                else:
+                    self.log_test("Search Products", False, f"Unexpected results: {data}")
+            else:
+                self.log_test("Search Products", False, f"Status: {response.status_code}, Response: {response.text}")
+                
+        except Exception as e:
+            self.log_test("Search Products", False, f"Exception: {str(e)}")
+    
     def test_get_categories(self):
         """Test GET /api/categories"""
         print("\n=== Testing Get Categories ===")
@@ -239,6 +288,40 @@ class AutomaresAPITester:
         except Exception as e:
             self.log_test("Add Multiple Items", False, f"Exception: {str(e)}")
     
+    def test_cart_batch(self):
+        """Test POST /api/cart/{session_id}/batch"""
+        print("\n=== Testing Cart Batch Operations ===")
+        
+        if len(self.created_products) < 2:
+            self.log_test("Cart Batch", False, "Need at least 2 products for testing")
+            return
+            
+        try:
+            batch_session = str(uuid.uuid4())
+            first, second = self.created_products[0], self.created_products[1]
+            payload = {"operations": [
+                {"op": "add", "product_id": first['id'], "quantity": 1},
+                {"op": "add", "product_id": second['id'], "quantity": 1},
+                {"op": "set", "product_id": first['id'], "quantity": 2},
+                {"op": "remove", "product_id": second['id']}
+            ]}
+            
+            response = requests.post(f"{self.base_url}/cart/{batch_session}/batch", json=payload)
+            
+            if response.status_code == 200:
+                cart = response.json().get('cart', {})
+                items = cart.get('items', [])
+                expected_total = round(2 * first['price'], 2)
+                if len(items) == 1 and items[0]['quantity'] == 2 and abs(cart.get('total_amount', 0) - expected_total) < 0.01:
+                    self.log_test("Cart Batch", True, f"Batch applied, total: ${cart['total_amount']}")
+                else:
+                    self.log_test("Cart Batch", False, f"Unexpected cart: {cart}")
+            else:
+                self.log_test("Cart Batch", False, f"Status: {response.status_code}, Response: {response.text}")
+                
+        except Exception as e:
+            self.log_test("Cart Batch", False, f"Exception: {str(e)}")
+    
     def test_create_order(self):
         """Test POST /api/orders"""
         print("\n=== Testing Create Order ===")
@@ -290,6 +373,30 @@ class AutomaresAPITester:
         except Exception as e:
             self.log_test("Get Orders", False, f"Exception: {str(e)}")
     
+    def test_export_orders(self):
+        """Test GET /api/orders/export as NDJSON and resuming from a cursor"""
+        print("\n=== Testing Order Export ===")
+        
+        try:
+            response = requests.get(f"{self.base_url}/orders/export", params={"format": "ndjson"}, stream=True)
+            
+            if response.status_code == 200:
+                rows = [json.loads(line) for line in response.iter_lines() if line]
+                if not rows:
+                    self.log_test("Export Orders", True, "No orders to export")
+                    return
+                resumed = requests.get(f"{self.base_url}/orders/export", params={"format": "ndjson", "cursor": rows[0]['cursor']})
+                resumed_rows = [json.loads(line) for line in resumed.iter_lines() if line]
+                if len(resumed_rows) == len(rows) - 1:
+                    self.log_test("Export Orders", True, f"Exported {len(rows)} orders, resume skipped the first")
+                else:
+                    self.log_test("Export Orders", False, f"Resume returned {len(resumed_rows)} of {len(rows) - 1} expected rows")
+            else:
+                self.log_test("Export Orders", False, f"Status: {response.status_code}, Response: {response.text}")
+                
+        except Exception as e:
+            self.log_test("Export Orders", False, f"Exception: {str(e)}")
+    
     def test_get_single_order(self):
         """Test GET /api/orders/{order_id}"""
         print("\n=== Testing Get Single Order ===")
@@ -438,6 +545,8 @@ class AutomaresAPITester:
         
         self.test_get_products()
         self.test_get_products_by_category()
+        self.test_get_products_paginated()
+        self.test_search_products()
         self.test_get_categories()
         self.test_get_single_product()
         
@@ -447,6 +556,7 @@ class AutomaresAPITester:
         self.test_update_cart_quantity()
         self.test_add_multiple_items_to_cart()
         self.test_remove_from_cart()
+        self.test_cart_batch()
         
         # Priority 3 - Order Processing
         # Re-add items for order testing since we removed them
@@ -461,6 +571,7 @@ class AutomaresAPITester:
         
         self.test_create_order()
         self.test_get_orders()
+        self.test_export_orders()
         self.test_get_single_order()
         self.test_update_order_status()
         self.test_cart_cleared_after_order()
@@ -9,6 +9,9 @@ import Profile from "./Profile";
 
 const API = `http://localhost:5001/api`;
 
+// Stored images are served from the blob store by hash; others are plain URLs
+const imageSrc = (hash, url) => (hash ? `${API}/images/${hash}` : url);
+
 // Generate a session ID for the cart
 const getSessionId = () => {
   let sessionId = localStorage.getItem('cart_session_id');
@@ -104,7 +107,7 @@ const ProductCard = ({ product, onAddToCart }) => {
     <div className="bg-white rounded-lg shadow-lg overflow-hidden hover:shadow-xl transition-shadow">
       <div className="h-48 bg-gray-200 overflow-hidden">
         <img 
-          src={product.image_base64} 
+          src={imageSrc(product.image_hash, product.image_url)} 
           alt={product.name}
           className="w-full h-full object-cover hover:scale-105 transition-transform duration-300"
         />
@@ -216,7 +219,7 @@ const CartView = ({ cart, onUpdateQuantity, onRemoveItem, onCheckout, onBackToHo
                 <div key={item.product_id} className="bg-white rounded-lg shadow p-4">
                   <div className="flex items-center space-x-4">
                     <img 
-                      src={item.product_image} 
+                      src={imageSrc(item.product_image_hash, item.product_image)} 
                       alt={item.product_name}
                       className="w-16 h-16 object-cover rounded"
                     />
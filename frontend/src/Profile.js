@@ -15,6 +15,56 @@ const Profile = () => {
     }
   }, [token]);
 
+  useEffect(() => {
+    if (!token) {
+      return;
+    }
+    // Status changes are pushed by the server instead of polled. EventSource
+    // cannot send headers, so it opens the stream with a short-lived ticket
+    // rather than putting the session token in the URL.
+    let source = null;
+    let closed = false;
+    const onOrder = (event) => {
+      const update = JSON.parse(event.data);
+      setOrders((current) =>
+        current.map((order) =>
+          order.id === update.order_id
+            ? { ...order, status: update.status, payment_status: update.payment_status }
+            : order
+        )
+      );
+    };
+    const connect = () => {
+      axios
+        .post(`${API}/orders/events/ticket`, null, {
+          headers: { Authorization: `Bearer ${token}` },
+        })
+        .then((response) => {
+          if (closed) {
+            return;
+          }
+          source = new EventSource(
+            `${API}/orders/events?ticket=${encodeURIComponent(response.data.ticket)}`
+          );
+          source.addEventListener("order", onOrder);
+          // A reconnect after the ticket expired is refused; start over with a new one
+          source.onerror = () => {
+            if (source.readyState === EventSource.CLOSED && !closed) {
+              setTimeout(connect, 5000);
+            }
+          };
+        })
+        .catch((error) => console.error("Error opening order updates:", error));
+    };
+    connect();
+    return () => {
+      closed = true;
+      if (source) {
+        source.close();
+      }
+    };
+  }, [token]);
+
   const loadUserProfile = async () => {
     try {
       const response = await axios.get(`${API}/auth`, {
@@ -0,0 +1,47 @@
+import os
+import sys
+from pathlib import Path
+
+import pytest
+
+# The backend modules are imported flat, the way uvicorn loads server.py
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "backend"))
+
+# server.py reads these at import time; no connection is made until startup
+os.environ.setdefault("MONGO_URL", "mongodb://localhost:27017")
+os.environ.setdefault("DB_NAME", "test")
+
+
+@pytest.fixture
+def mock_db(monkeypatch):
+    """A fresh mongomock database installed as the app's db and catalog_db."""
+    mongomock_motor = pytest.importorskip("mongomock_motor")
+    import server
+
+    db = mongomock_motor.AsyncMongoMockClient()["test"]
+    monkeypatch.setattr(server, "db", db)
+    monkeypatch.setattr(server, "catalog_db", db)
+    server.clear_catalog_cache()
+    return db
+
+
+@pytest.fixture
+def api(mock_db):
+    """A TestClient for the app backed by mock_db; the lifespan is not run."""
+    pytest.importorskip("httpx")
+    from fastapi.testclient import TestClient
+
+    import server
+
+    return TestClient(server.app)
+
+
+@pytest.fixture
+def blobs(tmp_path, monkeypatch):
+    """Image blobs written under tmp_path instead of the app's blob directory."""
+    import server
+    from blob_store import LocalBlobStore
+
+    store = LocalBlobStore(tmp_path / "blobs")
+    monkeypatch.setattr(server, "blob_store", store)
+    return store
@@ -0,0 +1,65 @@
+import base64
+import json
+
+import pytest
+
+pytest.importorskip("fastapi")
+pytest.importorskip("httpx")
+pytest.importorskip("mongomock_motor")
+
+
+@pytest.fixture
+def client(api, blobs):
+    import server
+
+    return api, server
+
+
+def ndjson(*rows):
+    return "\n".join(row if isinstance(row, str) else json.dumps(row) for row in rows).encode()
+
+
+def test_invalid_rows_are_reported_without_failing_the_import(client):
+    client, _ = client
+    product = {"name": "Brake pads", "description": "Front", "price": 25.0, "category": "Brakes", "stock_quantity": 4}
+    body = ndjson(
+        {**product, "sku": "BP-1"},
+        {**product, "sku": "BP-2", "image_base64": "not base64!"},
+        {**product, "sku": "BP-3", "price": "free"},
+        "{broken",
+        {**product, "name": "No SKU"},
+        {**product, "sku": "BP-4", "image_base64": base64.b64encode(b"\x89PNG\r\n\x1a\n").decode()},
+    )
+
+    response = client.post("/api/products/bulk", files={"file": ("products.ndjson", body)})
+
+    assert response.status_code == 200
+    summary = response.json()
+    assert summary["inserted"] == 2
+    assert [error["row"] for error in summary["errors"]] == [2, 3, 4, 5]
+    assert summary["errors"][0]["error"] == "Invalid base64 image"
+    products = client.get("/api/products", params={"fields": "sku"}).json()
+    assert sorted(product["sku"] for product in products) == ["BP-1", "BP-4"]
+
+
+def test_rows_are_parsed_off_the_event_loop(client, monkeypatch):
+    import threading
+
+    client, server = client
+    monkeypatch.setattr(server, "IMPORT_CHUNK_SIZE", 2)
+    threads = []
+    import_operation = server.import_operation
+
+    def recording_operation(row):
+        threads.append(threading.current_thread())
+        return import_operation(row)
+
+    monkeypatch.setattr(server, "import_operation", recording_operation)
+    product = {"name": "Brake pads", "description": "Front", "price": 25.0, "category": "Brakes", "stock_quantity": 4}
+    body = ndjson(*({**product, "sku": f"BP-{n}"} for n in range(5)))
+
+    response = client.post("/api/products/bulk", files={"file": ("products.ndjson", body)})
+
+    assert response.json() == {"inserted": 5, "updated": 0, "errors": [], "error_count": 0}
+    assert len(threads) == 5
+    assert threading.main_thread() not in threads
@@ -0,0 +1,152 @@
+from datetime import datetime
+from types import SimpleNamespace
+
+import pytest
+
+pytest.importorskip("fastapi")
+pytest.importorskip("httpx")
+pytest.importorskip("mongomock_motor")
+
+
+class RecordingCarts:
+    """Records cart updates instead of running them; mongomock lacks $round."""
+
+    def __init__(self):
+        self.updates = []
+
+    async def find_one_and_update(self, filter, update, **kwargs):
+        self.updates.append((filter, update))
+        return {"session_id": filter["session_id"]}
+
+
+@pytest.fixture
+def cart_batch(api, mock_db, monkeypatch):
+    import asyncio
+
+    import server
+
+    products = mock_db.products
+    asyncio.run(products.insert_many([
+        {"id": f"p{n}", "name": f"Part {n}", "price": 2.5, "stock_quantity": 10_000} for n in range(600)
+    ]))
+    carts = RecordingCarts()
+    monkeypatch.setattr(server, "db", SimpleNamespace(products=products, carts=carts))
+    build_pipeline = server.cart_batch_pipeline
+
+    def recording_pipeline(lines, now):
+        carts.lines = lines
+        return build_pipeline(lines, now)
+
+    monkeypatch.setattr(server, "cart_batch_pipeline", recording_pipeline)
+
+    def post(operations):
+        return api.post("/api/cart/session-1/batch", json={"operations": operations})
+
+    return post, carts, server
+
+
+def test_batches_update_the_cart_in_a_fixed_number_of_stages(cart_batch):
+    post, carts, server = cart_batch
+    operations = [{"op": "set", "product_id": f"p{n % 5}", "quantity": n + 1} for n in range(1000)]
+
+    assert post(operations).status_code == 200
+    [(_, pipeline)] = carts.updates
+    assert len(carts.lines) == 5
+    assert len(pipeline) == len(server.cart_batch_pipeline([], datetime.utcnow()))
+
+
+def test_batches_apply_the_net_change_per_product(cart_batch):
+    post, carts, _ = cart_batch
+    response = post([
+        {"op": "add", "product_id": "p1", "quantity": 2},
+        {"op": "add", "product_id": "p1", "quantity": 3},
+        {"op": "add", "product_id": "p2", "quantity": 4},
+        {"op": "set", "product_id": "p2", "quantity": 1},
+        {"op": "add", "product_id": "p2", "quantity": 2},
+        {"op": "set", "product_id": "p3", "quantity": 6},
+        {"op": "remove", "product_id": "p3"},
+    ])
+
+    assert response.status_code == 200
+    assert [(line["product_id"], line["absolute"], line["quantity"]) for line in carts.lines] == [
+        ("p1", False, 5), ("p2", True, 3), ("p3", True, 0),
+    ]
+    assert carts.lines[0]["item"] == {**carts.lines[0]["item"], "quantity": 5, "product_price": 2.5}
+
+
+def test_batches_are_capped_by_distinct_products(cart_batch):
+    post, carts, server = cart_batch
+    cap = server.MAX_CART_BATCH_SIZE
+
+    assert post([{"op": "add", "product_id": f"p{n}"} for n in range(cap)]).status_code == 200
+    assert post([{"op": "add", "product_id": f"p{n}"} for n in range(cap + 1)]).status_code == 400
+    assert len(carts.updates) == 1
+
+
+def expression_strings(node):
+    """Strings the server would evaluate as expressions, skipping $literal values."""
+    if isinstance(node, dict):
+        for key, value in node.items():
+            if key != "$literal":
+                yield from expression_strings(value)
+    elif isinstance(node, list):
+        for value in node:
+            yield from expression_strings(value)
+    elif isinstance(node, str):
+        yield node
+
+
+def test_client_values_are_never_evaluated_as_expressions():
+    import server
+
+    product_id = "$session_id"
+    quantity = "$$ROOT.quantity"
+    price = "$$ROOT.price"
+    now = datetime.utcnow()
+    item = {"product_id": product_id, "quantity": quantity, "product_price": price}
+    pipelines = [
+        server.add_to_cart_pipeline(item, now),
+        server.set_cart_quantity_pipeline(product_id, quantity, now),
+        server.remove_from_cart_pipeline(product_id, now),
+        server.cart_batch_pipeline([{"product_id": product_id, "absolute": True, "quantity": 1, "item": item}], now),
+    ]
+
+    for pipeline in pipelines:
+        evaluated = set(expression_strings(pipeline))
+        assert not evaluated & {product_id, quantity, price}
+
+
+def test_every_cart_change_reopens_a_checked_out_cart():
+    import server
+
+    now = datetime.utcnow()
+    item = {"product_id": "p1", "quantity": 1, "product_price": 2.5}
+    reopen = server.reopen_cart_pipeline()
+    for pipeline in [
+        server.add_to_cart_pipeline(item, now),
+        server.set_cart_quantity_pipeline("p1", 2, now),
+        server.remove_from_cart_pipeline("p1", now),
+        server.cart_batch_pipeline([], now),
+    ]:
+        assert pipeline[:len(reopen)] == reopen
+
+
+@pytest.mark.parametrize("operation", [
+    {"op": "add", "product_id": "p1", "quantity": 0},
+    {"op": "add", "product_id": "p1", "quantity": -2},
+    {"op": "set", "product_id": "p1", "quantity": -1},
+])
+def test_batches_reject_invalid_quantities(cart_batch, operation):
+    post, carts, _ = cart_batch
+
+    response = post([{"op": "add", "product_id": "p2", "quantity": 1}, operation])
+
+    assert response.status_code == 400
+    assert carts.updates == []
+
+
+def test_setting_zero_removes_the_line(cart_batch):
+    post, carts, _ = cart_batch
+
+    assert post([{"op": "set", "product_id": "p1", "quantity": 0}]).status_code == 200
+    assert [(line["absolute"], line["quantity"]) for line in carts.lines] == [(True, 0)]
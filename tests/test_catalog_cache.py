@@ -0,0 +1,52 @@
+import asyncio
+
+import pytest
+
+pytest.importorskip("fastapi")
+pytest.importorskip("httpx")
+pytest.importorskip("mongomock_motor")
+
+
+@pytest.fixture
+def catalog(api, mock_db):
+    import server
+
+    asyncio.run(mock_db.products.insert_one({
+        "id": "p1", "name": "Brake pads", "description": "Front", "price": 25.0,
+        "category": "Brakes", "stock_quantity": 4,
+    }))
+    return api, server, mock_db
+
+
+def test_reads_are_cached_until_invalidated(catalog):
+    api, server, _ = catalog
+
+    assert api.get("/api/products/p1").status_code == 200
+    assert api.get("/api/products").status_code == 200
+    assert len(server.product_cache) == 1 and len(server.listing_cache) == 1
+
+    server.invalidate_catalog(["p1"])
+    assert len(server.product_cache) == 0 and len(server.listing_cache) == 0
+
+
+def test_reads_overlapping_an_invalidation_are_not_cached(catalog, monkeypatch):
+    api, server, db = catalog
+    products = type(db.products)
+    find_one, find = products.find_one, products.find
+
+    # A write lands, and invalidates the catalog, while each read is in flight
+    async def find_one_during_write(self, *args, **kwargs):
+        document = await find_one(self, *args, **kwargs)
+        server.invalidate_catalog(["p1"])
+        return document
+
+    def find_during_write(self, *args, **kwargs):
+        server.invalidate_catalog(["p1"])
+        return find(self, *args, **kwargs)
+
+    monkeypatch.setattr(products, "find_one", find_one_during_write)
+    monkeypatch.setattr(products, "find", find_during_write)
+
+    assert api.get("/api/products/p1").json()["stock_quantity"] == 4
+    assert api.get("/api/products").status_code == 200
+    assert len(server.product_cache) == 0 and len(server.listing_cache) == 0
@@ -0,0 +1,110 @@
+import asyncio
+
+import pytest
+
+pytest.importorskip("fastapi")
+pytest.importorskip("httpx")
+pytest.importorskip("mongomock_motor")
+
+ORDER = {
+    "customer_name": "Test", "customer_email": "test@example.com", "customer_phone": "0700000000",
+    "customer_address": "Nairobi", "cart_session_id": "session-1",
+}
+
+
+@pytest.fixture
+def checkout(api, mock_db, monkeypatch):
+    import server
+
+    db = mock_db
+    asyncio.run(db.products.insert_one(
+        {"id": "p1", "name": "Brake pads", "price": 25.0, "category": "Brakes", "stock_quantity": 3}
+    ))
+    asyncio.run(db.carts.insert_one({"session_id": "session-1", "total_amount": 50.0, "items": [
+        {"product_id": "p1", "quantity": 2, "product_name": "Brake pads", "product_price": 25.0},
+    ]}))
+    monkeypatch.setitem(server.app.dependency_overrides, server.get_current_user,
+                        lambda: server.User(email="test@example.com", hashed_password="x"))
+    return api, server, db
+
+
+def test_a_cart_is_ordered_only_once(checkout):
+    client, server, db = checkout
+
+    first = client.post("/api/orders", json=ORDER)
+    second = client.post("/api/orders", json=ORDER)
+
+    assert first.status_code == 200
+    assert second.status_code == 400
+    assert asyncio.run(db.orders.count_documents({})) == 1
+    assert asyncio.run(db.products.find_one({"id": "p1"}))["stock_quantity"] == 1
+    assert client.get("/api/cart/session-1").json() == {"items": [], "total_amount": 0}
+
+    asyncio.run(server.clear_cart_job({"session_id": "session-1", "order_id": first.json()["id"]}))
+    assert asyncio.run(db.carts.count_documents({})) == 0
+
+
+def test_a_failed_checkout_releases_the_cart(checkout):
+    client, _, db = checkout
+    asyncio.run(db.products.update_one({"id": "p1"}, {"$set": {"stock_quantity": 1}}))
+
+    assert client.post("/api/orders", json=ORDER).status_code == 400
+
+    cart = asyncio.run(db.carts.find_one({"session_id": "session-1"}))
+    assert "checked_out_order_id" not in cart
+    asyncio.run(db.products.update_one({"id": "p1"}, {"$set": {"stock_quantity": 5}}))
+    assert client.post("/api/orders", json=ORDER).status_code == 200
+
+
+def test_clearing_keeps_a_cart_reopened_after_checkout(checkout):
+    client, server, db = checkout
+    order = client.post("/api/orders", json=ORDER).json()
+    # As reopen_cart_pipeline leaves it; mongomock cannot run the pipeline ($$REMOVE, $round)
+    asyncio.run(db.carts.update_one(
+        {"session_id": "session-1"}, {"$set": {"items": [], "total_amount": 0}, "$unset": {"checked_out_order_id": ""}}
+    ))
+
+    asyncio.run(server.clear_cart_job({"session_id": "session-1", "order_id": order["id"]}))
+
+    assert asyncio.run(db.carts.count_documents({})) == 1
+
+
+def test_a_stored_order_keeps_its_cart_claimed(checkout, monkeypatch):
+    client, server, db = checkout
+
+    async def enqueue(*jobs):
+        raise RuntimeError("queue unavailable")
+
+    monkeypatch.setattr(server.order_jobs, "enqueue", enqueue)
+    with pytest.raises(RuntimeError):
+        client.post("/api/orders", json=ORDER)
+
+    [order] = asyncio.run(db.orders.find({}).to_list(None))
+    cart = asyncio.run(db.carts.find_one({"session_id": "session-1"}))
+    assert cart["checked_out_order_id"] == order["id"]
+    assert client.post("/api/orders", json=ORDER).status_code == 400
+
+
+def test_the_reservation_is_committed_by_a_job(checkout):
+    client, server, db = checkout
+    order = client.post("/api/orders", json=ORDER).json()
+    assert asyncio.run(db.products.find_one({"id": "p1"}))["reserved_by"] == [order["id"]]
+
+    while asyncio.run(server.order_jobs.run_one()):
+        pass
+
+    assert asyncio.run(db.products.find_one({"id": "p1"}))["reserved_by"] == []
+    assert asyncio.run(db.carts.count_documents({})) == 0
+
+
+def test_the_sweeper_leaves_checked_out_carts_alone(checkout):
+    from datetime import datetime, timedelta
+
+    client, server, db = checkout
+    assert client.post("/api/orders", json=ORDER).status_code == 200
+    idle = datetime.utcnow() - timedelta(seconds=server.CART_ABANDON_SECONDS + 60)
+    asyncio.run(db.carts.update_many({}, {"$set": {"updated_at": idle}}))
+    asyncio.run(db.carts.insert_one({"session_id": "session-2", "items": [], "updated_at": idle}))
+
+    assert asyncio.run(server.archive_abandoned_carts()) == 1
+    assert [cart["session_id"] for cart in asyncio.run(db.carts.find({}).to_list(None))] == ["session-1"]
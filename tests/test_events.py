@@ -0,0 +1,84 @@
+import asyncio
+
+import pytest
+
+from events import EventBroker
+
+
+def test_events_reach_only_subscribers_of_the_topic():
+    async def scenario():
+        broker = EventBroker()
+        mine, other = broker.subscribe("user-1"), broker.subscribe("user-2")
+        delivered = broker.publish("user-1", {"status": "shipped"})
+        return delivered, mine.get_nowait(), other.empty()
+
+    delivered, event, other_empty = asyncio.run(scenario())
+    assert delivered == 1
+    assert event == {"status": "shipped"}
+    assert other_empty
+
+
+def test_slow_subscribers_keep_the_newest_events():
+    async def scenario():
+        broker = EventBroker(max_queued=2)
+        queue = broker.subscribe("user-1")
+        for status in ("confirmed", "processing", "shipped"):
+            broker.publish("user-1", status)
+        return [queue.get_nowait() for _ in range(queue.qsize())], broker.stats()
+
+    events, stats = asyncio.run(scenario())
+    assert events == ["processing", "shipped"]
+    assert stats["dropped"] == 1
+
+
+def test_unsubscribing_the_last_queue_removes_the_topic():
+    async def scenario():
+        broker = EventBroker()
+        queue = broker.subscribe("user-1")
+        broker.unsubscribe("user-1", queue)
+        return broker.has_subscribers("user-1"), broker.publish("user-1", "ignored")
+
+    assert asyncio.run(scenario()) == (False, 0)
+
+
+@pytest.fixture
+def session(api, mock_db):
+    import server
+
+    user = server.User(email="buyer@example.com", hashed_password="x")
+    asyncio.run(mock_db.users.insert_one(user.dict()))
+    token = server.create_access_token({"sub": user.email})
+    return api, server, user, {"Authorization": f"Bearer {token}"}
+
+
+def test_streams_open_with_a_ticket_not_the_session_token(session):
+    from fastapi import HTTPException
+
+    client, server, user, headers = session
+
+    response = client.post("/api/orders/events/ticket", headers=headers)
+
+    assert response.status_code == 200
+    ticket = response.json()["ticket"]
+    assert asyncio.run(server.get_stream_user(ticket)).id == user.id
+    session_token = headers["Authorization"].split()[1]
+    with pytest.raises(HTTPException) as refused:
+        asyncio.run(server.get_stream_user(session_token))
+    assert refused.value.status_code == 401
+    assert client.get("/api/orders/events", params={"token": session_token}).status_code == 422
+
+
+def test_tickets_are_not_sessions_and_expire(session):
+    from datetime import timedelta
+
+    from fastapi import HTTPException
+
+    client, server, user, headers = session
+    ticket = client.post("/api/orders/events/ticket", headers=headers).json()["ticket"]
+    expired = server.create_access_token(
+        {"sub": user.email, "purpose": server.STREAM_TICKET_PURPOSE}, expires_delta=timedelta(seconds=-1)
+    )
+
+    assert client.get("/api/orders/me", headers={"Authorization": f"Bearer {ticket}"}).status_code == 401
+    with pytest.raises(HTTPException):
+        asyncio.run(server.get_stream_user(expired))
@@ -0,0 +1,64 @@
+import asyncio
+import base64
+
+import pytest
+
+pytest.importorskip("fastapi")
+pytest.importorskip("httpx")
+pytest.importorskip("mongomock_motor")
+
+PNG = b"\x89PNG\r\n\x1a\n"
+
+
+def test_migration_skips_undecodable_images(api, mock_db, blobs, monkeypatch):
+    # mongomock has no array filters, so cart writes are recorded instead of run
+    collection = type(mock_db.carts)
+    bulk_write = collection.bulk_write
+    cart_writes = []
+
+    async def recording_bulk_write(self, requests, **kwargs):
+        if self.name == "carts":
+            cart_writes.extend(requests)
+            return None
+        return await bulk_write(self, requests, **kwargs)
+
+    monkeypatch.setattr(collection, "bulk_write", recording_bulk_write)
+    asyncio.run(mock_db.products.insert_many([
+        {"id": "p1", "name": "Legacy path", "image_base64": "/static/a.jpg"},
+        {"id": "p2", "name": "Inline", "image_base64": base64.b64encode(PNG).decode()},
+        {"id": "p3", "name": "Linked", "image_base64": "https://cdn.example.com/p3.jpg"},
+    ]))
+    asyncio.run(mock_db.carts.insert_many([
+        {"session_id": "s1", "items": [
+            {"product_id": "p2", "product_image": "inline"},
+            {"product_id": "p1", "product_image": "inline"},
+        ]},
+        {"session_id": "s2", "items": [{"product_id": "p9", "product_image": None}]},
+    ]))
+
+    response = api.post("/api/images/migrate")
+
+    assert response.status_code == 200
+    assert response.json()["errors"] == [{"product_id": "p1", "error": "Invalid base64 image"}]
+    products = {p["id"]: p for p in asyncio.run(mock_db.products.find({}, {"_id": 0}).to_list(None))}
+    assert products["p1"]["image_base64"] == "/static/a.jpg"
+    assert "image_base64" not in products["p2"] and blobs.stat(products["p2"]["image_hash"])
+    assert products["p3"]["image_url"] == "https://cdn.example.com/p3.jpg"
+    [cart_write] = cart_writes
+    assert cart_write._filter == {"session_id": "s1"}
+    assert cart_write._doc == {"$set": {
+        "items.$[p0].product_image_hash": products["p2"]["image_hash"],
+        "items.$[p0].product_image": None,
+    }}
+    assert cart_write._array_filters == [{"p0.product_id": "p2"}]
+
+    # Nothing is left to migrate but the bad image, which is reported again
+    assert api.post("/api/images/migrate").json()["error_count"] == 1
+
+
+def test_image_etags_use_weak_comparison(api, blobs):
+    image_hash = blobs.put(PNG)
+
+    response = api.get(f"/api/images/{image_hash}", headers={"If-None-Match": f'W/"{image_hash}", "other"'})
+
+    assert response.status_code == 304
@@ -0,0 +1,35 @@
+import pytest
+
+pytest.importorskip("pymongo")
+
+from indexes import INDEXES, QUERY_SHAPES, plan_stages, winning_plan
+
+
+def index_keys(collection):
+    return [list(model.document["key"]) for model in INDEXES[collection]]
+
+
+def has_text_index(collection):
+    return any("text" in model.document["key"].values() for model in INDEXES[collection])
+
+
+def test_plan_stages_walks_nested_plans():
+    explain = {"queryPlanner": {"winningPlan": {
+        "stage": "SUBPLAN",
+        "inputStage": {"stage": "OR", "inputStages": [
+            {"stage": "FETCH", "inputStage": {"stage": "IXSCAN"}},
+            {"stage": "COLLSCAN"},
+        ]},
+    }}}
+    assert list(plan_stages(winning_plan(explain))) == ["SUBPLAN", "OR", "FETCH", "IXSCAN", "COLLSCAN"]
+
+
+@pytest.mark.parametrize("collection,query,sort", QUERY_SHAPES)
+def test_every_query_shape_has_an_index_prefix(collection, query, sort):
+    branches = query.get("$or", [query])
+    for branch in branches:
+        if "$text" in branch:
+            assert has_text_index(collection), collection
+            continue
+        fields = list(branch) or [field for field, _ in sort]
+        assert any(keys[:len(fields)] == fields for keys in index_keys(collection)), (collection, fields)
@@ -0,0 +1,82 @@
+import asyncio
+
+import pytest
+
+mongomock_motor = pytest.importorskip("mongomock_motor")
+
+from jobs import JobQueue
+
+
+def make_queue(**kwargs):
+    db = mongomock_motor.AsyncMongoMockClient()["jobs_test"]
+    return JobQueue(lambda: db.jobs, backoff_seconds=0, **kwargs), db
+
+
+def test_finished_jobs_are_deleted():
+    async def scenario():
+        queue, db = make_queue()
+        seen = []
+
+        async def handler(payload):
+            seen.append(payload["n"])
+
+        queue.register("note", handler)
+        await queue.enqueue(("note", {"n": 1}), ("note", {"n": 2}))
+        while await queue.run_one():
+            pass
+        return seen, await db.jobs.count_documents({})
+
+    seen, remaining = asyncio.run(scenario())
+    assert sorted(seen) == [1, 2]
+    assert remaining == 0
+
+
+def test_failing_jobs_are_retried_then_kept_as_failed():
+    async def scenario():
+        queue, db = make_queue(max_attempts=3)
+        calls = []
+
+        async def handler(payload):
+            calls.append(payload)
+            raise RuntimeError("downstream unavailable")
+
+        queue.register("flaky", handler)
+        await queue.enqueue(("flaky", {}))
+        while await queue.run_one():
+            pass
+        return calls, await db.jobs.find_one({}, {"_id": 0})
+
+    calls, job = asyncio.run(scenario())
+    assert len(calls) == 3
+    assert job["status"] == "failed"
+    assert job["attempts"] == 3
+    assert "downstream unavailable" in job["last_error"]
+
+
+def test_unknown_job_types_are_rejected_at_enqueue():
+    queue, _ = make_queue()
+    with pytest.raises(KeyError):
+        asyncio.run(queue.enqueue(("missing", {})))
+
+
+def test_jobs_reclaimed_after_their_last_attempt_are_not_rerun():
+    async def scenario():
+        queue, db = make_queue(lease_seconds=0)
+        calls = []
+
+        async def handler(payload):
+            calls.append(payload)
+
+        queue.register("once", handler, max_attempts=1)
+        await queue.enqueue(("once", {}))
+        # A worker claims the job and dies before settling it
+        await queue.claim()
+        while await queue.run_one():
+            pass
+        return calls, await db.jobs.find_one({}, {"_id": 0})
+
+    calls, job = asyncio.run(scenario())
+    assert calls == []
+    assert job["status"] == "failed"
+    assert job["attempts"] == 2
+    assert "Lease expired" in job["last_error"]
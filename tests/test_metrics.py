@@ -0,0 +1,65 @@
+from types import SimpleNamespace
+
+import pytest
+
+from metrics import Metrics, current_scope
+
+
+def command_event(name, micros):
+    return SimpleNamespace(command_name=name, duration_micros=micros)
+
+
+def test_histograms_render_cumulative_buckets():
+    metrics = Metrics(buckets=(0.1, 1.0))
+    metrics.request_started()
+    metrics.request_finished("GET", "/api/products", 200, 0.05)
+    metrics.request_started()
+    metrics.request_finished("GET", "/api/products", 200, 0.5)
+
+    text = metrics.render()
+    assert 'http_request_duration_seconds_bucket{method="GET",route="/api/products",le="0.1"} 1' in text
+    assert 'http_request_duration_seconds_bucket{method="GET",route="/api/products",le="1.0"} 2' in text
+    assert 'http_request_duration_seconds_bucket{method="GET",route="/api/products",le="+Inf"} 2' in text
+    assert 'http_requests_total{method="GET",route="/api/products",status="200"} 2' in text
+    assert "http_requests_in_flight 0" in text
+
+
+def test_commands_are_attributed_to_the_current_route():
+    metrics = Metrics()
+    listener = metrics.command_listener()
+    listener.succeeded(command_event("find", 1500))
+    token = current_scope.set({"route": SimpleNamespace(path="/api/orders/{order_id}")})
+    try:
+        listener.failed(command_event("update", 800))
+    finally:
+        current_scope.reset(token)
+
+    text = metrics.render()
+    assert 'mongodb_command_duration_seconds_count{route="background",command="find"} 1' in text
+    assert 'mongodb_command_failures_total{route="/api/orders/{order_id}",command="update"} 1' in text
+
+
+def test_middleware_labels_requests_by_route_template():
+    pytest.importorskip("fastapi")
+    pytest.importorskip("httpx")
+    from fastapi import FastAPI
+    from fastapi.testclient import TestClient
+
+    from metrics import MetricsMiddleware
+
+    metrics = Metrics()
+    app = FastAPI()
+    app.add_middleware(MetricsMiddleware, metrics=metrics)
+
+    @app.get("/items/{item_id}")
+    async def get_item(item_id: str):
+        return {"id": item_id}
+
+    client = TestClient(app)
+    client.get("/items/1")
+    client.get("/items/2")
+    client.get("/missing")
+
+    text = metrics.render()
+    assert 'http_requests_total{method="GET",route="/items/{item_id}",status="200"} 2' in text
+    assert 'http_requests_total{method="GET",route="unmatched",status="404"} 1' in text
@@ -0,0 +1,140 @@
+import asyncio
+import json
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+httpx = pytest.importorskip("httpx")
+
+from mpesa import DarajaClient, MpesaError
+
+
+class StubDaraja(BaseHTTPRequestHandler):
+    """Minimal stand-in for the Daraja OAuth and STK push endpoints."""
+
+    calls = []
+    push_failures = 0
+    push_failure_status = 503
+
+    def log_message(self, *args):
+        pass
+
+    def _reply(self, status, body):
+        data = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self):
+        StubDaraja.calls.append("token")
+        self._reply(200, {"access_token": f"token-{len(StubDaraja.calls)}", "expires_in": "3599"})
+
+    def do_POST(self):
+        body = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+        StubDaraja.calls.append("push")
+        if StubDaraja.push_failures:
+            StubDaraja.push_failures -= 1
+            self._reply(StubDaraja.push_failure_status, {})
+            return
+        self._reply(200, {"CheckoutRequestID": "ws_CO_1", "AccountReference": body["AccountReference"]})
+
+
+@pytest.fixture
+def stub_url():
+    StubDaraja.calls = []
+    StubDaraja.push_failures = 0
+    StubDaraja.push_failure_status = 503
+    server = ThreadingHTTPServer(("127.0.0.1", 0), StubDaraja)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield f"http://127.0.0.1:{server.server_address[1]}"
+    server.shutdown()
+
+
+def make_client(url, **kwargs):
+    return DarajaClient(url, "key", "secret", "174379", "passkey", backoff=0, **kwargs)
+
+
+def test_token_is_cached_across_pushes(stub_url):
+    async def run():
+        client = make_client(stub_url)
+        try:
+            for _ in range(3):
+                result = await client.stk_push(10, "254700000000", "order-1", "http://cb")
+                assert result["AccountReference"] == "order-1"
+        finally:
+            await client.aclose()
+
+    asyncio.run(run())
+    assert StubDaraja.calls == ["token", "push", "push", "push"]
+
+
+def push(url, max_retries=1):
+    async def run():
+        client = make_client(url, max_retries=max_retries)
+        try:
+            return await client.stk_push(10, "254700000000", "order-1", "http://cb")
+        finally:
+            await client.aclose()
+
+    return asyncio.run(run())
+
+
+def test_throttled_pushes_are_retried_then_raised(stub_url):
+    StubDaraja.push_failure_status = 429
+    StubDaraja.push_failures = 1
+    assert push(stub_url)["CheckoutRequestID"] == "ws_CO_1"
+
+    StubDaraja.push_failures = 5
+    with pytest.raises(MpesaError):
+        push(stub_url)
+
+
+def test_pushes_that_may_have_been_processed_are_not_retried(stub_url):
+    # A 503 may come after Safaricom already prompted the customer
+    StubDaraja.push_failures = 1
+    with pytest.raises(MpesaError):
+        push(stub_url)
+    assert StubDaraja.calls == ["token", "push"]
+
+
+def push_with_transport_errors(errors):
+    """Push through a mock transport that raises errors, in order, before succeeding."""
+    errors = list(errors)
+    pushes = []
+
+    def handle(request):
+        if request.method == "GET":
+            return httpx.Response(200, json={"access_token": "token", "expires_in": "3599"})
+        pushes.append(request)
+        if errors:
+            raise errors.pop(0)
+        return httpx.Response(200, json={"CheckoutRequestID": "ws_CO_1"})
+
+    async def run():
+        client = make_client("http://daraja", max_retries=1)
+        client._http = httpx.AsyncClient(base_url="http://daraja", transport=httpx.MockTransport(handle))
+        try:
+            return await client.stk_push(10, "254700000000", "order-1", "http://cb")
+        finally:
+            await client.aclose()
+
+    try:
+        return asyncio.run(run()), len(pushes)
+    except MpesaError:
+        return None, len(pushes)
+
+
+def test_pushes_are_retried_when_the_connection_fails():
+    result, pushes = push_with_transport_errors([httpx.ConnectError("refused")])
+    assert result["CheckoutRequestID"] == "ws_CO_1"
+    assert pushes == 2
+
+
+def test_pushes_are_not_retried_after_a_read_timeout():
+    result, pushes = push_with_transport_errors([httpx.ReadTimeout("no response")])
+    assert result is None
+    assert pushes == 1
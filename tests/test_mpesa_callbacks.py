@@ -0,0 +1,140 @@
+import asyncio
+import json
+
+import pytest
+
+pytest.importorskip("fastapi")
+pytest.importorskip("motor")
+
+from server import callback_token_hash, parse_stk_callback, payment_update
+
+TOKEN_HASH = callback_token_hash("token")
+
+
+def callback_body(result_code=0, **metadata):
+    callback = {"CheckoutRequestID": "ws_CO_1", "ResultCode": result_code, "ResultDesc": "..."}
+    if metadata:
+        callback["CallbackMetadata"] = {"Item": [{"Name": name, "Value": value} for name, value in metadata.items()]}
+    return json.dumps({"Body": {"stkCallback": callback}})
+
+
+def test_successful_callback_is_parsed():
+    result = parse_stk_callback(callback_body(Amount=5000, MpesaReceiptNumber="QWE123"), TOKEN_HASH)
+    assert result == {
+        "checkout_request_id": "ws_CO_1",
+        "token_hash": TOKEN_HASH,
+        "paid": True,
+        "amount": 5000,
+        "receipt_number": "QWE123",
+    }
+
+
+def test_failed_callback_needs_no_metadata():
+    result = parse_stk_callback(callback_body(result_code=1032), TOKEN_HASH)
+    assert result["paid"] is False and result["amount"] is None
+
+
+@pytest.mark.parametrize("body,token_hash", [
+    (callback_body(Amount=5000), None),
+    (callback_body(MpesaReceiptNumber="QWE123"), TOKEN_HASH),
+    ("not json", TOKEN_HASH),
+])
+def test_untokenized_or_incomplete_callbacks_are_rejected(body, token_hash):
+    with pytest.raises((ValueError, KeyError)):
+        parse_stk_callback(body, token_hash)
+
+
+def test_payment_matches_checkout_token_and_requested_amount():
+    update = payment_update(parse_stk_callback(callback_body(Amount=5000, MpesaReceiptNumber="QWE123"), TOKEN_HASH))
+    document = update._doc
+    assert update._filter == {
+        "mpesa_checkouts": {"$elemMatch": {
+            "token_hash": TOKEN_HASH,
+            "checkout_request_id": {"$in": ["ws_CO_1", None]},
+            "amount": 5000,
+        }},
+        "payment_status": {"$ne": "paid"},
+    }
+    assert document["$set"]["payment_status"] == "paid"
+    assert document["$set"]["mpesa_receipt_number"] == "QWE123"
+
+
+def test_failure_never_requires_an_amount():
+    update = payment_update(parse_stk_callback(callback_body(result_code=1), TOKEN_HASH))
+    assert "amount" not in update._filter["mpesa_checkouts"]["$elemMatch"]
+    assert update._doc["$set"]["payment_status"] == "failed"
+
+
+def store_callbacks(db, *callbacks):
+    from datetime import datetime
+
+    asyncio.run(db.mpesa_callbacks.insert_many([
+        {"id": f"cb{n}", "body": body, "token_hash": token_hash, "processed": False, "received_at": datetime.utcnow()}
+        for n, (body, token_hash) in enumerate(callbacks)
+    ]))
+
+
+def test_any_push_of_an_order_can_be_paid(mock_db):
+    import server
+
+    second_hash = callback_token_hash("second")
+    asyncio.run(mock_db.orders.insert_one({"id": "o1", "payment_status": "pending", "mpesa_checkouts": [
+        {"token_hash": TOKEN_HASH, "amount": 5000, "checkout_request_id": "ws_CO_1"},
+        {"token_hash": second_hash, "amount": 5000, "checkout_request_id": "ws_CO_2"},
+    ]}))
+    # The customer retried the push, then paid the first prompt
+    store_callbacks(mock_db, (callback_body(Amount=5000, MpesaReceiptNumber="QWE123"), TOKEN_HASH))
+
+    assert asyncio.run(server.apply_mpesa_callbacks()) == 1
+
+    order = asyncio.run(mock_db.orders.find_one({"id": "o1"}))
+    assert order["payment_status"] == "paid" and order["mpesa_receipt_number"] == "QWE123"
+    callback = asyncio.run(mock_db.mpesa_callbacks.find_one({"id": "cb0"}))
+    assert callback["processed"] and "error" not in callback
+
+
+def test_unmatched_callbacks_are_kept_with_an_error(mock_db, caplog):
+    import server
+
+    asyncio.run(mock_db.orders.insert_one({"id": "o1", "payment_status": "pending", "mpesa_checkouts": [
+        {"token_hash": TOKEN_HASH, "amount": 5000},
+    ]}))
+    store_callbacks(
+        mock_db,
+        (callback_body(Amount=50, MpesaReceiptNumber="QWE123"), TOKEN_HASH),
+        (callback_body(Amount=5000, MpesaReceiptNumber="QWE124"), callback_token_hash("unknown")),
+    )
+
+    asyncio.run(server.apply_mpesa_callbacks())
+
+    order = asyncio.run(mock_db.orders.find_one({"id": "o1"}))
+    assert order["payment_status"] == "pending"
+    callbacks = asyncio.run(mock_db.mpesa_callbacks.find({}, {"_id": 0}).sort("id", 1).to_list(None))
+    assert all(callback["processed"] for callback in callbacks)
+    assert "Paid amount 50 does not match the requested 5000" in callbacks[0]["error"]
+    assert "No order has a checkout" in callbacks[1]["error"]
+    assert caplog.text.count("Skipping M-Pesa callback") == 2
+
+
+def test_every_push_keeps_its_own_checkout(api, mock_db, monkeypatch):
+    from types import SimpleNamespace
+
+    import server
+
+    pushes = []
+
+    async def stk_push(**kwargs):
+        pushes.append(kwargs)
+        return {"CheckoutRequestID": f"ws_CO_{len(pushes)}"}
+
+    monkeypatch.setattr(server, "mpesa_client", SimpleNamespace(stk_push=stk_push))
+    asyncio.run(mock_db.orders.insert_one({"id": "o1", "total_amount": 5000.0, "payment_status": "pending"}))
+
+    for _ in range(2):
+        assert api.post("/api/mpesa/stk-push", params={"order_id": "o1", "phone_number": "254700000000"}).status_code == 200
+
+    order = asyncio.run(mock_db.orders.find_one({"id": "o1"}))
+    hashes = [callback_token_hash(push["callback_url"].rsplit("/", 1)[1]) for push in pushes]
+    assert [(c["token_hash"], c["checkout_request_id"], c["amount"]) for c in order["mpesa_checkouts"]] == [
+        (hashes[0], "ws_CO_1", 5000), (hashes[1], "ws_CO_2", 5000),
+    ]
@@ -0,0 +1,30 @@
+from pymongo import monitoring
+
+from pool_stats import PoolStatsListener
+
+ADDRESS = ("db.internal", 27017)
+
+
+def test_checkouts_and_waits_are_tracked_per_server():
+    listener = PoolStatsListener()
+    listener.connection_created(monitoring.ConnectionCreatedEvent(ADDRESS, 1))
+    listener.connection_check_out_started(monitoring.ConnectionCheckOutStartedEvent(ADDRESS))
+    waiting = listener.stats()["db.internal:27017"]["wait_queue"]
+    listener.connection_checked_out(monitoring.ConnectionCheckedOutEvent(ADDRESS, 1))
+    busy = listener.stats()["db.internal:27017"]
+    listener.connection_checked_in(monitoring.ConnectionCheckedInEvent(ADDRESS, 1))
+    idle = listener.stats()["db.internal:27017"]
+
+    assert waiting == 1
+    assert busy["checked_out"] == 1 and busy["wait_queue"] == 0 and busy["checkouts"] == 1
+    assert idle["checked_out"] == 0 and idle["open"] == 1
+
+
+def test_failed_checkouts_leave_the_wait_queue():
+    listener = PoolStatsListener()
+    listener.connection_check_out_started(monitoring.ConnectionCheckOutStartedEvent(ADDRESS))
+    listener.connection_check_out_failed(monitoring.ConnectionCheckOutFailedEvent(ADDRESS, "timeout"))
+
+    stats = listener.stats()["db.internal:27017"]
+    assert stats["wait_queue"] == 0
+    assert stats["checkout_failures"] == 1
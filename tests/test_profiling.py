@@ -0,0 +1,97 @@
+import time
+
+import pytest
+
+from profiling import PROFILE_HEADER, ProfileStore, sign_profile_request, verify_profile_token
+
+
+def test_profile_tokens_are_bound_to_path_and_expiry():
+    expires = int(time.time()) + 60
+    token = sign_profile_request("secret", "/api/orders", expires)
+
+    assert verify_profile_token("secret", "/api/orders", token)
+    assert not verify_profile_token("secret", "/api/products", token)
+    assert not verify_profile_token("other", "/api/orders", token)
+    assert not verify_profile_token("secret", "/api/orders", sign_profile_request("secret", "/api/orders", 1))
+
+
+def test_store_keeps_only_the_newest_profiles(tmp_path):
+    from collections import Counter
+
+    store = ProfileStore(tmp_path, max_profiles=2)
+    ids = ["00000000-0000-0000-0000-00000000000%d" % n for n in range(3)]
+    for profile_id in ids:
+        store.save({"id": profile_id}, Counter({"main;handler": 3}))
+        time.sleep(0.01)
+
+    assert [summary["id"] for summary in store.index()] == ids[:0:-1]
+    assert store.read(ids[0]) is None
+    assert store.read(ids[2]) == "main;handler 3\n"
+    assert store.read("../etc/passwd") is None
+
+
+def profiled_app(store, **options):
+    from fastapi import FastAPI
+    from fastapi.testclient import TestClient
+
+    from profiling import ProfilingMiddleware
+
+    app = FastAPI()
+    app.add_middleware(ProfilingMiddleware, store=store, secret="secret", interval=0.001, **options)
+    return app, TestClient(app)
+
+
+def signed(path):
+    return {PROFILE_HEADER: sign_profile_request("secret", path, int(time.time()) + 60)}
+
+
+def test_signed_requests_are_profiled(tmp_path):
+    pytest.importorskip("fastapi")
+    pytest.importorskip("httpx")
+
+    store = ProfileStore(tmp_path)
+    app, client = profiled_app(store)
+
+    # Async handlers run on the event loop thread, the one the sampler watches
+    @app.get("/slow")
+    async def slow():
+        deadline = time.perf_counter() + 0.05
+        while time.perf_counter() < deadline:
+            pass
+        return {}
+
+    plain = client.get("/slow")
+    profiled = client.get("/slow", headers=signed("/slow"))
+
+    assert "X-Profile-Id" not in plain.headers
+    [summary] = store.index()
+    assert summary["id"] == profiled.headers["X-Profile-Id"]
+    assert summary["route"] == "/slow" and summary["trigger"] == "header"
+    assert "slow (test_profiling.py:" in store.read(summary["id"])
+
+
+def test_event_streams_are_not_profiled(tmp_path):
+    pytest.importorskip("fastapi")
+    pytest.importorskip("httpx")
+    from fastapi.responses import StreamingResponse
+
+    store = ProfileStore(tmp_path)
+    app, client = profiled_app(store, max_concurrent=1)
+
+    @app.get("/events")
+    async def events():
+        async def stream():
+            yield "data: one\n\n"
+        return StreamingResponse(stream(), media_type="text/event-stream")
+
+    @app.get("/ping")
+    async def ping():
+        return {}
+
+    streamed = client.get("/events", headers=signed("/events"))
+    profiled = client.get("/ping", headers=signed("/ping"))
+
+    assert streamed.text == "data: one\n\n"
+    assert "X-Profile-Id" not in streamed.headers
+    # The stream released its slot, so the next request could still be profiled
+    assert [summary["id"] for summary in store.index()] == [profiled.headers["X-Profile-Id"]]
@@ -0,0 +1,148 @@
+"""Upper bounds on the MongoDB commands each endpoint issues.
+
+These run against a real MongoDB at MONGO_URL (skipped when none is
+reachable) and count every command the app sends while serving a request,
+so an accidental extra round trip fails the build.
+"""
+import os
+import uuid
+
+import pytest
+
+pytest.importorskip("fastapi")
+pytest.importorskip("motor")
+pytest.importorskip("httpx")
+
+from pymongo import MongoClient, monitoring
+from pymongo.errors import PyMongoError
+
+MONGO_URL = os.environ.get("MONGO_URL", "mongodb://localhost:27017")
+TEST_DB = f"round_trips_{uuid.uuid4().hex[:8]}"
+
+os.environ.setdefault("MONGO_URL", MONGO_URL)
+os.environ["DB_NAME"] = TEST_DB
+os.environ["BCRYPT_ROUNDS"] = "4"
+
+
+class CommandCounter(monitoring.CommandListener):
+    def __init__(self):
+        self.commands = []
+
+    def started(self, event):
+        if event.command_name not in ("endSessions", "killCursors"):
+            self.commands.append(event.command_name)
+
+    def succeeded(self, event):
+        pass
+
+    def failed(self, event):
+        pass
+
+
+@pytest.fixture(scope="module")
+def app_client():
+    try:
+        sync_client = MongoClient(MONGO_URL, serverSelectionTimeoutMS=500)
+        sync_client.admin.command("ping")
+    except PyMongoError:
+        pytest.skip(f"MongoDB not reachable at {MONGO_URL}")
+
+    from fastapi.testclient import TestClient
+    from motor.motor_asyncio import AsyncIOMotorClient
+
+    import server
+    from indexes import INDEXES
+
+    for collection, indexes in INDEXES.items():
+        sync_client[TEST_DB][collection].create_indexes(indexes)
+
+    counter = CommandCounter()
+    server.client = AsyncIOMotorClient(MONGO_URL, event_listeners=[counter])
+    server.db = server.catalog_db = server.client[TEST_DB]
+    server.clear_catalog_cache()
+    # The lifespan is deliberately not run, so background workers add no commands
+    client = TestClient(server.app)
+    yield client, counter
+    sync_client.drop_database(TEST_DB)
+
+
+@pytest.fixture
+def count(app_client):
+    client, counter = app_client
+
+    def request(method, url, **kwargs):
+        counter.commands.clear()
+        response = getattr(client, method)(url, **kwargs)
+        assert response.status_code < 500, response.text
+        return response, list(counter.commands)
+
+    return request
+
+
+def assert_at_most(commands, limit):
+    assert len(commands) <= limit, f"{len(commands)} commands (limit {limit}): {commands}"
+
+
+def test_catalog_round_trips(count):
+    response, commands = count("post", "/api/init-sample-data")
+    assert_at_most(commands, 2)
+
+    response, commands = count("get", "/api/products")
+    assert_at_most(commands, 1)
+    product = response.json()[0]
+
+    _, commands = count("get", "/api/products")
+    assert_at_most(commands, 0)
+
+    _, commands = count("get", f"/api/products/{product['id']}")
+    assert_at_most(commands, 1)
+
+    _, commands = count("put", f"/api/products/{product['id']}", json={"price": 99.5})
+    assert_at_most(commands, 1)
+
+    _, commands = count("get", "/api/categories")
+    assert_at_most(commands, 1)
+
+
+def test_cart_and_order_round_trips(count):
+    products, _ = count("get", "/api/products")
+    first, second = products.json()[:2]
+    session_id = str(uuid.uuid4())
+
+    _, commands = count("post", "/api/cart/add", params={"session_id": session_id, "product_id": first["id"]})
+    assert_at_most(commands, 2)
+
+    _, commands = count("post", "/api/cart/update", params={"session_id": session_id, "product_id": first["id"], "quantity": 2})
+    assert_at_most(commands, 2)
+
+    _, commands = count("post", f"/api/cart/{session_id}/batch", json={"operations": [
+        {"op": "add", "product_id": second["id"], "quantity": 1},
+        {"op": "remove", "product_id": second["id"]},
+    ]})
+    assert_at_most(commands, 2)
+
+    email = f"{uuid.uuid4().hex}@example.com"
+    _, commands = count("post", "/api/register", json={"email": email, "password": "secret"})
+    assert_at_most(commands, 1)
+
+    token, commands = count("post", "/api/token", data={"username": email, "password": "secret"})
+    assert_at_most(commands, 1)
+    headers = {"Authorization": f"Bearer {token.json()['access_token']}"}
+
+    order_data = {
+        "customer_name": "Test", "customer_email": email, "customer_phone": "0700000000",
+        "customer_address": "Nairobi", "cart_session_id": session_id,
+    }
+    # user, cart claim, stock check, reservation, insert, job enqueue
+    order, commands = count("post", "/api/orders", json=order_data, headers=headers)
+    assert_at_most(commands, 6)
+    order_id = order.json()["id"]
+
+    _, commands = count("get", f"/api/orders/{order_id}")
+    assert_at_most(commands, 1)
+
+    _, commands = count("put", f"/api/orders/{order_id}/status", params={"status": "confirmed"})
+    assert_at_most(commands, 1)
+
+    _, commands = count("get", "/api/orders/me", headers=headers)
+    assert_at_most(commands, 1)
@@ -0,0 +1,44 @@
+import asyncio
+from datetime import datetime
+
+import pytest
+
+pytest.importorskip("fastapi")
+pytest.importorskip("httpx")
+pytest.importorskip("mongomock_motor")
+
+
+def order(order_id, status, *items):
+    return {
+        "id": order_id, "status": status, "created_at": datetime(2026, 10, 1, 12),
+        "total_amount": sum(item["subtotal"] for item in items), "items": list(items),
+    }
+
+
+def item(product_id, quantity, price, category="Brakes"):
+    return {"product_id": product_id, "product_name": product_id.upper(), "quantity": quantity,
+            "price": price, "subtotal": quantity * price, "category": category}
+
+
+def test_rebuild_replaces_rollups_with_totals_from_orders(api, mock_db):
+    asyncio.run(mock_db.orders.insert_many([
+        order("o1", "pending", item("p1", 2, 10.0), item("p2", 1, 5.0, "Filters")),
+        order("o2", "delivered", item("p1", 1, 10.0)),
+        order("o3", "cancelled", item("p2", 4, 5.0, "Filters")),
+    ]))
+    # Drifted rows, including one for a product that no longer has sales
+    asyncio.run(mock_db.sales_daily.insert_one({"day": "2026-10-01", "revenue": 999.0, "orders": 9, "units": 9}))
+    asyncio.run(mock_db.product_sales.insert_one({"product_id": "gone", "revenue": 1.0, "units": 1}))
+
+    assert api.post("/api/admin/stats/rebuild").status_code == 200
+
+    daily = asyncio.run(mock_db.sales_daily.find({}, {"_id": 0}).to_list(None))
+    assert daily == [{"day": "2026-10-01", "revenue": 35.0, "orders": 2, "units": 4}]
+    categories = asyncio.run(mock_db.sales_by_category.find({}, {"_id": 0}).sort("category", 1).to_list(None))
+    assert [(row["category"], row["revenue"], row["units"]) for row in categories] == [
+        ("Brakes", 30.0, 3), ("Filters", 5.0, 1),
+    ]
+    products = asyncio.run(mock_db.product_sales.find({}, {"_id": 0}).sort("product_id", 1).to_list(None))
+    assert [(row["product_id"], row["revenue"], row["units"]) for row in products] == [
+        ("p1", 30.0, 3), ("p2", 5.0, 1),
+    ]
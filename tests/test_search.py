@@ -0,0 +1,56 @@
+import pytest
+
+pytest.importorskip("fastapi")
+pytest.importorskip("httpx")
+
+
+class FakeCursor:
+    def __init__(self, result):
+        self.result = result
+
+    async def to_list(self, length):
+        return [self.result]
+
+
+class FakeProducts:
+    """Answers the search aggregation with a fixed total and no products."""
+
+    def __init__(self, total):
+        self.total = total
+        self.pipelines = []
+
+    def aggregate(self, pipeline):
+        self.pipelines.append(pipeline)
+        return FakeCursor({"products": [], "total": [{"count": self.total}], "categories": []})
+
+
+@pytest.fixture
+def search(api, monkeypatch):
+    from types import SimpleNamespace
+
+    import server
+
+    products = FakeProducts(total=5000)
+    monkeypatch.setattr(server, "catalog_db", SimpleNamespace(products=products))
+
+    def get(**params):
+        return api.get("/api/products/search", params={"q": "brake", **params})
+
+    return get, products, server.MAX_SEARCH_OFFSET
+
+
+def test_offsets_past_the_cap_are_rejected(search):
+    get, products, cap = search
+
+    assert get(offset=cap + 1).status_code == 400
+    assert get(offset=-1).status_code == 400
+    assert products.pipelines == []
+
+
+def test_paging_stops_at_the_offset_cap(search):
+    get, _, cap = search
+
+    assert get(offset=0, limit=20).json()["next_offset"] == 20
+    assert get(offset=cap - 20, limit=20).json()["next_offset"] == cap
+    assert get(offset=cap, limit=20).json()["next_offset"] is None
+    assert get(offset=cap - 10, limit=20).json()["next_offset"] is None
@@ -0,0 +1,26 @@
+import asyncio
+
+import pytest
+
+pytest.importorskip("fastapi")
+pytest.importorskip("mongomock_motor")
+
+
+def test_startup_fails_when_a_unique_index_is_refused(mock_db):
+    import server
+
+    asyncio.run(mock_db.users.insert_many([
+        {"id": "u1", "email": "dup@example.com"},
+        {"id": "u2", "email": "dup@example.com"},
+    ]))
+
+    with pytest.raises(RuntimeError, match="users"):
+        asyncio.run(server.ensure_indexes())
+
+
+def test_startup_builds_indexes_on_clean_collections(mock_db):
+    import server
+
+    asyncio.run(server.ensure_indexes())
+
+    assert "email_1" in asyncio.run(mock_db.users.index_information())
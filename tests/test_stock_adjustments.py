@@ -0,0 +1,129 @@
+import pytest
+
+pytest.importorskip("fastapi")
+pytest.importorskip("httpx")
+pytest.importorskip("mongomock_motor")
+
+
+def evaluated_arrays(node):
+    """Rewrite [expression] array literals, which mongomock leaves unevaluated, as $map."""
+    if isinstance(node, dict):
+        return {
+            key: [evaluated_arrays(arg) for arg in value] if key.startswith("$") and isinstance(value, list)
+            else evaluated_arrays(value)
+            for key, value in node.items()
+        }
+    if isinstance(node, list) and len(node) == 1 and isinstance(node[0], str) and node[0].startswith("$"):
+        return {"$map": {"input": [0], "in": node[0]}}
+    if isinstance(node, list):
+        return [evaluated_arrays(value) for value in node]
+    return node
+
+
+@pytest.fixture
+def stock(api, mock_db, monkeypatch):
+    import asyncio
+
+    from pymongo import UpdateOne
+
+    db = mock_db
+    collection = type(db.products)
+    bulk_write = collection.bulk_write
+
+    async def evaluating_bulk_write(self, requests, **kwargs):
+        requests = [UpdateOne(r._filter, evaluated_arrays(r._doc)) for r in requests]
+        return await bulk_write(self, requests, **kwargs)
+
+    # mongomock_motor hands out a new collection object on every attribute access
+    monkeypatch.setattr(collection, "bulk_write", evaluating_bulk_write)
+    asyncio.run(db.products.insert_many([
+        {"id": "p1", "name": "Brake pads", "stock_quantity": 10},
+        {"id": "p2", "name": "Oil filter", "stock_quantity": 3},
+    ]))
+
+    def levels():
+        products = asyncio.run(db.products.find({}, {"_id": 0, "id": 1, "stock_quantity": 1}).to_list(None))
+        return {product["id"]: product["stock_quantity"] for product in products}
+
+    def ledger():
+        return asyncio.run(db.stock_ledger.find({}, {"_id": 0}).to_list(None))
+
+    def adjust(*adjustments):
+        return api.post("/api/stock/adjustments", json={"adjustments": list(adjustments), "reference": "count-1"})
+
+    return adjust, levels, ledger, db
+
+
+def test_deltas_and_absolute_levels_apply_in_order(stock):
+    adjust, levels, ledger, _ = stock
+
+    response = adjust(
+        {"product_id": "p1", "delta": -4},
+        {"product_id": "p1", "quantity": 20},
+        {"product_id": "p1", "delta": 5},
+        {"product_id": "p2", "quantity": 7},
+        {"product_id": "unknown", "delta": 1},
+    )
+
+    assert response.status_code == 200
+    assert response.json()["applied"] == 4
+    assert response.json()["missing_products"] == ["unknown"]
+    assert levels() == {"p1": 25, "p2": 7}
+    entries = ledger()
+    assert [
+        (entry["product_id"], entry["delta"], entry["quantity"], entry["stock_before"], entry["stock_after"])
+        for entry in entries
+    ] == [
+        ("p1", -4, None, 10, 6), ("p1", None, 20, 6, 20), ("p1", 5, None, 20, 25), ("p2", None, 7, 3, 7),
+    ]
+    assert {entry["batch_id"] for entry in entries} == {response.json()["batch_id"]}
+
+
+def test_stock_never_goes_below_zero(stock):
+    adjust, levels, ledger, _ = stock
+
+    assert adjust({"product_id": "p2", "delta": -5}, {"product_id": "p2", "delta": 2}).status_code == 200
+    assert levels() == {"p1": 10, "p2": 2}
+    assert [(entry["delta"], entry["stock_before"], entry["stock_after"]) for entry in ledger()] == [
+        (-5, 3, 0), (2, 0, 2),
+    ]
+
+
+def test_negative_levels_are_rejected(stock):
+    adjust, levels, ledger, _ = stock
+
+    response = adjust({"product_id": "p2", "delta": -1}, {"product_id": "p1", "quantity": -3})
+
+    assert response.status_code == 400
+    assert "p1" in response.json()["detail"]
+    assert levels() == {"p1": 10, "p2": 3}
+    assert ledger() == []
+
+
+def test_ledger_only_records_adjustments_that_were_applied(stock, monkeypatch):
+    from pymongo.errors import BulkWriteError
+
+    adjust, levels, ledger, db = stock
+    collection = type(db.products)
+    bulk_write = collection.bulk_write
+
+    async def fail_second_write(self, requests, ordered):
+        # Goes through the fixture's bulk_write, which mongomock can evaluate
+        await bulk_write(self, requests[:1], ordered=ordered)
+        raise BulkWriteError({"writeErrors": [{"index": 1, "code": 11000, "errmsg": "failed"}]})
+
+    monkeypatch.setattr(collection, "bulk_write", fail_second_write)
+    with pytest.raises(BulkWriteError):
+        adjust({"product_id": "p1", "delta": 1}, {"product_id": "p2", "delta": 1})
+
+    assert levels() == {"p1": 11, "p2": 3}
+    assert [(entry["product_id"], entry["stock_after"]) for entry in ledger()] == [("p1", 11)]
+
+
+def test_invalid_adjustments_write_nothing(stock):
+    adjust, levels, ledger, _ = stock
+
+    assert adjust({"product_id": "p1", "delta": 1, "quantity": 4}).status_code == 400
+    assert adjust({"product_id": "p1"}).status_code == 400
+    assert levels() == {"p1": 10, "p2": 3}
+    assert ledger() == []